@@ -4,37 +4,51 @@ Procesa 1TB+ de datos diarios con latencia <5 minutos
 Arquitectura Lambda + Kappa combinada para batch/streaming
 """
 
+from abc import ABC, abstractmethod
 import asyncio
+import bisect
+import heapq
+import importlib.util
+import io
 import json
 import logging
+import re
+import shutil
 import time
-from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Any, Tuple, Set
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Any, Tuple, Set, Callable, Awaitable
 from enum import Enum
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, replace
 from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import multiprocessing as mp
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+import os
+import socket
+import sqlite3
+import tempfile
+import threading
+import uuid
+from urllib.parse import quote
 
 import pandas as pd
 import numpy as np
 import pyarrow as pa
 import pyarrow.parquet as pq
-import dask.dataframe as dd
-from dask.distributed import Client, LocalCluster
+import pyarrow.json as pa_json
+import pyarrow.csv as pa_csv
 import polars as pl
-import ray
-from ray import serve
-import apache_beam as beam
-from apache_beam.options.pipeline_options import PipelineOptions
-from pyspark.sql import SparkSession
-from pyspark.sql.functions import *
-from pyspark.sql.types import *
+# Spark, Dask y Ray se importan al arrancar su motor (LazyEngine): importarlos aquí
+# añadía segundos al arranque de cada pod de la API
 import boto3
 from botocore.exceptions import ClientError
 import google.cloud.bigquery as bigquery
 import google.cloud.storage as storage
-from kafka import KafkaProducer, KafkaConsumer
+from kafka import KafkaProducer
+from aiokafka import AIOKafkaConsumer
+from aiokafka.structs import TopicPartition, ConsumerRecord
 import redis
+import redis.asyncio as aioredis
 import psycopg2
 from psycopg2.extras import execute_batch
 import sqlalchemy
@@ -43,9 +57,10 @@ import duckdb
 import clickhouse_connect
 from prometheus_client import Counter, Histogram, Gauge, start_http_server
 import msgpack
+from pyroaring import BitMap
 import orjson
 import zstandard as zstd
-from lz4 import frame
+import lz4.frame
 import snappy
 
 # Métricas Prometheus
@@ -53,6 +68,15 @@ EVENTS_PROCESSED = Counter('events_processed_total', 'Total events processed')
 PROCESSING_LATENCY = Histogram('processing_latency_seconds', 'Event processing latency')
 DATA_VOLUME_GB = Gauge('data_volume_gb', 'Data volume processed in GB')
 PARALLEL_TASKS = Gauge('parallel_tasks', 'Number of parallel processing tasks')
+PENDING_BATCHES = Gauge('pending_micro_batches', 'Micro-batches waiting for downstream sinks')
+ENGINE_STARTUP_SECONDS = Gauge('engine_startup_seconds', 'Seconds to start a lazy compute engine', ['engine'])
+ENGINE_RUNNING = Gauge('engine_running', 'Whether a lazy compute engine is running', ['engine'])
+SINK_QUEUE_DEPTH = Gauge('sink_queue_depth', 'Chunks waiting in a sink queue (memory + spill)', ['sink'])
+SINK_FLUSH_LATENCY = Histogram('sink_flush_latency_seconds', 'Latency of one coalesced sink write', ['sink'])
+SINK_DROPPED_CHUNKS = Counter('sink_dropped_chunks_total', 'Chunks dropped because the sink queue was full', ['sink'])
+SINK_SPILLED_CHUNKS = Counter('sink_spilled_chunks_total', 'Chunks spilled to disk because the sink queue was full', ['sink'])
+TIME_TO_READY = Gauge('pipeline_time_to_ready_seconds', 'Seconds from service startup until the pipeline is ready')
+POSTGRES_ROWS_PER_SECOND = Gauge('postgres_copy_rows_per_second', 'Rows per second of the last Postgres COPY load')
 
 class ProcessingMode(str, Enum):
     """Modos de procesamiento"""
@@ -71,6 +95,56 @@ class DataSource(str, Enum):
     REDIS = "redis"
     API = "api"
 
+# Esquema fijo del evento en Arrow. `properties` se añade por batch (claves libres).
+EVENT_ARROW_SCHEMA = pa.schema([
+    ('event_id', pa.string()),
+    ('user_id', pa.string()),
+    ('session_id', pa.string()),
+    ('event_type', pa.string()),
+    ('event_name', pa.string()),
+    ('timestamp', pa.timestamp('us')),
+    ('platform', pa.string()),
+    ('device_info', pa.struct([
+        ('os', pa.string()),
+        ('os_version', pa.string()),
+        ('model', pa.string()),
+        ('manufacturer', pa.string())
+    ])),
+    ('location', pa.struct([
+        ('city', pa.string()),
+        ('country', pa.string()),
+        ('region', pa.string()),
+        ('lat', pa.float64()),
+        ('lon', pa.float64())
+    ])),
+    ('app_version', pa.string()),
+    ('ip_address', pa.string()),
+    ('user_agent', pa.string())
+])
+
+# Columnas de perfil que _enrich_data une a cada evento por user_id
+USER_PROFILE_SCHEMA = {
+    'user_id': pl.Utf8,
+    'country': pl.Utf8,
+    'language': pl.Utf8,
+    'subscription_tier': pl.Utf8,
+    'total_spent': pl.Float64,
+    'retention_score': pl.Float64
+}
+
+UNIX_EPOCH = datetime(1970, 1, 1)
+
+# Etapas del funnel de activación, en orden
+FUNNEL_STAGES = ['app_open', 'signup_view', 'signup_submit', 'onboarding_complete', 'first_action']
+
+# Eventos que cuentan como conversión y como final completo de un recorrido en el journey map
+JOURNEY_CONVERSION_EVENTS = ['signup_complete', 'purchase_complete']
+JOURNEY_COMPLETION_EVENTS = ['purchase_complete', 'onboarding_complete']
+
+# Claves de properties que nunca salen del pipeline
+SENSITIVE_PROPERTY_KEY = re.compile(r'password|token|secret|credit', re.IGNORECASE)
+MAX_PROPERTY_LENGTH = 1000
+
 @dataclass
 class UserJourneyEvent:
     """Evento de viaje del usuario"""
@@ -89,17 +163,2665 @@ class UserJourneyEvent:
     user_agent: Optional[str]
     processing_time: float = 0.0
 
-@dataclass
-class JourneyStage:
-    """Etapa en el viaje del usuario"""
-    stage_id: str
-    stage_name: str
-    entry_events: List[str]
-    exit_events: List[str]
-    duration_seconds: int
-    completion_rate: float
-    dropoff_rate: float
-    next_stages: List[str]
+@dataclass
+class JourneyStage:
+    """Etapa en el viaje del usuario"""
+    stage_id: str
+    stage_name: str
+    entry_events: List[str]
+    exit_events: List[str]
+    duration_seconds: int
+    completion_rate: float
+    dropoff_rate: float
+    next_stages: List[str]
+
+class InProcessKafkaConsumer:
+    """
+    Broker Kafka local en proceso con la misma interfaz que AIOKafkaConsumer
+    (start/getmany/commit/stop). Útil para desarrollo y pruebas sin cluster:
+    config['kafka_consumer_factory'] = lambda: consumidor
+    """
+    
+    def __init__(self, topic: str = 'user-journey-events', partitions: int = 1,
+                 value_deserializer=None):
+        self.topic = topic
+        self.value_deserializer = value_deserializer or (lambda v: v)
+        self.logs: Dict[TopicPartition, List[ConsumerRecord]] = {
+            TopicPartition(topic, p): [] for p in range(partitions)
+        }
+        self.positions: Dict[TopicPartition, int] = {tp: 0 for tp in self.logs}
+        self.committed: Dict[TopicPartition, int] = {}
+        self._data_available = asyncio.Event()
+        self._next_partition = 0
+    
+    def produce(self, value: bytes, partition: Optional[int] = None):
+        """Publicar mensaje crudo en el log en memoria"""
+        if partition is None:
+            partition = self._next_partition
+            self._next_partition = (self._next_partition + 1) % len(self.logs)
+        
+        tp = TopicPartition(self.topic, partition)
+        log = self.logs[tp]
+        log.append(ConsumerRecord(
+            topic=self.topic,
+            partition=partition,
+            offset=len(log),
+            timestamp=int(time.time() * 1000),
+            timestamp_type=0,
+            key=None,
+            value=value,
+            checksum=None,
+            serialized_key_size=-1,
+            serialized_value_size=len(value),
+            headers=[]
+        ))
+        self._data_available.set()
+    
+    async def start(self):
+        # Reanudar desde el último commit (o el inicio del log) como haría el group coordinator
+        for tp in self.logs:
+            self.positions[tp] = self.committed.get(tp, 0)
+    
+    async def stop(self):
+        pass
+    
+    async def getmany(self, timeout_ms: int = 0, max_records: Optional[int] = None):
+        if not self._has_pending():
+            self._data_available.clear()
+            try:
+                await asyncio.wait_for(self._data_available.wait(), timeout_ms / 1000)
+            except asyncio.TimeoutError:
+                return {}
+        
+        remaining = max_records or float('inf')
+        records = {}
+        
+        for tp, log in self.logs.items():
+            position = self.positions[tp]
+            if position >= len(log) or remaining <= 0:
+                continue
+            
+            end = int(min(len(log), position + remaining))
+            records[tp] = [
+                replace(message, value=self.value_deserializer(message.value))
+                for message in log[position:end]
+            ]
+            self.positions[tp] = end
+            remaining -= end - position
+        
+        return records
+    
+    async def commit(self, offsets: Optional[Dict[TopicPartition, int]] = None):
+        self.committed.update(offsets if offsets is not None else self.positions)
+    
+    def _has_pending(self) -> bool:
+        return any(self.positions[tp] < len(log) for tp, log in self.logs.items())
+
+class GeoIndex:
+    """
+    Índice geográfico local (city/country → region, timezone, lat/lon) sin geocoder de red.
+    El CSV de referencia se convierte una vez a Arrow IPC ordenado por clave y se abre
+    memory-mapped; las búsquedas son binarias y vectorizadas sobre las claves únicas
+    del batch. Filas con city vacía actúan como fallback a nivel país.
+    """
+    
+    CSV_SCHEMA = {
+        'city': pa.string(),
+        'country': pa.string(),
+        'region': pa.string(),
+        'timezone': pa.string(),
+        'lat': pa.float64(),
+        'lon': pa.float64()
+    }
+    
+    KEY_SEPARATOR = '\x1f'
+    
+    def __init__(self, reference_path: str, hot_cache_size: int = 4096):
+        self.reference_path = reference_path
+        self.index_path = os.path.splitext(reference_path)[0] + '.arrow'
+        self.hot_cache_size = hot_cache_size
+        self._hot_cache: OrderedDict = OrderedDict()
+        
+        if not os.path.exists(self.index_path) or \
+                os.path.getmtime(self.index_path) < os.path.getmtime(reference_path):
+            self._build_index()
+        
+        # Zero-copy: las columnas apuntan directamente al fichero mapeado
+        table = pa.ipc.open_file(pa.memory_map(self.index_path, 'r')).read_all()
+        self.frame = pl.from_arrow(table)
+        self._keys = self.frame['geo_key']
+    
+    def _build_index(self):
+        """Convertir el CSV a Arrow IPC ordenado por clave normalizada"""
+        table = pa_csv.read_csv(
+            self.reference_path,
+            convert_options=pa_csv.ConvertOptions(column_types=self.CSV_SCHEMA)
+        )
+        
+        frame = pl.from_arrow(table).with_columns(
+            self.key_expr(pl.col('city'), pl.col('country')).alias('geo_key')
+        ).unique(subset=['geo_key'], keep='first').sort('geo_key')
+        
+        tmp_path = f"{self.index_path}.tmp"
+        with pa.OSFile(tmp_path, 'wb') as sink:
+            with pa.ipc.new_file(sink, frame.to_arrow().schema) as writer:
+                writer.write_table(frame.to_arrow())
+        os.replace(tmp_path, self.index_path)
+    
+    @classmethod
+    def key_expr(cls, city: pl.Expr, country: pl.Expr) -> pl.Expr:
+        """Clave normalizada country␟city"""
+        return (
+            country.str.strip_chars().str.to_lowercase().fill_null('') +
+            cls.KEY_SEPARATOR +
+            city.str.strip_chars().str.to_lowercase().fill_null('')
+        )
+    
+    def lookup(self, keys: List[str]) -> Dict[str, int]:
+        """Resolver claves únicas a posiciones del índice (caché caliente + búsqueda binaria)"""
+        positions = {}
+        misses = []
+        
+        for key in keys:
+            position = self._hot_cache.get(key)
+            if position is None:
+                misses.append(key)
+            else:
+                self._hot_cache.move_to_end(key)
+                positions[key] = position
+        
+        if misses:
+            resolved = self._search(misses)
+            
+            # Fallback a nivel país para ciudades desconocidas
+            unresolved = [key for key in misses if key not in resolved]
+            if unresolved:
+                country_keys = {key: key.split(self.KEY_SEPARATOR)[0] + self.KEY_SEPARATOR for key in unresolved}
+                by_country = self._search(list(set(country_keys.values())))
+                for key, country_key in country_keys.items():
+                    if country_key in by_country:
+                        resolved[key] = by_country[country_key]
+            
+            for key, position in resolved.items():
+                positions[key] = position
+                self._hot_cache[key] = position
+                if len(self._hot_cache) > self.hot_cache_size:
+                    self._hot_cache.popitem(last=False)
+        
+        return positions
+    
+    def _search(self, keys: List[str]) -> Dict[str, int]:
+        if not keys or self._keys.len() == 0:
+            return {}
+        
+        needles = pl.Series(keys, dtype=pl.Utf8)
+        candidates = self._keys.search_sorted(needles, side='left').clip(0, self._keys.len() - 1)
+        found = self._keys.gather(candidates) == needles
+        
+        return dict(zip(needles.filter(found).to_list(), candidates.filter(found).to_list()))
+    
+    def enrich(self, df: pl.DataFrame) -> pl.DataFrame:
+        """Añadir `location_enriched` mediante un join vectorizado por clave geográfica"""
+        df = df.with_columns(
+            self.key_expr(
+                pl.col('location').struct.field('city'),
+                pl.col('location').struct.field('country')
+            ).alias('geo_key')
+        )
+        
+        positions = self.lookup(df['geo_key'].unique().to_list())
+        matches = self.frame[list(positions.values())].select(
+            pl.Series('geo_key', list(positions.keys()), dtype=pl.Utf8),
+            pl.col('region').alias('geo_region'),
+            pl.col('timezone').alias('geo_timezone'),
+            pl.col('lat').alias('geo_lat'),
+            pl.col('lon').alias('geo_lon')
+        )
+        
+        return df.join(matches, on='geo_key', how='left').with_columns(
+            location_struct_expr(
+                region=pl.col('geo_region'),
+                timezone=pl.col('geo_timezone'),
+                lat=pl.col('geo_lat'),
+                lon=pl.col('geo_lon')
+            )
+        ).drop(['geo_key', 'geo_region', 'geo_timezone', 'geo_lat', 'geo_lon'])
+
+def location_struct_expr(region: pl.Expr = pl.lit(None, pl.Utf8), timezone: pl.Expr = pl.lit(None, pl.Utf8),
+                         lat: pl.Expr = pl.lit(None, pl.Float64), lon: pl.Expr = pl.lit(None, pl.Float64)) -> pl.Expr:
+    """Struct `location_enriched`: datos del índice con fallback a los del propio evento"""
+    location = pl.col('location').struct
+    return pl.struct(
+        location.field('city'),
+        location.field('country'),
+        pl.coalesce(region, location.field('region')).alias('region'),
+        timezone.alias('timezone'),
+        pl.coalesce(lat, location.field('lat')).alias('lat'),
+        pl.coalesce(lon, location.field('lon')).alias('lon')
+    ).alias('location_enriched')
+
+class LocalLakeBackend:
+    """Backend del data lake sobre filesystem local (commit por rename atómico)"""
+    
+    def __init__(self, root: str):
+        self.root = root
+    
+    def uri(self, path: str = '') -> str:
+        return os.path.join(self.root, path)
+    
+    def put_atomic(self, path: str, data: bytes):
+        target = self.uri(path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        
+        tmp_path = f"{target}.tmp-{uuid.uuid4().hex}"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, target)
+
+class S3LakeBackend:
+    """Backend del data lake sobre S3 (un PUT es atómico: el objeto aparece completo o no aparece)"""
+    
+    def __init__(self, client, bucket: str):
+        self.client = client
+        self.bucket = bucket
+    
+    def uri(self, path: str = '') -> str:
+        return f"s3://{self.bucket}/{path}"
+    
+    def put_atomic(self, path: str, data: bytes):
+        content_type = 'application/json' if path.endswith('.json') else 'application/parquet'
+        self.client.put_object(Bucket=self.bucket, Key=path, Body=data, ContentType=content_type)
+
+@dataclass
+class PartitionBuffer:
+    """Filas pendientes de una partición del lake"""
+    frames: List[pl.DataFrame] = field(default_factory=list)
+    size_bytes: int = 0
+    rows: int = 0
+    opened_at: float = field(default_factory=time.monotonic)
+
+class RollingParquetWriter:
+    """
+    Writer de Parquet con particiones Hive (date/hour/event_type). Acumula filas por
+    partición y escribe un fichero cuando alcanza el tamaño objetivo o la edad máxima,
+    ordenado por user_id, timestamp. Cada flush se confirma con un manifiesto en
+    `_manifests/`, escrito después de los ficheros de datos. Una partición sale del
+    buffer solo cuando su fichero está escrito: si el backend falla, las filas siguen
+    en el buffer para el siguiente flush.
+    """
+    
+    PARTITION_COLUMNS = ['date', 'hour', 'event_type']
+    
+    def __init__(self, backend, prefix: str = 'user-journey/events',
+                 target_file_bytes: int = 128 * 1024 * 1024, max_age_seconds: float = 300,
+                 max_buffer_bytes: int = 1024 * 1024 * 1024, row_group_rows: int = 128 * 1024,
+                 compression: str = 'zstd'):
+        self.backend = backend
+        self.prefix = prefix.strip('/')
+        self.target_file_bytes = target_file_bytes
+        self.max_age_seconds = max_age_seconds
+        self.max_buffer_bytes = max_buffer_bytes
+        self.row_group_rows = row_group_rows
+        self.compression = compression
+        self._partitions: Dict[Tuple[str, str, str], PartitionBuffer] = {}
+        self._buffered_bytes = 0
+        # El worker del sink y el checkpoint (flush_all) llaman desde hilos distintos
+        self._lock = threading.RLock()
+    
+    def uri(self) -> str:
+        return self.backend.uri(self.prefix)
+    
+    def write(self, frame: pl.DataFrame) -> List[Dict[str, Any]]:
+        """Añadir filas al buffer y hacer flush de las particiones que lo requieran"""
+        self.append(frame)
+        return self.flush_due()
+    
+    def append(self, frame: pl.DataFrame):
+        """Añadir filas al buffer sin escribir nada"""
+        frame = frame.with_columns(
+            pl.col('timestamp').dt.strftime('%Y-%m-%d').alias('date'),
+            pl.col('timestamp').dt.strftime('%H').alias('hour'),
+            pl.col('event_type').fill_null('__HIVE_DEFAULT_PARTITION__')
+        )
+        
+        with self._lock:
+            for key, part in frame.partition_by(self.PARTITION_COLUMNS, as_dict=True).items():
+                buffer = self._partitions.setdefault(key, PartitionBuffer())
+                size = part.estimated_size()
+                buffer.frames.append(part.drop(self.PARTITION_COLUMNS))
+                buffer.size_bytes += size
+                buffer.rows += part.height
+                self._buffered_bytes += size
+    
+    def flush_due(self) -> List[Dict[str, Any]]:
+        """Flush por tamaño, edad o presión de memoria global"""
+        with self._lock:
+            return self._commit(self._due())
+    
+    def _due(self) -> List[Tuple[str, str, str]]:
+        now = time.monotonic()
+        due = [
+            key for key, buffer in self._partitions.items()
+            if buffer.size_bytes >= self.target_file_bytes or
+            now - buffer.opened_at >= self.max_age_seconds
+        ]
+        
+        # Si el buffer total excede el límite, vaciar las particiones más grandes primero
+        remaining = self._buffered_bytes - sum(self._partitions[key].size_bytes for key in due)
+        for key, buffer in sorted(self._partitions.items(), key=lambda item: -item[1].size_bytes):
+            if remaining <= self.max_buffer_bytes:
+                break
+            if key not in due:
+                due.append(key)
+                remaining -= buffer.size_bytes
+        
+        return due
+    
+    def flush_all(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return self._commit(list(self._partitions))
+    
+    def discard(self):
+        """Descartar filas en buffer (se reentregarán desde el último checkpoint)"""
+        with self._lock:
+            self._partitions.clear()
+            self._buffered_bytes = 0
+    
+    def _commit(self, keys: List[Tuple[str, str, str]]) -> List[Dict[str, Any]]:
+        files = []
+        try:
+            for key in keys:
+                files.append(self._write_partition(key))
+        finally:
+            if files:
+                # El manifiesto se escribe al final: solo referencia ficheros ya visibles
+                # (también los escritos antes de un fallo)
+                manifest = {
+                    'committed_at': datetime.now().isoformat(),
+                    'files': files
+                }
+                manifest_path = f"{self.prefix}/_manifests/{int(time.time() * 1000)}-{uuid.uuid4().hex[:8]}.json"
+                self.backend.put_atomic(manifest_path, orjson.dumps(manifest))
+        
+        return files
+    
+    def _write_partition(self, key: Tuple[str, str, str]) -> Dict[str, Any]:
+        buffer = self._partitions[key]
+        frame = pl.concat(buffer.frames, how='vertical_relaxed').sort(['user_id', 'timestamp'])
+        
+        sink = pa.BufferOutputStream()
+        pq.write_table(
+            frame.to_arrow(compat_level=pl.CompatLevel.oldest()),
+            sink,
+            row_group_size=self.row_group_rows,
+            compression=self.compression,
+            use_dictionary=True,
+            write_statistics=True,
+            data_page_version='2.0'
+        )
+        data = sink.getvalue().to_pybytes()
+        
+        date, hour, event_type = key
+        path = (
+            f"{self.prefix}/date={date}/hour={hour}/event_type={quote(event_type, safe='')}/"
+            f"part-{int(time.time() * 1000)}-{uuid.uuid4().hex[:8]}.parquet"
+        )
+        self.backend.put_atomic(path, data)
+        
+        del self._partitions[key]
+        self._buffered_bytes -= buffer.size_bytes
+        
+        return {
+            'path': path,
+            'partition': {'date': date, 'hour': hour, 'event_type': event_type},
+            'rows': frame.height,
+            'bytes': len(data),
+            'min_timestamp': frame['timestamp'].min().isoformat(),
+            'max_timestamp': frame['timestamp'].max().isoformat()
+        }
+
+class MicroBatcher:
+    """
+    Acumula eventos y dispara batches por tamaño o latencia (lo que ocurra primero).
+    add() se bloquea cuando hay demasiados batches pendientes: backpressure hacia la fuente.
+    Si un batch falla, los siguientes se descartan sin commit y add()/join() relanzan el
+    error para que la fuente se detenga y se reanude desde el último checkpoint.
+    """
+    
+    def __init__(self, handler: Callable[[List[bytes]], Awaitable[Any]],
+                 max_events: int = 1000, max_latency_ms: int = 1000, max_pending_batches: int = 4):
+        self.handler = handler
+        self.max_events = max_events
+        self.max_latency = max_latency_ms / 1000
+        self._buffer: List[bytes] = []
+        self._commits: List[Callable[[], Awaitable[Any]]] = []
+        self._first_event_at: Optional[float] = None
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_pending_batches)
+        self._in_flight = 0
+        self._error: Optional[Exception] = None
+        self.failed = asyncio.Event()
+        self.logger = logging.getLogger("UserJourneyPipeline30X")
+    
+    async def add(self, events: List[bytes],
+                  commit: Optional[Callable[[], Awaitable[Any]]] = None):
+        """Añadir payloads crudos de una lectura de la fuente junto con su callback de commit"""
+        if self._error:
+            raise self._error
+        
+        if events and not self._buffer:
+            self._first_event_at = time.monotonic()
+        
+        self._buffer.extend(events)
+        if commit:
+            self._commits.append(commit)
+        
+        while len(self._buffer) >= self.max_events:
+            await self._enqueue(self.max_events)
+    
+    async def flush(self):
+        """Enviar el buffer actual aunque no haya alcanzado el tamaño"""
+        if self._buffer or self._commits:
+            await self._enqueue(len(self._buffer))
+    
+    async def join(self):
+        """Esperar a que todos los batches encolados se hayan procesado"""
+        await self._queue.join()
+        if self._error:
+            raise self._error
+    
+    def is_idle(self) -> bool:
+        """Sin eventos en buffer ni batches pendientes o en proceso"""
+        return not self._buffer and not self._commits and self._queue.empty() and self._in_flight == 0
+    
+    async def run(self):
+        """Worker de procesamiento + disparador por latencia"""
+        await asyncio.gather(self._drain(), self._tick())
+    
+    async def _enqueue(self, size: int):
+        batch = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        
+        # Los commits solo viajan con el batch que contiene el último evento de su lectura
+        commits = []
+        if not self._buffer:
+            commits, self._commits = self._commits, []
+            self._first_event_at = None
+        else:
+            self._first_event_at = time.monotonic()
+        
+        # Bloquea si los sinks van atrasados
+        await self._queue.put((batch, commits))
+        PENDING_BATCHES.set(self._queue.qsize())
+    
+    async def _drain(self):
+        while True:
+            batch, commits = await self._queue.get()
+            self._in_flight += 1
+            try:
+                # Tras un fallo no se procesa nada más: todo se reentrega desde el checkpoint
+                if self._error:
+                    continue
+                
+                if batch:
+                    await self.handler(batch)
+                
+                for commit in commits:
+                    await commit()
+            
+            except Exception as e:
+                self.logger.error(f"Error procesando micro-batch: {str(e)}")
+                self._error = e
+                self.failed.set()
+            
+            finally:
+                self._in_flight -= 1
+                self._queue.task_done()
+                PENDING_BATCHES.set(self._queue.qsize())
+    
+    async def _tick(self):
+        interval = max(self.max_latency / 4, 0.001)
+        while True:
+            await asyncio.sleep(interval)
+            if self._first_event_at is not None and \
+                    time.monotonic() - self._first_event_at >= self.max_latency:
+                await self.flush()
+
+@dataclass
+class FunnelDefinition:
+    """Funnel ordenado con ventana de conversión desde la primera etapa"""
+    name: str
+    stages: List[str]
+    window_seconds: float = 7 * 24 * 3600
+
+class FunnelTracker:
+    """
+    Operador incremental de funnel entre batches.
+    Guarda por usuario solo (etapa alcanzada, inicio del intento) y acumula cuántos
+    intentos llegan a cada etapa. Un usuario avanza si su siguiente evento de la
+    secuencia llega dentro de la ventana, aunque sea en otro micro-batch. Los
+    intentos cuya ventana ya cerró respecto al watermark se expiran y max_users
+    acota la memoria (se descartan los intentos más antiguos). El watermark se
+    retrasa allowed_lateness segundos para tolerar eventos que llegan tarde.
+    """
+    
+    def __init__(self, definition: FunnelDefinition, max_users: int = 1_000_000,
+                 allowed_lateness: float = 300):
+        self.definition = definition
+        self.max_users = max_users
+        self.allowed_lateness = allowed_lateness
+        self._stage_index = {stage: i for i, stage in enumerate(definition.stages)}
+        
+        # user_id -> [etapa alcanzada, inicio del intento (epoch s)], en orden de inicio
+        self._users: OrderedDict = OrderedDict()
+        self.reached = [0] * len(definition.stages)
+        self.watermark = 0.0
+        self.expired = 0
+    
+    def update(self, df: pl.DataFrame):
+        """Aplicar los eventos de funnel de un batch (user_id, event_name, timestamp)"""
+        events = df.filter(
+            pl.col('event_name').is_in(self.definition.stages) &
+            pl.col('user_id').is_not_null() &
+            pl.col('timestamp').is_not_null()
+        ).select(
+            'user_id',
+            pl.col('event_name').replace_strict(self._stage_index, return_dtype=pl.Int32).alias('stage'),
+            (pl.col('timestamp').dt.epoch('us') / 1_000_000).alias('ts')
+        ).sort('user_id', 'ts')
+        
+        if events.height == 0:
+            return
+        
+        window = self.definition.window_seconds
+        last_stage = len(self.definition.stages) - 1
+        users = self._users
+        
+        for user_id, stage, ts in events.iter_rows():
+            state = users.get(user_id)
+            
+            if state is not None and ts - state[1] > window:
+                # Ventana cerrada: el intento ya no puede convertir
+                del users[user_id]
+                self.expired += 1
+                state = None
+            
+            if state is None:
+                if stage == 0:
+                    users[user_id] = [0, ts]
+                    self.reached[0] += 1
+                continue
+            
+            if stage == state[0] + 1 and ts >= state[1]:
+                state[0] = stage
+                self.reached[stage] += 1
+                if stage == last_stage:
+                    del users[user_id]
+        
+        self.watermark = max(self.watermark, events['ts'].max())
+        self._expire()
+    
+    def _expire(self):
+        cutoff = self.watermark - self.allowed_lateness - self.definition.window_seconds
+        users = self._users
+        
+        # El orden de inserción es aproximadamente el orden de inicio
+        while users:
+            user_id, (_, started_at) = next(iter(users.items()))
+            if started_at >= cutoff and len(users) <= self.max_users:
+                break
+            users.popitem(last=False)
+            self.expired += 1
+    
+    def metrics(self) -> Dict[str, float]:
+        """Intentos por etapa y conversión acumulada entre etapas consecutivas (%)"""
+        stages = self.definition.stages
+        result = {}
+        for i, stage in enumerate(stages):
+            result[stage] = self.reached[i]
+            if i > 0 and self.reached[i - 1] > 0:
+                result[f'{stages[i - 1]}_to_{stage}_conversion'] = self.reached[i] / self.reached[i - 1] * 100
+        
+        result['in_progress'] = len(self._users)
+        return result
+    
+    def snapshot(self) -> bytes:
+        return msgpack.packb({
+            'stages': self.definition.stages,
+            'window_seconds': self.definition.window_seconds,
+            'users': [[user_id, stage, started_at] for user_id, (stage, started_at) in self._users.items()],
+            'reached': self.reached,
+            'watermark': self.watermark,
+            'expired': self.expired
+        })
+    
+    def restore(self, data: bytes):
+        state = msgpack.unpackb(data)
+        if state['stages'] != self.definition.stages:
+            raise ValueError(f"Snapshot de funnel '{self.definition.name}' con otras etapas")
+        
+        self._users = OrderedDict((user_id, [stage, started_at]) for user_id, stage, started_at in state['users'])
+        self.reached = state['reached']
+        self.watermark = state['watermark']
+        self.expired = state['expired']
+
+SESSION_SCHEMA = {
+    'user_id': pl.Utf8,
+    'session_id': pl.Utf8,
+    'session_start': pl.Datetime('us'),
+    'session_end': pl.Datetime('us'),
+    'duration_seconds': pl.Float64,
+    'event_count': pl.Int64,
+    'path': pl.List(pl.Utf8),
+    'platform': pl.Utf8
+}
+
+# Intervalos entre eventos consecutivos de una sesión (Sessionizer.last_gaps)
+GAP_SCHEMA = {'platform': pl.Utf8, 'ts': pl.Float64, 'gap': pl.Float64}
+
+class Sessionizer:
+    """
+    Sesionización en streaming por (user_id, session_id) con ventanas por inactividad.
+    Una sesión se cierra cuando el watermark (máximo event time visto menos
+    allowed_lateness) supera su último evento en más de gap_seconds. Los eventos
+    más antiguos que el watermark de una sesión ya cerrada se descartan como tardíos.
+    Las sesiones abiertas viven en un dict ordenado por actividad; por encima de
+    max_open_sessions las menos recientes se mueven a SQLite en spill_path.
+    Cada sesión guarda su recorrido (event_name en orden de event time) hasta
+    max_path_events eventos y la plataforma de su primer evento. Tras cada update(),
+    `last_gaps` tiene los intervalos entre eventos consecutivos de una misma sesión
+    (también los que cruzan batches).
+    """
+    
+    def __init__(self, gap_seconds: float = 1800, allowed_lateness: float = 300,
+                 max_open_sessions: int = 500_000, spill_path: Optional[str] = None,
+                 max_path_events: int = 50):
+        self.gap = gap_seconds
+        self.allowed_lateness = allowed_lateness
+        self.max_open_sessions = max_open_sessions
+        self.spill_path = spill_path
+        self.max_path_events = max_path_events
+        
+        # (user_id, session_id) -> [inicio, fin, eventos, [(ts, event_name), ...], plataforma]
+        # en epoch s, menos reciente primero
+        self._open: OrderedDict = OrderedDict()
+        self._spill = None
+        self._spilled = 0
+        self.watermark = float('-inf')
+        self.late_events = 0
+        self.last_gaps = pl.DataFrame(schema=GAP_SCHEMA)
+    
+    @property
+    def open_sessions(self) -> int:
+        return len(self._open) + self._spilled
+    
+    def update(self, df: pl.DataFrame) -> pl.DataFrame:
+        """Aplicar un batch y devolver las sesiones cerradas (SESSION_SCHEMA)"""
+        closed = []
+        self.last_gaps = pl.DataFrame(schema=GAP_SCHEMA)
+        
+        if df.height:
+            events = self._events(df)
+            segments = self._segments(events)
+            if segments.height:
+                batch_gaps = []
+                self._merge(segments, closed, batch_gaps)
+                self.watermark = max(self.watermark, segments['end'].max() - self.allowed_lateness)
+                self.last_gaps = pl.concat([
+                    events.filter(pl.col('gap') <= self.gap).select(list(GAP_SCHEMA)),
+                    pl.DataFrame(batch_gaps, schema=GAP_SCHEMA, orient='row')
+                ])
+        
+        self._close_expired(closed)
+        self._spill_overflow()
+        
+        return self._closed_frame(closed)
+    
+    def _events(self, df: pl.DataFrame) -> pl.DataFrame:
+        """Eventos del batch ordenados por sesión y event time, con el intervalo desde el anterior"""
+        key = ['user_id', 'session_id']
+        name = pl.col('event_name') if 'event_name' in df.columns else pl.lit(None, dtype=pl.Utf8)
+        platform = pl.col('platform') if 'platform' in df.columns else pl.lit(None, dtype=pl.Utf8)
+        return df.select(
+            *key,
+            (pl.col('timestamp').dt.epoch('us') / 1_000_000).alias('ts'),
+            name.fill_null('unknown').alias('event_name'),
+            platform.fill_null('unknown').alias('platform')
+        ).drop_nulls().sort(*key, 'ts').with_columns(
+            pl.col('ts').diff().over(key).alias('gap')
+        )
+    
+    def _segments(self, events: pl.DataFrame) -> pl.DataFrame:
+        """Tramos de actividad del batch: eventos de una sesión separados por menos de gap"""
+        key = ['user_id', 'session_id']
+        return events.with_columns(
+            (pl.col('gap').fill_null(0) > self.gap).cum_sum().over(key).alias('segment')
+        ).group_by(*key, 'segment').agg(
+            pl.col('ts').min().alias('start'),
+            pl.col('ts').max().alias('end'),
+            pl.len().alias('count'),
+            pl.col('ts').head(self.max_path_events).alias('path_ts'),
+            pl.col('event_name').head(self.max_path_events).alias('path'),
+            pl.col('platform').first()
+        ).sort('start')
+    
+    def _merge(self, segments: pl.DataFrame, closed: List[tuple], gaps: List[tuple]):
+        gap = self.gap
+        sessions = self._open
+        
+        for user_id, session_id, _, start, end, count, path_ts, names, platform in segments.iter_rows():
+            path = list(zip(path_ts, names))
+            if end + gap < self.watermark:
+                # La sesión a la que pertenecía ya se cerró y se emitió
+                self.late_events += count
+                continue
+            
+            key = (user_id, session_id)
+            state = sessions.pop(key, None)
+            if state is None and self._spilled:
+                state = self._unspill(key)
+            
+            if state is None:
+                state = [start, end, count, path, platform]
+            
+            elif start > state[1] + gap:
+                # Inactividad: cerrar la sesión anterior y abrir una nueva
+                closed.append((*key, *state))
+                state = [start, end, count, path, platform]
+            
+            elif end + gap < state[0]:
+                # Tramo tardío anterior a la sesión abierta
+                closed.append((*key, start, end, count, path, platform))
+            
+            else:
+                if start >= state[1]:
+                    # Intervalo desde el último evento del batch anterior
+                    gaps.append((state[4] or platform, start, start - state[1]))
+                state = [min(state[0], start), max(state[1], end), state[2] + count,
+                         self._merge_path(state[3], path), state[4] or platform]
+            
+            sessions[key] = state
+    
+    def _merge_path(self, path: list, other: list) -> list:
+        """Unir dos recorridos por event time (el tramo nuevo suele ir detrás)"""
+        if not path or other[0][0] >= path[-1][0]:
+            merged = path + other
+        else:
+            merged = list(heapq.merge(path, other, key=lambda event: event[0]))
+        return merged[:self.max_path_events]
+    
+    def _close_expired(self, closed: List[tuple]):
+        cutoff = self.watermark - self.gap
+        sessions = self._open
+        
+        while sessions:
+            key, state = next(iter(sessions.items()))
+            if state[1] >= cutoff:
+                break
+            sessions.popitem(last=False)
+            closed.append((*key, *state))
+        
+        if self._spilled:
+            rows = self._spill.execute(
+                "SELECT user_id, session_id, start, end, count, path, platform FROM open_sessions WHERE end < ?",
+                (cutoff,)
+            ).fetchall()
+            if rows:
+                self._spill.execute("DELETE FROM open_sessions WHERE end < ?", (cutoff,))
+                self._spilled -= len(rows)
+                closed.extend((*row[:5], msgpack.unpackb(row[5]), row[6]) for row in rows)
+    
+    def _spill_overflow(self):
+        overflow = len(self._open) - self.max_open_sessions
+        if overflow <= 0:
+            return
+        
+        if self._spill is None:
+            # El spill no sobrevive a reinicios (el estado viene del checkpoint): tabla nueva
+            self._spill = sqlite3.connect(self.spill_path or ':memory:')
+            self._spill.execute("DROP TABLE IF EXISTS open_sessions")
+            self._spill.execute(
+                "CREATE TABLE open_sessions "
+                "(user_id TEXT, session_id TEXT, start REAL, end REAL, count INTEGER, path BLOB, platform TEXT, "
+                "PRIMARY KEY (user_id, session_id))"
+            )
+            self._spill.execute("CREATE INDEX open_sessions_end ON open_sessions (end)")
+        
+        rows = [
+            (*key, *state[:3], msgpack.packb(state[3]), state[4])
+            for key, state in (self._open.popitem(last=False) for _ in range(overflow))
+        ]
+        self._spill.executemany("INSERT OR REPLACE INTO open_sessions VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        self._spilled += len(rows)
+    
+    def _unspill(self, key: tuple) -> Optional[list]:
+        row = self._spill.execute(
+            "SELECT start, end, count, path, platform FROM open_sessions WHERE user_id = ? AND session_id = ?", key
+        ).fetchone()
+        if row is None:
+            return None
+        
+        self._spill.execute("DELETE FROM open_sessions WHERE user_id = ? AND session_id = ?", key)
+        self._spilled -= 1
+        return [*row[:3], msgpack.unpackb(row[3]), row[4]]
+    
+    @staticmethod
+    def _closed_frame(closed: List[tuple]) -> pl.DataFrame:
+        frame = pl.DataFrame(
+            [(*session[:5], [event[1] for event in session[5]], session[6]) for session in closed],
+            schema={
+                'user_id': pl.Utf8, 'session_id': pl.Utf8, 'start': pl.Float64, 'end': pl.Float64,
+                'event_count': pl.Int64, 'path': SESSION_SCHEMA['path'], 'platform': pl.Utf8
+            },
+            orient='row'
+        )
+        return frame.select(
+            pl.col('user_id').cast(pl.Utf8),
+            pl.col('session_id').cast(pl.Utf8),
+            pl.from_epoch((pl.col('start') * 1_000_000).cast(pl.Int64), time_unit='us').alias('session_start'),
+            pl.from_epoch((pl.col('end') * 1_000_000).cast(pl.Int64), time_unit='us').alias('session_end'),
+            (pl.col('end') - pl.col('start')).cast(pl.Float64).alias('duration_seconds'),
+            pl.col('event_count').cast(pl.Int64),
+            pl.col('path'),
+            pl.col('platform')
+        )
+    
+    def snapshot(self) -> bytes:
+        sessions = [[*key, *state] for key, state in self._open.items()]
+        if self._spilled:
+            sessions.extend(
+                [*row[:5], msgpack.unpackb(row[5]), row[6]] for row in
+                self._spill.execute("SELECT user_id, session_id, start, end, count, path, platform FROM open_sessions")
+            )
+        
+        return msgpack.packb({
+            'sessions': sessions,
+            'watermark': self.watermark,
+            'late_events': self.late_events
+        })
+    
+    def restore(self, data: bytes):
+        state = msgpack.unpackb(data)
+        if self._spill is not None:
+            self._spill.execute("DELETE FROM open_sessions")
+            self._spilled = 0
+        
+        # Los snapshots anteriores a los recorridos no traen `path` ni `platform`
+        self._open = OrderedDict(
+            ((user_id, session_id), [start, end, count, rest[0] if rest else [], rest[1] if len(rest) > 1 else None])
+            for user_id, session_id, start, end, count, *rest in sorted(state['sessions'], key=lambda s: s[3])
+        )
+        self.watermark = state['watermark']
+        self.late_events = state['late_events']
+        self._spill_overflow()
+
+class JourneyTrie:
+    """
+    Árbol de prefijos de recorridos de sesión. Cada nodo es [sesiones que pasan por el
+    prefijo, sesiones que terminan en él, sesiones que pasan y convierten (contienen un
+    evento de conversion_events), hijos]. Las consultas solo recorren lo que devuelven:
+    top_paths() es una búsqueda best-first acotada por el conteo de cada nodo, y
+    dropoff()/conversión por prefijo bajan por un único camino. Los conteos admiten
+    restas (ventanas deslizantes) y árboles de distintos workers se combinan con merge().
+    """
+    
+    def __init__(self, conversion_events=()):
+        self.conversion_events = frozenset(conversion_events)
+        self.root = [0, 0, 0, {}]
+        self.paths = 0
+        self.ends_by_event: Dict[str, int] = {}
+    
+    def insert(self, path, count: int = 1):
+        """Sumar (o restar, con count negativo) count sesiones con este recorrido"""
+        converted = count if self.conversion_events.intersection(path) else 0
+        node = self.root
+        trail = [node]
+        for name in path:
+            child = node[3].get(name)
+            if child is None:
+                child = node[3][name] = [0, 0, 0, {}]
+            node = child
+            trail.append(node)
+        
+        for visited in trail:
+            visited[0] += count
+            visited[2] += converted
+        self._add_ends(node, path[-1] if path else None, count)
+        
+        if count < 0:
+            # Podar los nodos que se quedan sin sesiones
+            for depth in range(len(path), 0, -1):
+                if trail[depth][0]:
+                    break
+                del trail[depth - 1][3][path[depth - 1]]
+    
+    def _add_ends(self, node: list, last_event: Optional[str], count: int):
+        before = node[1]
+        node[1] += count
+        if not before and node[1]:
+            self.paths += 1
+        elif before and not node[1]:
+            self.paths -= 1
+        
+        if last_event is not None:
+            remaining = self.ends_by_event.get(last_event, 0) + count
+            if remaining:
+                self.ends_by_event[last_event] = remaining
+            else:
+                self.ends_by_event.pop(last_event, None)
+    
+    def _find(self, prefix) -> Optional[list]:
+        node = self.root
+        for name in prefix:
+            node = node[3].get(name)
+            if node is None:
+                return None
+        return node
+    
+    def sessions(self, prefix=()) -> int:
+        node = self._find(prefix)
+        return node[0] if node else 0
+    
+    def conversion_rate(self, prefix=()) -> float:
+        """Porcentaje de las sesiones que pasan por el prefijo que convierten"""
+        node = self._find(prefix)
+        return node[2] / node[0] * 100 if node and node[0] else 0.0
+    
+    def top_paths(self, k: int = 20, prefix=(), min_frequency: int = 1) -> List[Tuple[List[str], int]]:
+        """
+        Los k recorridos completos más frecuentes que empiezan por prefix. Las sesiones que
+        terminan bajo un nodo nunca superan su conteo, así que cada recorrido sale del heap
+        antes que cualquier otro menos frecuente.
+        """
+        node = self._find(prefix)
+        if node is None:
+            return []
+        
+        tie = 0  # desempate estable sin comparar nodos
+        heap = [(-node[0], tie, False, list(prefix), node)]
+        results = []
+        while heap and len(results) < k:
+            count, _, complete, path, node = heapq.heappop(heap)
+            if -count < min_frequency:
+                break
+            
+            if complete:
+                results.append((path, -count))
+                continue
+            
+            if node[1]:
+                tie += 1
+                heapq.heappush(heap, (-node[1], tie, True, path, node))
+            for name, child in node[3].items():
+                tie += 1
+                heapq.heappush(heap, (-child[0], tie, False, path + [name], child))
+        
+        return results
+    
+    def main_path(self, max_depth: int = 50) -> List[str]:
+        """Camino principal: en cada paso el hijo con más sesiones"""
+        path = []
+        node = self.root
+        while node[3] and len(path) < max_depth:
+            name, node = max(node[3].items(), key=lambda item: item[1][0])
+            path.append(name)
+        return path
+    
+    def dropoff(self, path) -> List[Dict[str, Any]]:
+        """Sesiones, abandonos y conversión en cada paso de path"""
+        steps = []
+        node = self.root
+        for step, name in enumerate(path, 1):
+            child = node[3].get(name)
+            if child is None:
+                break
+            
+            steps.append({
+                'step': step,
+                'event': name,
+                'sessions': child[0],
+                'reached_from_previous': child[0] / node[0] * 100 if node[0] else 0.0,
+                'ended_here': child[1],
+                'dropoff_rate': child[1] / child[0] * 100,
+                'conversion_rate': child[2] / child[0] * 100
+            })
+            node = child
+        
+        return steps
+    
+    def merge(self, other: 'JourneyTrie'):
+        """Sumar otro árbol (p. ej. construido en otro worker) a este"""
+        stack = [(self.root, other.root, None)]
+        while stack:
+            node, source, last_event = stack.pop()
+            node[0] += source[0]
+            node[2] += source[2]
+            if source[1]:
+                self._add_ends(node, last_event, source[1])
+            
+            for name, child in source[3].items():
+                mine = node[3].get(name)
+                if mine is None:
+                    mine = node[3][name] = [0, 0, 0, {}]
+                stack.append((mine, child, name))
+    
+    def snapshot(self) -> bytes:
+        return msgpack.packb({
+            'conversion_events': sorted(self.conversion_events),
+            'root': self.root
+        })
+    
+    def restore(self, data: bytes):
+        state = msgpack.unpackb(data)
+        source = JourneyTrie()
+        source.root = state['root']
+        
+        self.conversion_events = frozenset(state['conversion_events'])
+        self.root = [0, 0, 0, {}]
+        self.paths = 0
+        self.ends_by_event = {}
+        self.merge(source)
+
+class JourneyMapStore:
+    """
+    Recorridos de sesiones cerradas en una ventana deslizante de window_days buckets
+    diarios (día UTC de fin de sesión). Cada bucket cuenta sesiones por recorrido
+    (tupla de event_name); la ventana entera vive en un JourneyTrie al que se suman las
+    sesiones nuevas y se restan los días que expiran, así que las consultas no recorren
+    los buckets. Si un día supera max_paths_per_day recorridos distintos se descartan
+    los menos frecuentes. Actualización (pool de CPU) y consultas (API) van bajo un lock.
+    """
+    
+    def __init__(self, window_days: int = 7, max_paths_per_day: int = 100_000,
+                 conversion_events=JOURNEY_CONVERSION_EVENTS):
+        self.window_days = window_days
+        self.max_paths_per_day = max_paths_per_day
+        
+        # día (epoch días) -> [sesiones, {recorrido: sesiones}]
+        self._days: Dict[int, list] = {}
+        self.trie = JourneyTrie(conversion_events)
+        # Un solo objeto str por event_name entre todos los recorridos
+        self._names: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        self.sessions = 0
+        self.pruned_sessions = 0
+    
+    def update(self, sessions: pl.DataFrame) -> bool:
+        """Añadir sesiones cerradas (SESSION_SCHEMA); devuelve si cambió la ventana"""
+        if sessions.height == 0:
+            return False
+        
+        with self._lock:
+            self._update(sessions)
+        return True
+    
+    def _update(self, sessions: pl.DataFrame):
+        counts = sessions.group_by(
+            (pl.col('session_end').dt.epoch('d')).alias('day'), 'path'
+        ).agg(pl.len().alias('sessions'))
+        
+        newest = max(counts['day'].max(), max(self._days, default=0))
+        first_day = newest - self.window_days + 1
+        for day in [day for day in self._days if day < first_day]:
+            self._expire(day)
+        
+        names = self._names
+        touched = set()
+        for day, path, count in counts.iter_rows():
+            if day < first_day:
+                continue  # fuera de la ventana
+            
+            path = tuple(names.setdefault(name, name) for name in path)
+            bucket = self._days.setdefault(day, [0, {}])
+            bucket[0] += count
+            bucket[1][path] = bucket[1].get(path, 0) + count
+            self.trie.insert(path, count)
+            self.sessions += count
+            touched.add(day)
+        
+        for day in touched:
+            if len(self._days[day][1]) > self.max_paths_per_day:
+                self._prune(day)
+    
+    def _expire(self, day: int):
+        sessions, paths = self._days.pop(day)
+        self.sessions -= sessions
+        self._subtract(paths.items())
+    
+    def _prune(self, day: int):
+        """Quedarse con el 90% más frecuente del límite para no podar en cada batch"""
+        bucket = self._days[day]
+        keep = heapq.nlargest(int(self.max_paths_per_day * 0.9), bucket[1].items(), key=lambda item: item[1])
+        kept = dict(keep)
+        dropped = [(path, count) for path, count in bucket[1].items() if path not in kept]
+        bucket[1] = kept
+        
+        # Las sesiones podadas salen también de los totales: sessions == trie.sessions()
+        pruned = sum(count for _, count in dropped)
+        bucket[0] -= pruned
+        self.sessions -= pruned
+        self.pruned_sessions += pruned
+        self._subtract(dropped)
+    
+    def _subtract(self, items):
+        for path, count in items:
+            self.trie.insert(path, -count)
+    
+    def summary(self, k: int = 20, min_frequency: int = 1) -> Dict[str, Any]:
+        """Top k recorridos, abandonos por último evento y paso a paso del camino principal"""
+        with self._lock:
+            return {
+                'top_paths': self.trie.top_paths(k, min_frequency=min_frequency),
+                'ends_by_event': dict(self.trie.ends_by_event),
+                'step_dropoff': self.trie.dropoff(self.trie.main_path()),
+                'window': self._window_info()
+            }
+    
+    def query(self, prefix: List[str], k: int = 10) -> Dict[str, Any]:
+        """Recorridos que continúan prefix, con abandono y conversión en cada paso"""
+        with self._lock:
+            sessions = self.trie.sessions(prefix)
+            return {
+                'prefix': prefix,
+                'sessions': sessions,
+                'conversion_rate': self.trie.conversion_rate(prefix),
+                'top_paths': [
+                    {'path': path, 'frequency': count, 'percentage': count / sessions * 100}
+                    for path, count in self.trie.top_paths(k, prefix=prefix)
+                ],
+                'step_dropoff': self.trie.dropoff(prefix)
+            }
+    
+    def window(self) -> Dict[str, Any]:
+        """Rango y volumen de la ventana actual"""
+        with self._lock:
+            return self._window_info()
+    
+    def _window_info(self) -> Dict[str, Any]:
+        if not self._days:
+            return {'days': self.window_days, 'sessions': 0, 'distinct_paths': 0}
+        
+        return {
+            'days': self.window_days,
+            'from': (UNIX_EPOCH + timedelta(days=min(self._days))).date().isoformat(),
+            'to': (UNIX_EPOCH + timedelta(days=max(self._days))).date().isoformat(),
+            'sessions': self.sessions,
+            'distinct_paths': self.trie.paths,
+            'pruned_sessions': self.pruned_sessions
+        }
+    
+    def snapshot(self) -> bytes:
+        with self._lock:
+            return msgpack.packb({
+                'days': [
+                    [day, sessions, [[list(path), count] for path, count in paths.items()]]
+                    for day, (sessions, paths) in self._days.items()
+                ],
+                'pruned_sessions': self.pruned_sessions
+            })
+    
+    def restore(self, data: bytes):
+        state = msgpack.unpackb(data)
+        with self._lock:
+            self._days, self._names = {}, {}
+            self.trie = JourneyTrie(self.trie.conversion_events)
+            self.sessions = 0
+            
+            names = self._names
+            for day, sessions, paths in state['days']:
+                bucket = {}
+                for path, count in paths:
+                    path = tuple(names.setdefault(name, name) for name in path)
+                    bucket[path] = count
+                    self.trie.insert(path, count)
+                self._days[day] = [sessions, bucket]
+                self.sessions += sessions
+            
+            self.pruned_sessions = state['pruned_sessions']
+
+class UserTimelineStore:
+    """
+    Eventos recientes por usuario (hasta max_events) para /journey/{user_id}, en dos
+    niveles: una LRU local de max_users usuarios y una lista por usuario en Redis
+    (`timeline:{user_id}`). Cada evento se guarda codificado como JSON compacto
+    (t: epoch µs, id, s: session_id, n: event_name, e: event_type, p: properties en
+    JSON) junto a su clave de orden (t, id). El stream escribe siempre en Redis y solo
+    actualiza la LRU de los usuarios que ya están en ella; las entradas locales caducan
+    a los local_ttl_seconds para recoger lo que se haya perdido entretanto.
+    """
+    
+    def __init__(self, redis_client=None, max_events: int = 1000, max_users: int = 50_000,
+                 local_ttl_seconds: float = 60, redis_ttl_seconds: int = 7 * 86400):
+        self.redis_client = redis_client
+        self.max_events = max_events
+        self.max_users = max_users
+        self.local_ttl_seconds = local_ttl_seconds
+        self.redis_ttl_seconds = redis_ttl_seconds
+        
+        # user_id -> [cargado en (monotonic), [(t, id, evento codificado), ...] ordenado]
+        self._local: OrderedDict = OrderedDict()
+        # El stream escribe desde el pool de CPU y la API lee desde el event loop
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def encode(frame: pl.DataFrame) -> pl.DataFrame:
+        """Codificar un frame de almacenamiento (_storage_frame) a user_id, t, id, event"""
+        return frame.select(
+            'user_id',
+            pl.col('timestamp').dt.epoch('us').alias('t'),
+            pl.col('event_id').fill_null('').alias('id'),
+            pl.struct(
+                pl.col('timestamp').dt.epoch('us').alias('t'),
+                pl.col('event_id').fill_null('').alias('id'),
+                pl.col('session_id').alias('s'),
+                pl.col('event_name').alias('n'),
+                pl.col('event_type').alias('e'),
+                pl.col('properties').alias('p')
+            ).struct.json_encode().alias('event')
+        ).drop_nulls(['user_id', 't'])
+    
+    @staticmethod
+    def decode(event: str) -> Tuple[str, str, datetime, Any, str]:
+        """Evento codificado a la tupla que consume _build_individual_journey"""
+        data = orjson.loads(event)
+        properties = orjson.loads(data['p']) if data.get('p') else {}
+        timestamp = UNIX_EPOCH + timedelta(microseconds=data['t'])
+        return data['n'], data['e'], timestamp, properties, data['s']
+    
+    def cached_users(self) -> List[str]:
+        with self._lock:
+            return list(self._local)
+    
+    def append(self, encoded: pl.DataFrame):
+        """Añadir eventos a los usuarios presentes en la LRU local"""
+        with self._lock:
+            for user_id, events in encoded.group_by('user_id').agg(
+                pl.struct('t', 'id', 'event')
+            ).iter_rows():
+                entry = self._local.get(user_id)
+                if entry is None:
+                    continue
+                self._merge(entry[1], [(e['t'], e['id'], e['event']) for e in events])
+    
+    def _merge(self, timeline: list, events: list):
+        """Mantener el timeline ordenado por (t, id) y acotado a max_events"""
+        events.sort()
+        if timeline and events[0] < timeline[-1]:
+            timeline[:] = sorted(set(timeline).union(events))
+        else:
+            timeline.extend(events)
+        
+        if len(timeline) > self.max_events:
+            del timeline[:len(timeline) - self.max_events]
+    
+    def get_local(self, user_id: str) -> Optional[list]:
+        with self._lock:
+            entry = self._local.get(user_id)
+            if entry is None or time.monotonic() - entry[0] > self.local_ttl_seconds:
+                return None
+            self._local.move_to_end(user_id)
+            return list(entry[1])
+    
+    def put_local(self, user_id: str, timeline: list):
+        with self._lock:
+            self._local[user_id] = [time.monotonic(), timeline[-self.max_events:]]
+            self._local.move_to_end(user_id)
+            while len(self._local) > self.max_users:
+                self._local.popitem(last=False)
+    
+    def clear_local(self):
+        with self._lock:
+            self._local.clear()
+    
+    def redis_append(self, pipeline, encoded: pl.DataFrame):
+        """Encolar en un pipeline de Redis el append de cada usuario (RPUSH + LTRIM + EXPIRE)"""
+        for user_id, events in encoded.sort('t').group_by('user_id', maintain_order=True).agg('event').iter_rows():
+            key = f"timeline:{user_id}"
+            pipeline.rpush(key, *events)
+            pipeline.ltrim(key, -self.max_events, -1)
+            pipeline.expire(key, self.redis_ttl_seconds)
+    
+    def load_redis(self, user_id: str) -> list:
+        """Timeline desde Redis (bloqueante); los reintentos tras un checkpoint se deduplican por id"""
+        raw = self.redis_client.lrange(f"timeline:{user_id}", 0, -1)
+        timeline = {}
+        for event in raw:
+            data = orjson.loads(event)
+            timeline[(data['t'], data['id'])] = event.decode() if isinstance(event, bytes) else event
+        return [(t, event_id, event) for (t, event_id), event in sorted(timeline.items())]
+    
+    @staticmethod
+    def page(timeline: list, cursor: Optional[str] = None, limit: int = 100) -> Tuple[list, Optional[str]]:
+        """
+        Página de hasta limit eventos anteriores al cursor (o los más recientes), en orden
+        cronológico. El cursor siguiente apunta al evento más antiguo de la página.
+        """
+        end = len(timeline)
+        if cursor:
+            t, _, event_id = cursor.partition(':')
+            end = bisect.bisect_left(timeline, (int(t), event_id), key=lambda event: event[:2])
+        
+        start = max(0, end - limit)
+        page = timeline[start:end]
+        next_cursor = f"{page[0][0]}:{page[0][1]}" if start > 0 else None
+        return page, next_cursor
+
+class AnomalyDetector:
+    """
+    Detector de anomalías en streaming con estado entre batches.
+    Cuenta eventos por bucket de bucket_seconds y (event_type, platform); cuando el
+    watermark cierra un bucket compara su conteo con dos baselines por serie: una EWMA
+    y otra estacional por hora de la semana (168 slots, también EWMA). Se usa la
+    estacional cuando ya tiene min_samples observaciones. Cada cierre actualiza ambas
+    en O(1). Los conteos por usuario se acumulan en ventanas de user_window_seconds y
+    se evalúan al cerrarse con la misma regla de comportamiento errático.
+    """
+    
+    def __init__(self, bucket_seconds: int = 60, alpha: float = 0.05, z_threshold: float = 4.0,
+                 min_samples: int = 30, allowed_lateness: float = 120,
+                 user_window_seconds: int = 3600, erratic_min_events: int = 1000,
+                 erratic_max_event_types: int = 3):
+        self.bucket_seconds = bucket_seconds
+        self.alpha = alpha
+        self.z_threshold = z_threshold
+        self.min_samples = min_samples
+        self.allowed_lateness = allowed_lateness
+        self.user_window_seconds = user_window_seconds
+        self.erratic_min_events = erratic_min_events
+        self.erratic_max_event_types = erratic_max_event_types
+        
+        # bucket (epoch s) -> {(event_type, platform): eventos}
+        self._buckets: Dict[int, Dict[tuple, int]] = {}
+        # (event_type, platform) -> [media, varianza, n] y 168 slots estacionales
+        self._ewma: Dict[tuple, list] = {}
+        self._seasonal: Dict[tuple, List[list]] = {}
+        # ventana (epoch s) -> {user_id: [eventos, tipos de evento]}
+        self._user_windows: Dict[int, Dict[str, list]] = {}
+        
+        self.watermark = float('-inf')
+        self.late_events = 0
+    
+    def update(self, df: pl.DataFrame) -> List[Dict[str, Any]]:
+        """Acumular un batch y devolver las anomalías de los buckets que cierra"""
+        anomalies = []
+        if df.height == 0:
+            return anomalies
+        
+        epoch = pl.col('timestamp').dt.epoch('s')
+        series = [pl.col('event_type').fill_null('unknown'), pl.col('platform').fill_null('unknown')]
+        
+        counts = df.group_by(
+            (epoch // self.bucket_seconds * self.bucket_seconds).alias('bucket'), *series
+        ).agg(pl.len().alias('count'))
+        
+        for bucket, event_type, platform, count in counts.iter_rows():
+            if bucket is None:
+                continue
+            if bucket + self.bucket_seconds <= self.watermark:
+                self.late_events += count
+                continue
+            
+            bucket_counts = self._buckets.setdefault(bucket, {})
+            key = (event_type, platform)
+            bucket_counts[key] = bucket_counts.get(key, 0) + count
+        
+        users = df.group_by(
+            (epoch // self.user_window_seconds * self.user_window_seconds).alias('window'), 'user_id'
+        ).agg(
+            pl.len().alias('count'),
+            pl.col('event_type').drop_nulls().unique().head(self.erratic_max_event_types).alias('event_types')
+        )
+        
+        for window, user_id, count, event_types in users.iter_rows():
+            if window is None or window + self.user_window_seconds <= self.watermark:
+                continue
+            
+            state = self._user_windows.setdefault(window, {}).setdefault(user_id, [0, set()])
+            state[0] += count
+            if len(state[1]) < self.erratic_max_event_types:
+                state[1].update(event_types)
+        
+        latest = df.select(epoch.max()).item()
+        if latest is not None:
+            self.watermark = max(self.watermark, latest - self.allowed_lateness)
+        
+        self._close_buckets(anomalies)
+        self._close_user_windows(anomalies)
+        
+        return anomalies
+    
+    def _close_buckets(self, anomalies: List[Dict[str, Any]]):
+        for bucket in sorted(b for b in self._buckets if b + self.bucket_seconds <= self.watermark):
+            counts = self._buckets.pop(bucket)
+            # Hora de la semana empezando el lunes (el epoch cae en jueves)
+            slot = (bucket // 3600 + 72) % 168
+            
+            # Las series conocidas sin eventos en el bucket cuentan como 0
+            for key in set(self._ewma) | set(counts):
+                count = counts.get(key, 0)
+                ewma = self._ewma.setdefault(key, [0.0, 0.0, 0])
+                seasonal = self._seasonal.setdefault(key, [[0.0, 0.0, 0] for _ in range(168)])[slot]
+                
+                baseline = seasonal if seasonal[2] >= self.min_samples else ewma
+                if baseline[2] >= self.min_samples:
+                    std = max(baseline[1] ** 0.5, 1.0)
+                    z_score = (count - baseline[0]) / std
+                    if abs(z_score) >= self.z_threshold:
+                        anomalies.append({
+                            'type': 'activity_spike' if z_score > 0 else 'activity_drop',
+                            'timestamp': UNIX_EPOCH + timedelta(seconds=bucket),
+                            'event_type': key[0],
+                            'platform': key[1],
+                            'event_count': count,
+                            'expected': baseline[0],
+                            'threshold': baseline[0] + self.z_threshold * std,
+                            'z_score': z_score,
+                            'severity': 'high' if z_score > 0 else 'medium'
+                        })
+                
+                self._ewma_update(ewma, count)
+                self._ewma_update(seasonal, count)
+    
+    def _ewma_update(self, state: list, value: float):
+        if state[2] == 0:
+            state[0], state[1] = float(value), 0.0
+        else:
+            delta = value - state[0]
+            state[0] += self.alpha * delta
+            state[1] = (1 - self.alpha) * (state[1] + self.alpha * delta * delta)
+        state[2] += 1
+    
+    def _close_user_windows(self, anomalies: List[Dict[str, Any]]):
+        for window in sorted(w for w in self._user_windows if w + self.user_window_seconds <= self.watermark):
+            for user_id, (count, event_types) in self._user_windows.pop(window).items():
+                if count > self.erratic_min_events and len(event_types) < self.erratic_max_event_types:
+                    anomalies.append({
+                        'type': 'erratic_behavior',
+                        'user_id': user_id,
+                        'window_start': UNIX_EPOCH + timedelta(seconds=window),
+                        'event_count': count,
+                        'unique_event_types': len(event_types),
+                        'severity': 'low'
+                    })
+    
+    def snapshot(self) -> bytes:
+        return msgpack.packb({
+            'buckets': [[bucket, [[*key, count] for key, count in counts.items()]]
+                        for bucket, counts in self._buckets.items()],
+            'ewma': [[*key, state] for key, state in self._ewma.items()],
+            'seasonal': [[*key, slots] for key, slots in self._seasonal.items()],
+            'user_windows': [[window, [[user_id, count, list(types)] for user_id, (count, types) in users.items()]]
+                             for window, users in self._user_windows.items()],
+            'watermark': self.watermark,
+            'late_events': self.late_events
+        })
+    
+    def restore(self, data: bytes):
+        state = msgpack.unpackb(data)
+        self._buckets = {
+            bucket: {(event_type, platform): count for event_type, platform, count in counts}
+            for bucket, counts in state['buckets']
+        }
+        self._ewma = {(event_type, platform): ewma for event_type, platform, ewma in state['ewma']}
+        self._seasonal = {(event_type, platform): slots for event_type, platform, slots in state['seasonal']}
+        self._user_windows = {
+            window: {user_id: [count, set(types)] for user_id, count, types in users}
+            for window, users in state['user_windows']
+        }
+        self.watermark = state['watermark']
+        self.late_events = state['late_events']
+
+class RetentionEngine:
+    """
+    Retención por cohortes con bitmaps Roaring de IDs de usuario. Cada user_id recibe un
+    entero denso en su primera aparición (mapa en memoria y log append-only `users.log`);
+    su cohorte es el día y la semana (desde el lunes) de esa primera aparición. Por periodo
+    se guarda el bitmap de la cohorte y el de usuarios activos, así que una matriz de
+    retención son intersecciones de bitmaps. Los bitmaps modificados se escriben en `path`
+    en cada snapshot (checkpoint) y restore() vuelve a ese estado; sin `path` solo viven
+    en memoria. Se conservan max_weeks semanas.
+    """
+    
+    PERIODS = ('day', 'week')
+    
+    def __init__(self, path: Optional[str] = None, max_weeks: int = 52):
+        self.path = path
+        self.max_weeks = max_weeks
+        
+        self._ids: Dict[str, int] = {}
+        self._pending_users: List[str] = []
+        # ('cohort' | 'active', 'day' | 'week', índice del periodo) -> BitMap
+        self._bitmaps: Dict[Tuple[str, str, int], BitMap] = {}
+        self._dirty: Set[Tuple[str, str, int]] = set()
+        self._removed: Set[Tuple[str, str, int]] = set()
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def _week(day: int) -> int:
+        # El día 0 (1970-01-01) es jueves: semanas de lunes a domingo
+        return (day + 3) // 7
+    
+    @staticmethod
+    def _period_start(period: str, index: int) -> str:
+        days = index if period == 'day' else index * 7 - 3
+        return (UNIX_EPOCH + timedelta(days=days)).date().isoformat()
+    
+    @property
+    def users(self) -> int:
+        return len(self._ids)
+    
+    def update(self, df: pl.DataFrame):
+        """Registrar la actividad de un batch (usuarios nuevos → cohorte de su primer día)"""
+        if df.height == 0:
+            return
+        
+        activity = df.select(
+            'user_id', pl.col('timestamp').dt.epoch('d').alias('day')
+        ).drop_nulls().unique()
+        first_days = activity.group_by('user_id').agg(pl.col('day').min())
+        
+        with self._lock:
+            ids = self._ids
+            uids, new_users = [], []
+            for user_id, day in first_days.iter_rows():
+                uid = ids.get(user_id)
+                if uid is None:
+                    uid = ids[user_id] = len(ids)
+                    self._pending_users.append(user_id)
+                    new_users.append((uid, day))
+                uids.append(uid)
+            
+            activity = activity.join(
+                pl.DataFrame({'user_id': first_days['user_id'], 'uid': pl.Series(uids, dtype=pl.UInt32)}),
+                on='user_id'
+            ).with_columns(((pl.col('day') + 3) // 7).alias('week'))
+            
+            for day, day_uids in activity.group_by('day').agg('uid').iter_rows():
+                self._add(('active', 'day', day), day_uids)
+            for week, week_uids in activity.group_by('week').agg(pl.col('uid').unique()).iter_rows():
+                self._add(('active', 'week', week), week_uids)
+            for uid, day in new_users:
+                self._add(('cohort', 'day', day), [uid])
+                self._add(('cohort', 'week', self._week(day)), [uid])
+            
+            self._expire(activity['week'].max())
+    
+    def _add(self, key: Tuple[str, str, int], uids: List[int]):
+        bitmap = self._bitmaps.get(key)
+        if bitmap is None:
+            bitmap = self._bitmaps[key] = BitMap()
+        bitmap.update(uids)
+        self._dirty.add(key)
+    
+    def _expire(self, newest_week: int):
+        oldest_week = newest_week - self.max_weeks + 1
+        for key in [key for key in self._bitmaps if
+                    (key[2] if key[1] == 'week' else self._week(key[2])) < oldest_week]:
+            del self._bitmaps[key]
+            self._dirty.discard(key)
+            self._removed.add(key)
+    
+    def matrix(self, period: str = 'week', periods: int = 12, cohorts: int = 12) -> Dict[str, Any]:
+        """
+        Matriz de retención de las últimas `cohorts` cohortes: porcentaje de cada cohorte
+        activo en los periodos 0..periods posteriores (hasta el último periodo con datos)
+        """
+        if period not in self.PERIODS:
+            raise ValueError(f"Periodo no soportado: {period}")
+        
+        with self._lock:
+            bitmaps = self._bitmaps
+            latest = max((key[2] for key in bitmaps if key[:2] == ('active', period)), default=None)
+            starts = sorted(key[2] for key in bitmaps if key[:2] == ('cohort', period))[-cohorts:]
+            
+            rows = []
+            for start in starts:
+                cohort = bitmaps[('cohort', period, start)]
+                retention = []
+                for offset in range(min(periods, latest - start) + 1):
+                    active = bitmaps.get(('active', period, start + offset))
+                    retention.append(
+                        cohort.intersection_cardinality(active) / len(cohort) * 100 if active else 0.0
+                    )
+                rows.append({
+                    'cohort': self._period_start(period, start),
+                    'users': len(cohort),
+                    'retention': retention
+                })
+        
+        return {'period': period, 'cohorts': rows}
+    
+    def _file(self, key: Tuple[str, str, int]) -> str:
+        return os.path.join(self.path, f"{key[0]}-{key[1]}-{key[2]}.roaring")
+    
+    def snapshot(self) -> bytes:
+        """Escribir los bitmaps modificados y los usuarios nuevos; devuelve el índice de ficheros"""
+        with self._lock:
+            users_log_bytes = 0
+            if self.path:
+                os.makedirs(self.path, exist_ok=True)
+                users_log = os.path.join(self.path, 'users.log')
+                with open(users_log, 'ab') as f:
+                    for user_id in self._pending_users:
+                        f.write(msgpack.packb(user_id))
+                    f.flush()
+                    os.fsync(f.fileno())
+                    users_log_bytes = f.tell()
+                self._pending_users = []
+                
+                for key in self._dirty:
+                    tmp_path = f"{self._file(key)}.tmp"
+                    with open(tmp_path, 'wb') as f:
+                        f.write(self._bitmaps[key].serialize())
+                    os.replace(tmp_path, self._file(key))
+                for key in self._removed:
+                    if os.path.exists(self._file(key)):
+                        os.remove(self._file(key))
+                self._dirty.clear()
+                self._removed.clear()
+            
+            return msgpack.packb({
+                'users': len(self._ids),
+                'users_log_bytes': users_log_bytes,
+                'bitmaps': [list(key) for key in self._bitmaps]
+            })
+    
+    def restore(self, data: bytes):
+        """Volver a los ficheros del snapshot (sin `path` el estado en memoria se conserva)"""
+        if not self.path:
+            return
+        
+        state = msgpack.unpackb(data)
+        with self._lock:
+            users_log = os.path.join(self.path, 'users.log')
+            self._ids = {}
+            if os.path.exists(users_log):
+                # Lo escrito después del snapshot (p. ej. un checkpoint a medias) se descarta
+                os.truncate(users_log, state['users_log_bytes'])
+                with open(users_log, 'rb') as f:
+                    self._ids = {user_id: uid for uid, user_id in enumerate(msgpack.Unpacker(f, raw=False))}
+            
+            self._bitmaps = {}
+            for key in map(tuple, state['bitmaps']):
+                if os.path.exists(self._file(key)):
+                    with open(self._file(key), 'rb') as f:
+                        bitmap = BitMap.deserialize(f.read())
+                    # IDs asignados después del snapshot
+                    bitmap.remove_range(len(self._ids), 2 ** 32)
+                    self._bitmaps[key] = bitmap
+            
+            self._pending_users = []
+            self._dirty.clear()
+            self._removed.clear()
+
+def stable_hash64(values) -> np.ndarray:
+    """
+    Hash de 64 bits estable entre procesos y versiones (a diferencia de Series.hash de
+    Polars): FNV-1a con la mezcla final de MurmurHash3, vectorizado por posición de byte
+    sobre los buffers Arrow de los strings (sin nulos)
+    """
+    array = values.to_arrow() if isinstance(values, pl.Series) else pa.array(values, type=pa.large_string())
+    array = array.cast(pa.large_string())
+    _, offsets, data = array.buffers()
+    offsets = np.frombuffer(offsets, dtype=np.int64)[array.offset:array.offset + len(array) + 1]
+    data = np.frombuffer(data, dtype=np.uint8) if data is not None else np.empty(0, dtype=np.uint8)
+    starts, lengths = offsets[:-1], np.diff(offsets)
+    
+    hashes = np.full(len(array), 0xCBF29CE484222325, dtype=np.uint64)
+    active = np.arange(len(array))
+    position = 0
+    while True:
+        active = active[lengths[active] > position]
+        if len(active) == 0:
+            break
+        hashes[active] = (hashes[active] ^ data[starts[active] + position]) * np.uint64(0x100000001B3)
+        position += 1
+    
+    for shift, multiplier in ((33, 0xFF51AFD7ED558CCD), (33, 0xC4CEB9FE1A85EC53), (33, None)):
+        hashes ^= hashes >> np.uint64(shift)
+        if multiplier:
+            hashes *= np.uint64(multiplier)
+    return hashes
+
+class HyperLogLog:
+    """
+    Contador de distintos HyperLogLog: 2^precision registros de un byte (16 KB y ~0.8% de
+    error típico con precision=14) alimentados con hashes de 64 bits. merge() toma el
+    máximo por registro, así que combinar contadores de partes disjuntas o solapadas da
+    exactamente el contador de la unión.
+    """
+    
+    def __init__(self, precision: int = 14, registers: Optional[np.ndarray] = None):
+        self.precision = precision
+        self.registers = registers if registers is not None else np.zeros(1 << precision, dtype=np.uint8)
+    
+    def add_hashes(self, hashes: np.ndarray):
+        if len(hashes) == 0:
+            return
+        
+        index = (hashes & np.uint64((1 << self.precision) - 1)).astype(np.intp)
+        rest = hashes >> np.uint64(self.precision)
+        # Rango = ceros finales de los 64 - precision bits restantes + 1
+        lowest_bit = rest & (~rest + np.uint64(1))
+        with np.errstate(divide='ignore'):
+            rank = np.where(rest == 0, 64 - self.precision + 1, np.log2(lowest_bit.astype(np.float64)) + 1)
+        np.maximum.at(self.registers, index, rank.astype(np.uint8))
+    
+    def merge(self, other: 'HyperLogLog'):
+        if other.precision != self.precision:
+            raise ValueError(f"Precisión distinta: {self.precision} != {other.precision}")
+        np.maximum(self.registers, other.registers, out=self.registers)
+    
+    def count(self) -> int:
+        m = len(self.registers)
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / np.ldexp(1.0, -self.registers.astype(np.int64)).sum()
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * m and zeros:
+            # Linear counting para cardinalidades pequeñas
+            estimate = m * np.log(m / zeros)
+        return int(round(estimate))
+
+class HeavyHitters:
+    """
+    Top-k aproximado con Count-Min: depth x width contadores estiman la frecuencia de
+    cualquier valor (solo por exceso) y se guardan los `capacity` valores con mayor
+    estimación vista. merge() suma los contadores, que es exacto, y reevalúa los
+    candidatos de ambos lados sobre el sketch combinado.
+    """
+    
+    def __init__(self, capacity: int = 100, width: int = 2048, depth: int = 4,
+                 counts: Optional[np.ndarray] = None, candidates: Optional[Dict[str, int]] = None):
+        self.capacity = capacity
+        self.counts = counts if counts is not None else np.zeros((depth, width), dtype=np.uint32)
+        self.candidates: Dict[str, int] = candidates or {}
+    
+    def _columns(self, hashes: np.ndarray) -> np.ndarray:
+        # Doble hashing: una columna por fila a partir de las dos mitades del hash
+        depth, width = self.counts.shape
+        low, high = hashes & np.uint64(0xFFFFFFFF), hashes >> np.uint64(32)
+        return np.stack([(low + np.uint64(row) * high) % np.uint64(width) for row in range(depth)]).astype(np.intp)
+    
+    def _estimate(self, columns: np.ndarray) -> np.ndarray:
+        return self.counts[np.arange(self.counts.shape[0])[:, None], columns].min(axis=0)
+    
+    def add(self, values: List[str], counts: np.ndarray, hashes: Optional[np.ndarray] = None):
+        """Sumar `counts` ocurrencias de cada valor (valores únicos dentro de la llamada)"""
+        if len(values) == 0:
+            return
+        
+        columns = self._columns(stable_hash64(values) if hashes is None else hashes)
+        for row in range(self.counts.shape[0]):
+            np.add.at(self.counts[row], columns[row], np.asarray(counts, dtype=np.uint32))
+        
+        # Con el conjunto lleno solo entran (o se actualizan) los que superan al último
+        estimates = self._estimate(columns)
+        if len(self.candidates) >= self.capacity:
+            threshold = min(self.candidates.values())
+            selected = np.flatnonzero(estimates > threshold)
+            values, estimates = [values[i] for i in selected], estimates[selected]
+        
+        self.candidates.update(zip(values, estimates.tolist()))
+        self._prune()
+    
+    def _prune(self):
+        if len(self.candidates) > self.capacity:
+            self.candidates = dict(heapq.nlargest(self.capacity, self.candidates.items(), key=lambda item: item[1]))
+    
+    def merge(self, other: 'HeavyHitters'):
+        if other.counts.shape != self.counts.shape:
+            raise ValueError(f"Dimensiones distintas: {self.counts.shape} != {other.counts.shape}")
+        
+        self.counts += other.counts
+        values = list(self.candidates.keys() | other.candidates.keys())
+        if values:
+            self.candidates = dict(zip(values, self._estimate(self._columns(stable_hash64(values))).tolist()))
+            self._prune()
+    
+    def top(self, k: int) -> List[Tuple[str, int]]:
+        return heapq.nlargest(k, self.candidates.items(), key=lambda item: item[1])
+
+class SketchBucket:
+    """
+    Métricas de dashboard de un periodo: total de eventos, usuarios y sesiones distintos
+    (HyperLogLog) y top de event_name y de usuarios (HeavyHitters). Dos buckets del mismo
+    periodo se combinan con merge() y se serializan comprimidos para Redis.
+    """
+    
+    def __init__(self, precision: int = 14, capacity: int = 100, width: int = 2048, depth: int = 4):
+        self.events = 0
+        self.users = HyperLogLog(precision)
+        self.sessions = HyperLogLog(precision)
+        self.event_names = HeavyHitters(capacity, width, depth)
+        self.top_users = HeavyHitters(capacity, width, depth)
+    
+    def merge(self, other: 'SketchBucket'):
+        self.events += other.events
+        self.users.merge(other.users)
+        self.sessions.merge(other.sessions)
+        self.event_names.merge(other.event_names)
+        self.top_users.merge(other.top_users)
+    
+    def summary(self, k: int = 10) -> Dict[str, Any]:
+        return {
+            'total_events': self.events,
+            'unique_users': self.users.count(),
+            'unique_sessions': self.sessions.count(),
+            'top_event_names': [{'event_name': name, 'count': count} for name, count in self.event_names.top(k)],
+            'top_users': [{'user_id': user_id, 'count': count} for user_id, count in self.top_users.top(k)]
+        }
+    
+    def to_bytes(self) -> bytes:
+        def heavy_hitters(sketch: HeavyHitters) -> list:
+            return [sketch.capacity, list(sketch.counts.shape), sketch.counts.tobytes(), sketch.candidates]
+        
+        return zstd.ZstdCompressor().compress(msgpack.packb([
+            self.events,
+            self.users.precision, self.users.registers.tobytes(), self.sessions.registers.tobytes(),
+            heavy_hitters(self.event_names), heavy_hitters(self.top_users)
+        ]))
+    
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'SketchBucket':
+        events, precision, users, sessions, event_names, top_users = msgpack.unpackb(
+            zstd.ZstdDecompressor().decompress(data)
+        )
+        
+        def heavy_hitters(state: list) -> HeavyHitters:
+            capacity, shape, counts, candidates = state
+            return HeavyHitters(capacity, counts=np.frombuffer(counts, dtype=np.uint32).reshape(shape).copy(),
+                                candidates=candidates)
+        
+        bucket = cls.__new__(cls)
+        bucket.events = events
+        bucket.users = HyperLogLog(precision, np.frombuffer(users, dtype=np.uint8).copy())
+        bucket.sessions = HyperLogLog(precision, np.frombuffer(sessions, dtype=np.uint8).copy())
+        bucket.event_names = heavy_hitters(event_names)
+        bucket.top_users = heavy_hitters(top_users)
+        return bucket
+
+class QuantileSketch:
+    """
+    Sketch de cuantiles DDSketch: cada valor positivo cae en el bin logarítmico
+    ceil(log_γ(x)) con γ = (1 + α) / (1 − α), así que cualquier cuantil se devuelve con
+    error relativo ≤ α (1% por defecto). merge() suma los bins: el resultado es idéntico
+    al sketch de la unión de los valores. Por encima de max_bins se pliegan los bins más
+    bajos (solo pierden precisión los cuantiles más pequeños).
+    """
+    
+    # Valores por debajo (incluidos 0 y negativos por desfase de relojes) van al bin cero
+    MIN_VALUE = 1e-9
+    
+    def __init__(self, relative_accuracy: float = 0.01, max_bins: int = 2048):
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = np.log(self.gamma)
+        
+        self.bins: Dict[int, int] = {}
+        self.zero_count = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min = float('inf')
+        self.max = float('-inf')
+    
+    def add(self, values: np.ndarray):
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return
+        
+        positive = values[values > self.MIN_VALUE]
+        self.zero_count += len(values) - len(positive)
+        if len(positive):
+            indexes, counts = np.unique(np.ceil(np.log(positive) / self._log_gamma).astype(np.int64),
+                                        return_counts=True)
+            bins = self.bins
+            for index, count in zip(indexes.tolist(), counts.tolist()):
+                bins[index] = bins.get(index, 0) + count
+            self._collapse()
+        
+        self.count += len(values)
+        self.sum += float(values.sum())
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+    
+    def _collapse(self):
+        overflow = len(self.bins) - self.max_bins
+        if overflow <= 0:
+            return
+        
+        indexes = sorted(self.bins)
+        self.bins[indexes[overflow]] += sum(self.bins.pop(index) for index in indexes[:overflow])
+    
+    def merge(self, other: 'QuantileSketch'):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError(f"Precisión distinta: {self.relative_accuracy} != {other.relative_accuracy}")
+        
+        for index, count in other.bins.items():
+            self.bins[index] = self.bins.get(index, 0) + count
+        self._collapse()
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+    
+    def quantile(self, q: float) -> Optional[float]:
+        if not self.count:
+            return None
+        
+        rank = q * (self.count - 1)
+        if rank < self.zero_count:
+            return max(self.min, 0.0)
+        
+        cumulative = self.zero_count
+        for index in sorted(self.bins):
+            cumulative += self.bins[index]
+            if cumulative > rank:
+                # Punto medio del bin en escala relativa, acotado al rango observado
+                return min(max(2 * self.gamma ** index / (self.gamma + 1), self.min), self.max)
+        return self.max
+    
+    def to_state(self) -> list:
+        return [self.relative_accuracy, self.max_bins, self.zero_count, self.count, self.sum,
+                self.min, self.max, list(self.bins), list(self.bins.values())]
+    
+    @classmethod
+    def from_state(cls, state: list) -> 'QuantileSketch':
+        relative_accuracy, max_bins, zero_count, count, total, minimum, maximum, indexes, counts = state
+        sketch = cls(relative_accuracy, max_bins)
+        sketch.bins = dict(zip(indexes, counts))
+        sketch.zero_count, sketch.count, sketch.sum = zero_count, count, total
+        sketch.min, sketch.max = minimum, maximum
+        return sketch
+
+class QuantileBucket:
+    """QuantileSketches de un periodo por (métrica, plataforma), combinables con merge()"""
+    
+    QUANTILES = (0.5, 0.9, 0.99)
+    
+    def __init__(self, relative_accuracy: float = 0.01, max_bins: int = 2048):
+        self.params = (relative_accuracy, max_bins)
+        self.sketches: Dict[Tuple[str, str], QuantileSketch] = {}
+    
+    def sketch(self, metric: str, platform: str) -> QuantileSketch:
+        sketch = self.sketches.get((metric, platform))
+        if sketch is None:
+            sketch = self.sketches[(metric, platform)] = QuantileSketch(*self.params)
+        return sketch
+    
+    def merge(self, other: 'QuantileBucket'):
+        for (metric, platform), sketch in other.sketches.items():
+            self.sketch(metric, platform).merge(sketch)
+    
+    def summary(self) -> Dict[str, Dict[str, Dict[str, Any]]]:
+        """{métrica: {plataforma: {count, avg, p50, p90, p99}}}, con `all` combinando plataformas"""
+        by_metric: Dict[str, Dict[str, QuantileSketch]] = {}
+        for (metric, platform), sketch in self.sketches.items():
+            by_metric.setdefault(metric, {})[platform] = sketch
+        
+        summary = {}
+        for metric, platforms in sorted(by_metric.items()):
+            if 'all' not in platforms:
+                combined = QuantileSketch(*self.params)
+                for _, sketch in sorted(platforms.items()):
+                    combined.merge(sketch)
+                platforms = {**platforms, 'all': combined}
+            summary[metric] = {
+                platform: {
+                    'count': sketch.count,
+                    'avg': sketch.sum / sketch.count if sketch.count else None,
+                    **{f"p{round(q * 100)}": sketch.quantile(q) for q in self.QUANTILES}
+                }
+                for platform, sketch in sorted(platforms.items())
+            }
+        return summary
+    
+    def to_bytes(self) -> bytes:
+        return zstd.ZstdCompressor().compress(msgpack.packb([
+            list(self.params),
+            [[metric, platform, sketch.to_state()] for (metric, platform), sketch in self.sketches.items()]
+        ]))
+    
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'QuantileBucket':
+        params, sketches = msgpack.unpackb(zstd.ZstdDecompressor().decompress(data))
+        bucket = cls(*params)
+        bucket.sketches = {
+            (metric, platform): QuantileSketch.from_state(state) for metric, platform, state in sketches
+        }
+        return bucket
+
+class PeriodSketches(ABC):
+    """
+    Buckets de sketches combinables por hora y por día, con retención acotada. Cada
+    worker publica sus buckets como parciales (un campo por worker) y los lectores
+    combinan los de todos: el día no es una suma de horas sino la unión de los sketches.
+    `worker_id` viaja en el snapshot para que un worker restaurado siga escribiendo su
+    propio parcial en lugar de duplicarlo.
+    """
+    
+    PERIOD_SECONDS = {'hour': 3600, 'day': 86400}
+    bucket_type: Any = None
+    
+    def __init__(self, retention_hours: int = 48, retention_days: int = 8, worker_id: Optional[str] = None):
+        self.retention = {'hour': retention_hours, 'day': retention_days}
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        
+        # ('hour' | 'day', índice desde epoch) -> bucket
+        self._buckets: Dict[Tuple[str, int], Any] = {}
+        self._dirty: Set[Tuple[str, int]] = set()
+        # El stream actualiza desde el pool de CPU y la publicación corre en otro hilo
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def label(period: str, index: int) -> str:
+        """Sufijo de las claves de Redis: YYYY-MM-DDTHH por hora, YYYY-MM-DD por día"""
+        start = UNIX_EPOCH + timedelta(seconds=index * PeriodSketches.PERIOD_SECONDS[period])
+        return start.strftime('%Y-%m-%dT%H' if period == 'hour' else '%Y-%m-%d')
+    
+    @classmethod
+    def merge_payloads(cls, payloads: List[bytes]) -> Optional[Any]:
+        """Combinar parciales serializados del mismo periodo (None si no hay ninguno)"""
+        merged = None
+        for payload in payloads:
+            bucket = cls.bucket_type.from_bytes(payload)
+            if merged is None:
+                merged = bucket
+            else:
+                merged.merge(bucket)
+        return merged
+    
+    @abstractmethod
+    def _new_bucket(self) -> Any:
+        """Bucket vacío del tipo bucket_type"""
+    
+    def _bucket(self, key: Tuple[str, int]) -> Any:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = self._new_bucket()
+        self._dirty.add(key)
+        return bucket
+    
+    def _expire(self):
+        for period, keep in self.retention.items():
+            newest = max((index for p, index in self._buckets if p == period), default=None)
+            if newest is None:
+                continue
+            for key in [key for key in self._buckets if key[0] == period and key[1] <= newest - keep]:
+                del self._buckets[key]
+                self._dirty.discard(key)
+    
+    def take_dirty(self) -> Dict[Tuple[str, int], bytes]:
+        """Buckets modificados desde la última publicación, serializados"""
+        with self._lock:
+            dirty = {key: self._buckets[key].to_bytes() for key in self._dirty}
+            self._dirty.clear()
+        return dirty
+    
+    def mark_dirty(self, keys):
+        with self._lock:
+            self._dirty.update(key for key in keys if key in self._buckets)
+    
+    def ttl(self, period: str) -> int:
+        """Segundos que se conservan los parciales de un periodo en Redis"""
+        return self.retention[period] * self.PERIOD_SECONDS[period]
+    
+    def summary(self, period: str, index: int, *args) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            bucket = self._buckets.get((period, index))
+            return bucket.summary(*args) if bucket else None
+    
+    def snapshot(self) -> bytes:
+        with self._lock:
+            return msgpack.packb({
+                'worker_id': self.worker_id,
+                'buckets': [[period, index, bucket.to_bytes()] for (period, index), bucket in self._buckets.items()]
+            })
+    
+    def restore(self, data: bytes):
+        state = msgpack.unpackb(data)
+        with self._lock:
+            self.worker_id = state['worker_id']
+            self._buckets = {
+                (period, index): self.bucket_type.from_bytes(payload) for period, index, payload in state['buckets']
+            }
+            # Los parciales en Redis pueden ir por delante del snapshot: se reescriben
+            self._dirty = set(self._buckets)
+
+class DashboardSketches(PeriodSketches):
+    """SketchBuckets por hora y por día de event time, mantenidos desde el stream con memoria fija por bucket"""
+    
+    bucket_type = SketchBucket
+    
+    def __init__(self, precision: int = 14, capacity: int = 100, width: int = 2048, depth: int = 4,
+                 retention_hours: int = 48, retention_days: int = 8, worker_id: Optional[str] = None):
+        super().__init__(retention_hours, retention_days, worker_id)
+        self.params = (precision, capacity, width, depth)
+    
+    def _new_bucket(self) -> SketchBucket:
+        return SketchBucket(*self.params)
+    
+    def update(self, df: pl.DataFrame):
+        if df.height == 0:
+            return
+        
+        frame = df.select(
+            'user_id', 'session_id', pl.col('event_name').fill_null('unknown'),
+            (pl.col('timestamp').dt.epoch('s') // 3600).alias('hour')
+        ).drop_nulls()
+        
+        # Un hash por valor único del batch, compartido entre horas y días
+        hashes = {}
+        for column in ('user_id', 'session_id'):
+            values = frame[column].unique()
+            hashes[column] = pl.DataFrame({column: values, f"{column}_hash": stable_hash64(values)})
+            frame = frame.join(hashes[column], on=column, how='left')
+        
+        with self._lock:
+            for (hour,), part in frame.partition_by('hour', as_dict=True).items():
+                user_hashes = part['user_id_hash'].unique().to_numpy()
+                session_hashes = part['session_id_hash'].unique().to_numpy()
+                names = part.group_by('event_name').agg(pl.len())
+                users = part.group_by('user_id', 'user_id_hash').agg(pl.len())
+                
+                for key in (('hour', hour), ('day', hour // 24)):
+                    bucket = self._bucket(key)
+                    bucket.events += part.height
+                    bucket.users.add_hashes(user_hashes)
+                    bucket.sessions.add_hashes(session_hashes)
+                    bucket.event_names.add(names['event_name'].to_list(), names['len'].to_numpy())
+                    bucket.top_users.add(users['user_id'].to_list(), users['len'].to_numpy(),
+                                         users['user_id_hash'].to_numpy())
+            
+            self._expire()
+
+class QuantileSketches(PeriodSketches):
+    """
+    QuantileBuckets por hora y por día: duración de sesión e intervalo entre eventos por
+    plataforma (event time) y latencia por etapa del pipeline (wall clock, plataforma `all`)
+    """
+    
+    bucket_type = QuantileBucket
+    
+    def __init__(self, relative_accuracy: float = 0.01, max_bins: int = 2048,
+                 retention_hours: int = 48, retention_days: int = 8, worker_id: Optional[str] = None):
+        super().__init__(retention_hours, retention_days, worker_id)
+        self.params = (relative_accuracy, max_bins)
+    
+    def _new_bucket(self) -> QuantileBucket:
+        return QuantileBucket(*self.params)
+    
+    def _add(self, metric: str, hour: int, platform: str, values: np.ndarray):
+        for key in (('hour', hour), ('day', hour // 24)):
+            self._bucket(key).sketch(metric, platform).add(values)
+    
+    def update(self, metric: str, frame: pl.DataFrame):
+        """Añadir valores de un frame con columnas ts (epoch s), platform y value"""
+        if frame.height == 0:
+            return
+        
+        frame = frame.select(
+            (pl.col('ts') // 3600).cast(pl.Int64).alias('hour'),
+            pl.col('platform').fill_null('unknown'),
+            pl.col('value').cast(pl.Float64)
+        ).drop_nulls()
+        
+        with self._lock:
+            for (hour, platform), part in frame.partition_by('hour', 'platform', as_dict=True).items():
+                self._add(metric, hour, platform, part['value'].to_numpy())
+            self._expire()
+    
+    def observe(self, metric: str, seconds: float):
+        """Una medida de latencia en la hora actual"""
+        hour = int((datetime.now() - UNIX_EPOCH).total_seconds()) // 3600
+        with self._lock:
+            self._add(metric, hour, 'all', np.array([seconds]))
+            self._expire()
+
+class SinkQueue:
+    """
+    Cola acotada y pool de workers para un sink. Los workers agrupan los chunks
+    encolados en escrituras de hasta coalesce_rows filas y reintentan con backoff
+    exponencial. submit() devuelve un future que se resuelve cuando la escritura que
+    contiene el chunk termina (ack para el checkpoint). Con la cola llena, la política
+    decide: block (backpressure), drop (el future falla) o spill (Arrow IPC en disco,
+    se reencola cuando hay hueco).
+    """
+    
+    POLICIES = ('block', 'drop', 'spill')
+    
+    def __init__(self, name: str, write: Callable[[pl.DataFrame], Awaitable[Any]],
+                 workers: int = 1, max_queue: int = 32, policy: str = 'block',
+                 coalesce_rows: int = 100_000, max_retries: int = 3,
+                 backoff_seconds: float = 0.5, spill_dir: Optional[str] = None,
+                 on_flush: Optional[Callable[[str, float], None]] = None):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Política de sink no soportada: {policy}")
+        
+        self.name = name
+        self.write = write
+        self.workers = workers
+        self.max_queue = max_queue
+        self.policy = policy
+        self.coalesce_rows = coalesce_rows
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.spill_dir = spill_dir
+        self.on_flush = on_flush
+        self.logger = logging.getLogger("UserJourneyPipeline30X")
+        
+        self._queue: Optional[asyncio.Queue] = None
+        self._spilled: List[Tuple[str, asyncio.Future]] = []
+        self._tasks: List[asyncio.Task] = []
+        self._writing = 0
+    
+    def _ensure_started(self):
+        if self._tasks:
+            return
+        
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+    
+    async def submit(self, frame: pl.DataFrame) -> asyncio.Future:
+        """Encolar un chunk; el future se resuelve cuando está escrito en el sink"""
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        
+        if not self._queue.full():
+            self._queue.put_nowait((frame, future))
+        elif self.policy == 'drop':
+            SINK_DROPPED_CHUNKS.labels(sink=self.name).inc()
+            future.set_exception(RuntimeError(f"Cola de {self.name} llena: chunk descartado"))
+        elif self.policy == 'spill':
+            self._spill(frame, future)
+        else:
+            await self._queue.put((frame, future))
+        
+        self._report_depth()
+        return future
+    
+    async def stop(self):
+        """Esperar a que se escriba todo lo encolado y parar los workers"""
+        if not self._tasks:
+            return
+        
+        while self._spilled or not self._queue.empty() or self._writing:
+            await asyncio.sleep(0.05)
+        
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+    
+    def clear(self):
+        """Descartar chunks encolados o en disco (se reentregarán desde el último checkpoint)"""
+        while self._queue and not self._queue.empty():
+            _, future = self._queue.get_nowait()
+            future.cancel()
+            self._queue.task_done()
+        
+        for path, future in self._spilled:
+            future.cancel()
+            os.remove(path)
+        self._spilled = []
+        self._report_depth()
+    
+    def _spill(self, frame: pl.DataFrame, future: asyncio.Future):
+        os.makedirs(self.spill_dir, exist_ok=True)
+        path = os.path.join(self.spill_dir, f"{self.name}-{uuid.uuid4().hex}.arrow")
+        frame.write_ipc(path, compression='lz4')
+        self._spilled.append((path, future))
+        SINK_SPILLED_CHUNKS.labels(sink=self.name).inc()
+    
+    def _report_depth(self):
+        depth = (self._queue.qsize() if self._queue else 0) + len(self._spilled)
+        SINK_QUEUE_DEPTH.labels(sink=self.name).set(depth)
+    
+    async def _next(self) -> Tuple[pl.DataFrame, asyncio.Future, bool]:
+        # Lo que está en disco vuelve en cuanto la cola se vacía
+        if self._spilled and self._queue.empty():
+            path, future = self._spilled.pop(0)
+            try:
+                frame = pl.read_ipc(path)
+            except Exception as e:
+                future.set_exception(e)
+                raise
+            finally:
+                os.remove(path)
+            return frame, future, False
+        
+        frame, future = await self._queue.get()
+        return frame, future, True
+    
+    async def _worker(self):
+        while True:
+            try:
+                frame, future, queued = await self._next()
+            except Exception as e:
+                self.logger.error(f"Error leyendo chunk en disco de {self.name}: {str(e)}")
+                continue
+            
+            items = [(frame, future, queued)]
+            rows = frame.height
+            
+            # Agrupar lo ya encolado en una sola escritura
+            while rows < self.coalesce_rows and not self._queue.empty():
+                frame, future = self._queue.get_nowait()
+                items.append((frame, future, True))
+                rows += frame.height
+            
+            self._writing += 1
+            try:
+                live = [item for item in items if not item[1].done()]
+                if live:
+                    frame = live[0][0] if len(live) == 1 else \
+                        pl.concat([item[0] for item in live], how='diagonal_relaxed')
+                    await self._write_with_retry(frame, [item[1] for item in live])
+            finally:
+                self._writing -= 1
+                for _, _, queued in items:
+                    if queued:
+                        self._queue.task_done()
+                self._report_depth()
+    
+    async def _write_with_retry(self, frame: pl.DataFrame, futures: List[asyncio.Future]):
+        error = None
+        for attempt in range(self.max_retries + 1):
+            started_at = time.monotonic()
+            try:
+                await self.write(frame)
+                elapsed = time.monotonic() - started_at
+                SINK_FLUSH_LATENCY.labels(sink=self.name).observe(elapsed)
+                if self.on_flush:
+                    self.on_flush(self.name, elapsed)
+                error = None
+                break
+            except Exception as e:
+                error = e
+                if attempt < self.max_retries:
+                    delay = min(self.backoff_seconds * 2 ** attempt, 30)
+                    self.logger.warning(f"Reintentando {self.name} en {delay:.1f}s: {str(e)}")
+                    await asyncio.sleep(delay)
+        
+        for future in futures:
+            if future.done():
+                continue
+            if error:
+                future.set_exception(error)
+            else:
+                future.set_result(frame.height)
+
+class CheckpointError(Exception):
+    """Un batch no fue confirmado por todos los sinks requeridos"""
+
+class CheckpointCoordinator:
+    """
+    Checkpoints consistentes entre sinks, estado de operadores y posiciones de la fuente.
+    Cada batch cuenta los acks por sink de sus partes (chunks), que llegan de forma
+    asíncrona desde las colas de los sinks. checkpoint() espera a que todos los batches
+    sellados estén confirmados por los sinks requeridos, ejecuta los hooks previos (p. ej.
+    flush del lake), guarda el snapshot de operadores junto con las posiciones en espera
+    y después hace commit en la fuente.
+    Tras un fallo, restore() devuelve los operadores al último checkpoint y la fuente
+    reentrega desde las posiciones confirmadas; position() permite descartar lo que ya
+    estaba incluido en el snapshot.
+    """
+    
+    def __init__(self, required_sinks: Set[str], snapshot_state: Callable[[], Dict[str, bytes]],
+                 restore_state: Callable[[Dict[str, bytes]], None], path: Optional[str] = None,
+                 interval_seconds: float = 60,
+                 pre_checkpoint: Optional[List[Callable[[], Any]]] = None):
+        self.required_sinks = set(required_sinks)
+        self.snapshot_state = snapshot_state
+        self.restore_state = restore_state
+        self.path = path
+        self.interval = interval_seconds
+        self.pre_checkpoint = pre_checkpoint or []
+        self.logger = logging.getLogger("UserJourneyPipeline30X")
+        
+        # batch -> [partes esperadas, acks por sink, errores por sink, escrituras, sellado]
+        self._batches: Dict[int, list] = {}
+        self._error: Optional[CheckpointError] = None
+        self._next_batch = 0
+        self._pending: List[Tuple[Dict[str, Any], Callable[[], Awaitable[Any]]]] = []
+        self._last_checkpoint_at = time.monotonic()
+        
+        self.checkpoint_id = 0
+        self.positions: Dict[str, Any] = {}
+        self.operator_state: Dict[str, bytes] = {}
+    
+    def begin(self, parts: int) -> int:
+        batch_id = self._next_batch
+        self._next_batch += 1
+        self._batches[batch_id] = [parts, {}, {}, [], False]
+        return batch_id
+    
+    def watch(self, batch_id: int, sink: str, write: asyncio.Future):
+        """Registrar la escritura pendiente de una parte del batch en un sink"""
+        self._batches[batch_id][3].append(write)
+        write.add_done_callback(lambda future: self._on_write(batch_id, sink, future))
+    
+    def _on_write(self, batch_id: int, sink: str, future: asyncio.Future):
+        if batch_id not in self._batches:
+            return  # descartado por restore()
+        
+        if future.cancelled():
+            self.fail(batch_id, sink, RuntimeError('escritura cancelada'))
+        elif future.exception():
+            self.fail(batch_id, sink, future.exception())
+        else:
+            self.ack(batch_id, sink)
+    
+    def ack(self, batch_id: int, sink: str):
+        acks = self._batches[batch_id][1]
+        acks[sink] = acks.get(sink, 0) + 1
+    
+    def fail(self, batch_id: int, sink: str, error: Exception):
+        self._batches[batch_id][2][sink] = str(error)
+        if sink in self.required_sinks:
+            self._error = self._error or CheckpointError(f"Batch {batch_id} sin confirmar: {sink}: {str(error)}")
+        else:
+            self.logger.warning(f"Sink opcional {sink} falló: {str(error)}")
+    
+    def seal(self, batch_id: int, failed_parts: int = 0):
+        """Todas las partes del batch se procesaron y se enviaron a los sinks"""
+        if failed_parts:
+            self._error = self._error or CheckpointError(
+                f"Batch {batch_id} sin confirmar: {failed_parts} partes fallaron antes de los sinks"
+            )
+        self._batches[batch_id][4] = True
+        self.raise_if_failed()
+    
+    def raise_if_failed(self):
+        if self._error:
+            raise self._error
+    
+    async def drain(self):
+        """Esperar las escrituras de los batches sellados; lanza CheckpointError si falta algún ack"""
+        writes = [write for batch in self._batches.values() if batch[4] for write in batch[3]]
+        if writes:
+            # wait() no cancela las escrituras si se cancela el checkpoint
+            await asyncio.wait(writes)
+        self.raise_if_failed()
+        
+        for batch_id in [batch_id for batch_id, batch in self._batches.items() if batch[4]]:
+            parts, acks, errors, _, _ = self._batches.pop(batch_id)
+            missing = {
+                sink: errors.get(sink, f"{acks.get(sink, 0)}/{parts} partes")
+                for sink in self.required_sinks
+                if acks.get(sink, 0) < parts
+            }
+            if missing:
+                self._error = CheckpointError(f"Batch {batch_id} sin confirmar: {missing}")
+                raise self._error
+    
+    def track(self, positions: Dict[str, Any],
+              commit: Callable[[], Awaitable[Any]]) -> Callable[[], Awaitable[Any]]:
+        """Callback de commit para la fuente: deja las posiciones a la espera del siguiente checkpoint"""
+        async def stage():
+            self._pending.append((positions, commit))
+        return stage
+    
+    def position(self, key: str, default: Any = None) -> Any:
+        """Posición de la fuente incluida en el último checkpoint"""
+        return self.positions.get(key, default)
+    
+    def idle(self) -> bool:
+        """Ningún batch a medias de procesar (las escrituras pueden seguir en curso)"""
+        return all(batch[4] for batch in self._batches.values())
+    
+    def due(self) -> bool:
+        return time.monotonic() - self._last_checkpoint_at >= self.interval
+    
+    async def checkpoint(self):
+        """
+        Llamar solo entre batches, cuando el estado de los operadores corresponde
+        exactamente a las posiciones en espera.
+        """
+        self._last_checkpoint_at = time.monotonic()
+        await self.drain()
+        pending, self._pending = self._pending, []
+        
+        for hook in self.pre_checkpoint:
+            try:
+                hook()
+            except Exception as e:
+                # Sin los hooks (p. ej. el lake en S3) el snapshot no sería consistente
+                self._error = CheckpointError(f"Hook previo al checkpoint falló: {str(e)}")
+                raise self._error from e
+        
+        positions = dict(self.positions)
+        for batch_positions, _ in pending:
+            positions.update(batch_positions)
+        
+        operator_state = self.snapshot_state()
+        if self.path:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(msgpack.packb({
+                    'checkpoint_id': self.checkpoint_id + 1,
+                    'created_at': time.time(),
+                    'positions': positions,
+                    'operators': operator_state
+                }))
+            os.replace(tmp_path, self.path)
+        
+        self.checkpoint_id += 1
+        self.positions = positions
+        self.operator_state = operator_state
+        
+        # El snapshot ya es durable: ahora sí se confirma en la fuente
+        for _, commit in pending:
+            await commit()
+    
+    def load(self) -> bool:
+        """Cargar el último checkpoint persistido y restaurar los operadores"""
+        if not self.path or not os.path.exists(self.path):
+            return False
+        
+        with open(self.path, 'rb') as f:
+            state = msgpack.unpackb(f.read())
+        
+        self.checkpoint_id = state['checkpoint_id']
+        self.positions = state['positions']
+        self.operator_state = state['operators']
+        self.restore_state(self.operator_state)
+        return True
+    
+    def restore(self):
+        """Volver al último checkpoint tras un fallo: descarta batches y commits posteriores"""
+        self._batches.clear()
+        self._pending.clear()
+        self._error = None
+        self.restore_state(self.operator_state)
+
+class EngineUnavailableError(RuntimeError):
+    """El motor de cómputo pedido no está registrado o no arranca"""
+
+class LazyEngine:
+    """
+    Motor de cómputo (Spark, Dask, Ray) que arranca en el primer uso y se libera
+    tras idle_seconds sin sesiones activas. Arranque y parada son bloqueantes y
+    corren en un hilo para no frenar el event loop.
+    """
+    
+    def __init__(self, name: str, start: Callable[[], Any], stop: Callable[[Any], None],
+                 idle_seconds: float = 300):
+        self.name = name
+        self._start = start
+        self._stop = stop
+        self.idle_seconds = idle_seconds
+        self.handle = None
+        self._users = 0
+        self._last_used = time.monotonic()
+        self._lock = asyncio.Lock()
+        self._reaper: Optional[asyncio.Task] = None
+        self.logger = logging.getLogger("UserJourneyPipeline30X")
+    
+    @property
+    def running(self) -> bool:
+        return self.handle is not None
+    
+    @asynccontextmanager
+    async def session(self):
+        """Usar el motor durante el bloque; arranca si hace falta"""
+        handle = await self.acquire()
+        try:
+            yield handle
+        finally:
+            self.release()
+    
+    async def acquire(self) -> Any:
+        async with self._lock:
+            if self.handle is None:
+                started_at = time.monotonic()
+                self.logger.info(f"🚀 Arrancando {self.name}...")
+                self.handle = await asyncio.to_thread(self._start)
+                
+                startup_seconds = time.monotonic() - started_at
+                ENGINE_STARTUP_SECONDS.labels(engine=self.name).set(startup_seconds)
+                ENGINE_RUNNING.labels(engine=self.name).set(1)
+                self.logger.info(f"✅ {self.name} listo en {startup_seconds:.1f}s")
+                
+                self._reaper = asyncio.create_task(self._release_when_idle())
+            
+            self._users += 1
+            return self.handle
+    
+    def release(self):
+        self._users -= 1
+        self._last_used = time.monotonic()
+    
+    async def close(self):
+        async with self._lock:
+            if self._reaper:
+                self._reaper.cancel()
+                self._reaper = None
+            await self._shutdown()
+    
+    async def _release_when_idle(self):
+        while True:
+            await asyncio.sleep(max(self.idle_seconds / 4, 1))
+            async with self._lock:
+                if self._users == 0 and time.monotonic() - self._last_used >= self.idle_seconds:
+                    self.logger.info(f"💤 {self.name} inactivo {self.idle_seconds:.0f}s, liberando")
+                    self._reaper = None
+                    await self._shutdown()
+                    return
+    
+    async def _shutdown(self):
+        handle, self.handle = self.handle, None
+        if handle is None:
+            return
+        
+        try:
+            await asyncio.to_thread(self._stop, handle)
+        except Exception as e:
+            self.logger.warning(f"Error parando {self.name}: {str(e)}")
+        finally:
+            ENGINE_RUNNING.labels(engine=self.name).set(0)
 
 class UserJourneyPipeline30X:
     """
@@ -113,23 +2835,133 @@ class UserJourneyPipeline30X:
         self.metrics = {}
         
         # Inicializar componentes de procesamiento
-        self.spark = None
-        self.dask_client = None
-        self.ray_context = None
+        self.engines: Dict[str, LazyEngine] = {}
         self.kafka_producer = None
         self.kafka_consumer = None
         self.redis_client = None
         self.clickhouse_client = None
         self.postgres_pool = None
         self.s3_client = None
+        self.lake_writer = None
+        # Último chunk añadido al lake cuyo flush falló: su reintento no lo vuelve a añadir
+        self._lake_unflushed: Optional[pl.DataFrame] = None
         self.bigquery_client = None
+        # Sinks que respondieron al arrancar: los únicos requeridos por defecto en los checkpoints
+        self.connected_sinks: Set[str] = set()
         
         # Configuraciones de optimización
         self.batch_size = config.get('batch_size', 10000)
-        self.parallelism = config.get('parallelism', mp.cpu_count() * 4)
+        # Cada micro-batch es un solo frame (Polars ya paraleliza por dentro); con más de una
+        # partición se reparte por hash de user_id para que cada usuario caiga en una sola.
+        # Por defecto 1 a propósito, sin derivarlo de cpu_workers: ver el README
+        self.stream_partitions = max(1, config.get('stream_partitions', 1))
+        
+        # Pool para etapas CPU (decode, enriquecimiento, limpieza, operadores): Polars y Arrow
+        # liberan el GIL, así que los hilos escalan con los cores sin serializar DataFrames
+        self.cpu_executor = ThreadPoolExecutor(
+            max_workers=config.get('cpu_workers', mp.cpu_count()),
+            thread_name_prefix='journey-cpu'
+        )
         self.compression_level = config.get('compression_level', 3)
         self.cache_ttl = config.get('cache_ttl', 3600)
         
+        # Motor de batch: auto (Spark > Dask > Polars), spark, dask, duckdb o polars
+        self.batch_engine = config.get('batch_engine', 'auto')
+        
+        # Cola acotada para eventos recibidos por HTTP (DataSource.API)
+        # Fuentes con un driver process_stream en marcha
+        self.active_sources: Set[DataSource] = set()
+        self.api_queue: asyncio.Queue = asyncio.Queue(
+            maxsize=config.get('api_queue_max_requests', 1000)
+        )
+        
+        # Índice geográfico local (opcional)
+        self.geo_index = None
+        if config.get('geo_reference_path'):
+            try:
+                self.geo_index = GeoIndex(
+                    config['geo_reference_path'],
+                    hot_cache_size=config.get('geo_hot_cache_size', 4096)
+                )
+            except Exception as e:
+                self.logger.warning(f"Índice geográfico no disponible: {str(e)}")
+        
+        # Funnels incrementales entre batches
+        funnel_definitions = config.get('funnels') or [
+            {'name': 'activation', 'stages': FUNNEL_STAGES}
+        ]
+        self.funnels = {
+            definition['name']: FunnelTracker(
+                FunnelDefinition(**definition),
+                max_users=config.get('funnel_max_users', 1_000_000),
+                allowed_lateness=config.get('funnel_allowed_lateness_seconds', 300)
+            )
+            for definition in funnel_definitions
+        }
+        
+        # Snapshots de estado de operadores (opcional)
+        self.state_dir = config.get('state_dir')
+        
+        # Sesiones entre batches con ventana por inactividad
+        self.sessionizer = Sessionizer(
+            gap_seconds=config.get('session_gap_seconds', 1800),
+            allowed_lateness=config.get('session_allowed_lateness_seconds', 300),
+            max_open_sessions=config.get('session_max_open', 500_000),
+            spill_path=config.get('session_spill_path') or (
+                os.path.join(self.state_dir, 'sessions-spill.sqlite') if self.state_dir else None
+            ),
+            max_path_events=config.get('session_max_path_events', 50)
+        )
+        
+        # Journey map agregado mantenido desde las sesiones cerradas (/journey/aggregate)
+        self.journey_maps = JourneyMapStore(
+            window_days=config.get('journey_window_days', 7),
+            max_paths_per_day=config.get('journey_max_paths_per_day', 100_000),
+            conversion_events=config.get('journey_conversion_events', JOURNEY_CONVERSION_EVENTS)
+        )
+        self.aggregate_journey: Dict[str, Any] = {}
+        
+        # Retención por cohortes con bitmaps persistidos en cada checkpoint
+        self.retention = RetentionEngine(
+            path=config.get('retention_path') or (
+                os.path.join(self.state_dir, 'retention') if self.state_dir else None
+            ),
+            max_weeks=config.get('retention_max_weeks', 52)
+        )
+        self._journey_map_dirty = True
+        self._journey_map_refreshed_at = 0.0
+        
+        # Distintos y top-k por hora/día con sketches combinables entre workers (dashboard_metrics:*)
+        self.dashboard_sketches = DashboardSketches(
+            precision=config.get('dashboard_hll_precision', 14),
+            capacity=config.get('dashboard_top_capacity', 100),
+            width=config.get('dashboard_cms_width', 2048),
+            depth=config.get('dashboard_cms_depth', 4),
+            retention_hours=config.get('dashboard_retention_hours', 48),
+            retention_days=config.get('dashboard_retention_days', 8),
+            worker_id=config.get('worker_id')
+        )
+        self._dashboard_published_at = 0.0
+        
+        # Cuantiles combinables por hora/día: duración de sesión, intervalo entre eventos y
+        # latencia por etapa (p50/p90/p99 en /metrics)
+        self.quantile_sketches = QuantileSketches(
+            relative_accuracy=config.get('quantile_relative_accuracy', 0.01),
+            max_bins=config.get('quantile_max_bins', 2048),
+            retention_hours=config.get('dashboard_retention_hours', 48),
+            retention_days=config.get('dashboard_retention_days', 8),
+            worker_id=config.get('worker_id')
+        )
+        
+        # Baselines de actividad para detección de anomalías
+        self.anomaly_detector = AnomalyDetector(
+            bucket_seconds=config.get('anomaly_bucket_seconds', 60),
+            alpha=config.get('anomaly_ewma_alpha', 0.05),
+            z_threshold=config.get('anomaly_z_threshold', 4.0),
+            min_samples=config.get('anomaly_min_samples', 30),
+            user_window_seconds=config.get('anomaly_user_window_seconds', 3600)
+        )
+        
         # Estadísticas en memoria
         self.stats = {
             'events_processed': 0,
@@ -140,6 +2972,119 @@ class UserJourneyPipeline30X:
         }
         
         self._init_cluster()
+        self.checkpoints = self._create_checkpoint_coordinator()
+        self.sink_queues = self._create_sink_queues()
+        
+        # Timelines por usuario para /journey/{user_id}: LRU local + Redis, lake como respaldo
+        self.timelines = UserTimelineStore(
+            self.redis_client,
+            max_events=config.get('timeline_max_events', 1000),
+            max_users=config.get('timeline_local_users', 50_000),
+            local_ttl_seconds=config.get('timeline_local_ttl_seconds', 60),
+            redis_ttl_seconds=config.get('timeline_redis_ttl_seconds', 7 * 86400)
+        )
+    
+    def _operators(self) -> Dict[str, Any]:
+        """Operadores con estado entre batches (snapshot()/restore())"""
+        operators = {f"funnel:{name}": tracker for name, tracker in self.funnels.items()}
+        operators['sessions'] = self.sessionizer
+        operators['journeys'] = self.journey_maps
+        operators['retention'] = self.retention
+        operators['dashboard'] = self.dashboard_sketches
+        operators['quantiles'] = self.quantile_sketches
+        operators['anomalies'] = self.anomaly_detector
+        return operators
+    
+    def _snapshot_operators(self) -> Dict[str, bytes]:
+        return {name: operator.snapshot() for name, operator in self._operators().items()}
+    
+    def _restore_operators(self, state: Dict[str, bytes]):
+        for name, operator in self._operators().items():
+            if name in state:
+                operator.restore(state[name])
+        
+        self._materialize_journey_map()
+    
+    def _create_checkpoint_coordinator(self) -> CheckpointCoordinator:
+        """Coordinador de checkpoints; restaura el último checkpoint persistido si existe"""
+        required = self.config.get('checkpoint_required_sinks')
+        if required is None:
+            # Solo los sinks con conectividad verificada; un cliente perezoso no basta
+            required = self.connected_sinks & {'clickhouse', 'postgres', 'lake'}
+        self.logger.info(f"🔒 Sinks requeridos en checkpoints: {', '.join(sorted(required)) or 'ninguno'}")
+        
+        interval = self.config.get('checkpoint_interval_seconds', 60)
+        if self.lake_writer and interval < self.lake_writer.max_age_seconds:
+            # Cada checkpoint cierra un fichero por partición abierta del lake: más a menudo
+            # que el flush por edad solo produciría ficheros pequeños
+            self.logger.warning(
+                f"⚠️ checkpoint_interval_seconds ({interval}) < lake_max_file_age_seconds "
+                f"({self.lake_writer.max_age_seconds}): los checkpoints irán cada "
+                f"{self.lake_writer.max_age_seconds}s"
+            )
+            interval = self.lake_writer.max_age_seconds
+        
+        coordinator = CheckpointCoordinator(
+            required_sinks=set(required),
+            snapshot_state=self._snapshot_operators,
+            restore_state=self._restore_operators,
+            path=os.path.join(self.state_dir, 'checkpoint.msgpack') if self.state_dir else None,
+            interval_seconds=interval,
+            pre_checkpoint=[self.lake_writer.flush_all] if self.lake_writer else []
+        )
+        
+        try:
+            if coordinator.load():
+                self.logger.info(f"♻️ Checkpoint {coordinator.checkpoint_id} restaurado")
+        except Exception as e:
+            self.logger.warning(f"No se pudo restaurar el checkpoint: {str(e)}")
+        
+        if not coordinator.operator_state:
+            coordinator.operator_state = self._snapshot_operators()
+        
+        return coordinator
+    
+    def _create_sink_queues(self) -> Dict[str, SinkQueue]:
+        """Una cola acotada con sus workers por sink configurado (o requerido)"""
+        sinks = {
+            'clickhouse': (self._store_clickhouse, self.clickhouse_client, 2),
+            'postgres': (self._store_postgres, self.postgres_pool, 2),
+            # RollingParquetWriter no es thread-safe: un solo worker
+            'lake': (self._store_lake_parquet, self.lake_writer, 1),
+            'redis': (self._update_redis_cache, self.redis_client, 1)
+        }
+        overrides = self.config.get('sinks', {})
+        spill_dir = os.path.join(self.state_dir or tempfile.gettempdir(), 'sink-spill')
+        
+        queues = {}
+        for name, (write, client, workers) in sinks.items():
+            required = name in self.checkpoints.required_sinks
+            if not client and not required:
+                continue
+            
+            options = {
+                'workers': workers,
+                'max_queue': 32,
+                # Descartar solo tiene sentido en sinks best-effort
+                'policy': 'block' if required else 'drop',
+                'spill_dir': spill_dir,
+                **overrides.get(name, {})
+            }
+            if name == 'lake':
+                options['workers'] = 1
+            
+            queues[name] = SinkQueue(name, write, on_flush=self._observe_sink_flush, **options)
+        
+        return queues
+    
+    def _recover_from_checkpoint(self):
+        """Volver al último checkpoint tras un batch no confirmado"""
+        self.checkpoints.restore()
+        for queue in self.sink_queues.values():
+            queue.clear()
+        if self.lake_writer:
+            self.lake_writer.discard()
+        self.timelines.clear_local()
     
     def _setup_logger(self) -> logging.Logger:
         """Configurar logger distribuido"""
@@ -166,74 +3111,79 @@ class UserJourneyPipeline30X:
         return logger
     
     def _init_cluster(self):
-        """Inicializar cluster de procesamiento distribuido"""
-        self.logger.info("🚀 Inicializando cluster de procesamiento 30X...")
-        
-        try:
-            # Inicializar Spark para procesamiento masivo
-            self.spark = SparkSession.builder \
-                .appName("UserJourneyPipeline30X") \
-                .master("local[*]") \
-                .config("spark.executor.memory", "8g") \
-                .config("spark.driver.memory", "4g") \
-                .config("spark.sql.shuffle.partitions", "100") \
-                .config("spark.default.parallelism", "200") \
-                .config("spark.serializer", "org.apache.spark.serializer.KryoSerializer") \
-                .config("spark.kryoserializer.buffer.max", "512m") \
-                .config("spark.sql.adaptive.enabled", "true") \
-                .config("spark.sql.adaptive.coalescePartitions.enabled", "true") \
-                .config("spark.sql.adaptive.skewJoin.enabled", "true") \
-                .getOrCreate()
-            
-            self.logger.info("✅ Spark inicializado")
-            
-        except Exception as e:
-            self.logger.warning(f"Spark no disponible: {str(e)}")
+        """Registrar motores de cómputo (arrancan en su primer uso) y clientes de almacenamiento"""
+        self.logger.info("🚀 Inicializando pipeline 30X...")
         
-        try:
-            # Inicializar Dask para procesamiento paralelo
-            cluster = LocalCluster(
-                n_workers=self.parallelism,
-                threads_per_worker=2,
-                memory_limit='8GB',
-                processes=True
-            )
-            self.dask_client = Client(cluster)
-            self.logger.info(f"✅ Dask cluster con {self.parallelism} workers")
-            
-        except Exception as e:
-            self.logger.warning(f"Dask no disponible: {str(e)}")
+        starters = {
+            'spark': (self._start_spark, lambda spark: spark.stop()),
+            'dask': (self._start_dask, lambda client: (client.cluster.close(), client.close())),
+            'ray': (self._start_ray, lambda ray: ray.shutdown())
+        }
         
-        try:
-            # Inicializar Ray para computación distribuida
-            ray.init(
-                num_cpus=self.parallelism,
-                object_store_memory=10**9,
-                ignore_reinit_error=True
-            )
-            self.ray_context = ray
-            self.logger.info("✅ Ray inicializado")
-            
-        except Exception as e:
-            self.logger.warning(f"Ray no disponible: {str(e)}")
+        idle_seconds = self.config.get('engine_idle_seconds', 300)
+        for name in self.config.get('engines', ['spark', 'dask', 'ray']):
+            start, stop = starters[name]
+            self.engines[name] = LazyEngine(name, start, stop, idle_seconds=idle_seconds)
         
         # Inicializar clientes de almacenamiento
         self._init_storage_clients()
         
-        self.logger.info("🔄 Todos los componentes inicializados")
+        self.logger.info(f"🔄 Componentes inicializados (motores bajo demanda: {', '.join(self.engines) or 'ninguno'})")
+    
+    def _start_spark(self):
+        """Spark para procesamiento masivo"""
+        from pyspark.sql import SparkSession
+        
+        return SparkSession.builder \
+            .appName("UserJourneyPipeline30X") \
+            .master(self.config.get('spark_master', 'local[*]')) \
+            .config("spark.executor.memory", self.config.get('spark_executor_memory', '8g')) \
+            .config("spark.driver.memory", self.config.get('spark_driver_memory', '4g')) \
+            .config("spark.sql.shuffle.partitions", "100") \
+            .config("spark.default.parallelism", "200") \
+            .config("spark.serializer", "org.apache.spark.serializer.KryoSerializer") \
+            .config("spark.kryoserializer.buffer.max", "512m") \
+            .config("spark.sql.adaptive.enabled", "true") \
+            .config("spark.sql.adaptive.coalescePartitions.enabled", "true") \
+            .config("spark.sql.adaptive.skewJoin.enabled", "true") \
+            .getOrCreate()
+    
+    def _start_dask(self):
+        """Dask para procesamiento paralelo"""
+        from dask.distributed import Client, LocalCluster
+        
+        cluster = LocalCluster(
+            n_workers=self.config.get('dask_workers', mp.cpu_count()),
+            threads_per_worker=2,
+            memory_limit=self.config.get('dask_worker_memory', 'auto'),
+            processes=True
+        )
+        return Client(cluster)
+    
+    def _start_ray(self):
+        """Ray para computación distribuida"""
+        import ray
+        
+        ray.init(
+            num_cpus=self.config.get('ray_num_cpus', mp.cpu_count()),
+            object_store_memory=10**9,
+            ignore_reinit_error=True
+        )
+        return ray
     
     def _init_storage_clients(self):
         """Inicializar clientes de almacenamiento y bases de datos"""
         # Redis para caché y estado
         try:
-            self.redis_client = redis.Redis(
+            client = redis.Redis(
                 host=self.config.get('redis_host', 'localhost'),
                 port=self.config.get('redis_port', 6379),
                 db=0,
                 decode_responses=False,
                 max_connections=50
             )
-            self.redis_client.ping()
+            client.ping()
+            self.redis_client = client
             self.logger.info("✅ Redis conectado")
         except Exception as e:
             self.logger.warning(f"Redis no disponible: {str(e)}")
@@ -247,6 +3197,8 @@ class UserJourneyPipeline30X:
                 password=self.config.get('clickhouse_password', ''),
                 database=self.config.get('clickhouse_db', 'default')
             )
+            if self.clickhouse_client.ping():
+                self.connected_sinks.add('clickhouse')
             self.logger.info("✅ ClickHouse conectado")
         except Exception as e:
             self.logger.warning(f"ClickHouse no disponible: {str(e)}")
@@ -259,6 +3211,10 @@ class UserJourneyPipeline30X:
                 max_overflow=10,
                 pool_pre_ping=True
             )
+            # create_engine es perezoso: solo una consulta confirma que hay servidor
+            with self.postgres_pool.connect() as conn:
+                conn.execute(text("SELECT 1"))
+            self.connected_sinks.add('postgres')
             self.logger.info("✅ PostgreSQL conectado")
         except Exception as e:
             self.logger.warning(f"PostgreSQL no disponible: {str(e)}")
@@ -275,6 +3231,27 @@ class UserJourneyPipeline30X:
         except Exception as e:
             self.logger.warning(f"S3 no disponible: {str(e)}")
         
+        # Data lake Parquet particionado
+        try:
+            if self.config.get('lake_backend', 's3') == 'local':
+                backend = LocalLakeBackend(self.config.get('lake_path', './data-lake'))
+            elif self.s3_client:
+                backend = S3LakeBackend(self.s3_client, self.config.get('s3_bucket', 'petmatch-data-lake'))
+            else:
+                backend = None
+            
+            if backend:
+                self.lake_writer = RollingParquetWriter(
+                    backend,
+                    target_file_bytes=self.config.get('lake_target_file_mb', 128) * 1024 * 1024,
+                    max_age_seconds=self.config.get('lake_max_file_age_seconds', 300),
+                    max_buffer_bytes=self.config.get('lake_max_buffer_mb', 1024) * 1024 * 1024
+                )
+                self.connected_sinks.add('lake')
+                self.logger.info(f"✅ Data lake en {self.lake_writer.uri()}")
+        except Exception as e:
+            self.logger.warning(f"Data lake no disponible: {str(e)}")
+        
         # Kafka para streaming
         try:
             self.kafka_producer = KafkaProducer(
@@ -309,202 +3286,625 @@ class UserJourneyPipeline30X:
             raise ValueError(f"Fuente no soportada: {source}")
         
         processor = processors[source]
+        backoff = 1
+        self.active_sources.add(source)
+        journey_refresher = asyncio.create_task(self._refresh_journey_map())
         
-        # Procesar en micro-batches para balancear latencia/throughput
-        if mode == ProcessingMode.MICRO_BATCH:
-            await self._process_micro_batches(processor)
-        elif mode == ProcessingMode.STREAMING:
-            await processor()
-        else:
-            await self._process_hybrid(processor)
+        try:
+            while True:
+                try:
+                    # Procesar en micro-batches para balancear latencia/throughput
+                    if mode == ProcessingMode.MICRO_BATCH:
+                        await self._process_micro_batches(processor)
+                    elif mode == ProcessingMode.STREAMING:
+                        await processor()
+                    else:
+                        await self._process_hybrid(processor)
+                    return
+                
+                except asyncio.CancelledError:
+                    raise
+                
+                except Exception as e:
+                    # Fallos de fuente, sinks o hooks: reanudar desde el último checkpoint consistente
+                    if not isinstance(e, CheckpointError):
+                        self.logger.exception(f"❌ Error en stream {source.value}: {str(e)}")
+                    self.logger.error(f"🔁 {str(e)}; reanudando desde checkpoint {self.checkpoints.checkpoint_id}")
+                    self._recover_from_checkpoint()
+                    await asyncio.sleep(backoff)
+                    backoff = min(backoff * 2, 60)
+        finally:
+            journey_refresher.cancel()
+            self.active_sources.discard(source)
     
-    async def _process_kafka_stream(self):
-        """Procesar stream desde Kafka"""
-        consumer = KafkaConsumer(
+    def _create_kafka_consumer(self):
+        """Crear consumidor Kafka asíncrono con prefetch acotado"""
+        factory = self.config.get('kafka_consumer_factory')
+        if factory:
+            # Permite inyectar un broker local en proceso (InProcessKafkaConsumer)
+            return factory()
+        
+        prefetch_bytes = self.config.get('kafka_prefetch_bytes', 50 * 1024 * 1024)  # 50MB
+        
+        return AIOKafkaConsumer(
             self.config.get('kafka_topic', 'user-journey-events'),
             bootstrap_servers=self.config.get('kafka_brokers', 'localhost:9092').split(','),
             group_id='journey-pipeline-30x',
             auto_offset_reset='latest',
             enable_auto_commit=False,
-            value_deserializer=lambda v: orjson.loads(v),
-            max_poll_records=5000,
-            fetch_max_bytes=50 * 1024 * 1024  # 50MB
+            max_poll_records=self.config.get('kafka_max_poll_records', 5000),
+            fetch_max_bytes=prefetch_bytes,
+            max_partition_fetch_bytes=min(prefetch_bytes, 8 * 1024 * 1024)
+        )
+    
+    async def _process_micro_batches(self, processor: Callable):
+        """Agrupar la salida de la fuente en micro-batches por tamaño o latencia"""
+        batcher = self._create_micro_batcher()
+        await self._run_with_batcher(batcher, processor(emit=batcher.add))
+    
+    async def _run_with_batcher(self, batcher: MicroBatcher, source: Awaitable):
+        """
+        Ejecutar la fuente junto al micro-batcher. Si un batch falla se detiene la fuente
+        aunque esté esperando datos, y el error llega a process_stream.
+        """
+        runner = asyncio.create_task(batcher.run())
+        source_task = asyncio.ensure_future(source)
+        failed = asyncio.create_task(batcher.failed.wait())
+        
+        try:
+            await asyncio.wait({source_task, failed}, return_when=asyncio.FIRST_COMPLETED)
+            if not failed.done():
+                await source_task
+                await batcher.flush()
+            await batcher.join()
+        finally:
+            for task in (runner, source_task, failed):
+                task.cancel()
+    
+    async def _process_hybrid(self, processor: Callable):
+        """
+        Alternar entre procesamiento por evento y por batch según la tasa de llegada.
+        Con poco tráfico cada lectura se procesa al instante (mínima latencia);
+        por encima del umbral se agrupa en micro-batches (máximo throughput).
+        """
+        batcher = self._create_micro_batcher()
+        
+        threshold = self.config.get('hybrid_rate_threshold', 500)  # eventos/segundo
+        alpha = self.config.get('hybrid_rate_smoothing', 0.2)
+        state = {'rate': 0.0, 'last_arrival': time.monotonic(), 'batching': False}
+        
+        async def emit(events: List[bytes], commit: Optional[Callable] = None):
+            now = time.monotonic()
+            elapsed = max(now - state['last_arrival'], 1e-3)
+            state['last_arrival'] = now
+            state['rate'] = alpha * (len(events) / elapsed) + (1 - alpha) * state['rate']
+            
+            # Histéresis para no oscilar alrededor del umbral
+            if not state['batching'] and state['rate'] > threshold:
+                state['batching'] = True
+                self.logger.info(f"🔀 Modo híbrido → batch ({state['rate']:.0f} eventos/segundo)")
+            elif state['batching'] and state['rate'] < threshold / 2:
+                state['batching'] = False
+                self.logger.info(f"🔀 Modo híbrido → por evento ({state['rate']:.0f} eventos/segundo)")
+            
+            # Solo se procesa directo cuando no quedan batches anteriores, para respetar el orden de commits
+            if not state['batching'] and batcher.is_idle():
+                await self._emit_direct(events, commit)
+            else:
+                await batcher.add(events, commit)
+        
+        await self._run_with_batcher(batcher, processor(emit=emit))
+    
+    def _create_micro_batcher(self) -> MicroBatcher:
+        """Crear micro-batcher con los triggers configurados"""
+        return MicroBatcher(
+            self._process_payloads,
+            max_events=self.config.get('micro_batch_max_events', 1000),
+            max_latency_ms=self.config.get('micro_batch_max_latency_ms', 1000),
+            max_pending_batches=self.config.get('micro_batch_max_pending', 4)
         )
+    
+    async def _emit_direct(self, events: List[bytes], commit: Optional[Callable] = None):
+        """Procesar una lectura de la fuente inmediatamente y confirmar su posición"""
+        if events:
+            await self._process_payloads(events)
+        
+        if commit:
+            await commit()
+    
+    async def _process_payloads(self, payloads: List[bytes]):
+        """Decodificar payloads crudos a un RecordBatch y procesarlo"""
+        # Entre batches el estado de los operadores coincide con las posiciones en espera
+        self.checkpoints.raise_if_failed()
+        if self.checkpoints.due():
+            await self.checkpoints.checkpoint()
+        
+        started_at = time.monotonic()
+        batch = await self._run_cpu(self._decode_batch, payloads)
+        self._observe_stage('decode', started_at)
+        if batch.num_rows:
+            await self._process_batch_parallel(batch)
+    
+    def _decode_batch(self, payloads: List[bytes]) -> pa.RecordBatch:
+        """
+        Decodificar JSON crudo directamente a un RecordBatch de Arrow con esquema fijo,
+        sin crear objetos Python por evento. `properties` no tiene claves fijas y se
+        infiere como struct por batch.
+        """
+        buffer = b'\n'.join(payloads)
+        
+        # Un solo bloque = un solo chunk contiguo por columna
+        read_options = pa_json.ReadOptions(use_threads=True, block_size=len(buffer) + 1)
         
-        batch = []
-        batch_start_time = time.time()
+        try:
+            table = pa_json.read_json(
+                pa.BufferReader(buffer),
+                read_options=read_options,
+                parse_options=pa_json.ParseOptions(
+                    explicit_schema=EVENT_ARROW_SCHEMA,
+                    unexpected_field_behavior='infer'
+                )
+            )
+            if 'properties' not in table.column_names:
+                table = table.append_column(
+                    'properties', pa.nulls(table.num_rows, pa.struct([]))
+                )
+            
+        except pa.ArrowInvalid:
+            # Tipos inconsistentes en properties, timestamps epoch o líneas corruptas: camino lento
+            table = self._decode_batch_fallback(payloads, read_options)
         
-        for message in consumer:
+        table = table.select(EVENT_ARROW_SCHEMA.names + ['properties'])
+        return table.combine_chunks().to_batches()[0] if table.num_rows else \
+            pa.RecordBatch.from_pylist([], schema=table.schema)
+    
+    def _decode_batch_fallback(self, payloads: List[bytes], read_options) -> pa.Table:
+        """
+        Decodificar descartando payloads inválidos, con properties como JSON string. Si un
+        campo fijo llega con otro tipo (p. ej. `location.lat: "abc"`) Arrow rechaza el bloque
+        entero: entonces se decodifica evento a evento y se descartan solo los inválidos.
+        """
+        valid = []
+        properties = []
+        for payload in payloads:
             try:
-                event_data = message.value
-                event = UserJourneyEvent(**event_data)
-                batch.append(event)
+                event = orjson.loads(payload)
+                timestamp = self._normalize_timestamp(event.get('timestamp'))
+                if timestamp != event.get('timestamp'):
+                    event['timestamp'] = timestamp
+                    payload = orjson.dumps(event)
+                
+                properties.append(orjson.dumps(event.get('properties') or {}).decode())
+                valid.append(payload)
+            except Exception as e:
+                self.logger.error(f"Error decodificando evento: {str(e)}")
+                self.stats['errors'] += 1
+        
+        try:
+            table = self._read_events(valid, read_options)
+        except pa.ArrowInvalid:
+            tables = []
+            kept_properties = []
+            for payload, event_properties in zip(valid, properties):
+                try:
+                    tables.append(self._read_events([payload]))
+                    kept_properties.append(event_properties)
+                except pa.ArrowInvalid as e:
+                    self.logger.error(f"Evento descartado por esquema: {str(e)}")
+                    self.stats['errors'] += 1
+            
+            table = pa.concat_tables(tables) if tables else EVENT_ARROW_SCHEMA.empty_table()
+            properties = kept_properties
+        
+        return table.append_column('properties', pa.array(properties, pa.string()))
+    
+    @staticmethod
+    def _normalize_timestamp(value: Any) -> Any:
+        """
+        Epoch (número o string numérico; s, ms o µs según la magnitud) e ISO 8601 con 'Z'
+        a ISO 8601 con offset explícito. Arrow no convierte números a timestamp: sin esto
+        el evento se descartaría por esquema.
+        """
+        if isinstance(value, str):
+            if value.endswith('Z'):
+                return value[:-1] + '+00:00'
+            if not value.isdigit():
+                return value
+            value = int(value)
+        
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return value
+        
+        if abs(value) >= 1e14:
+            value /= 1e6
+        elif abs(value) >= 1e11:
+            value /= 1e3
+        return datetime.fromtimestamp(value, tz=timezone.utc).isoformat()
+    
+    @staticmethod
+    def _read_events(payloads: List[bytes], read_options=None) -> pa.Table:
+        """Payloads JSON a una tabla con EVENT_ARROW_SCHEMA (campos no fijos ignorados)"""
+        if not payloads:
+            return EVENT_ARROW_SCHEMA.empty_table()
+        
+        buffer = b'\n'.join(payloads)
+        return pa_json.read_json(
+            pa.BufferReader(buffer),
+            read_options=read_options or pa_json.ReadOptions(use_threads=False, block_size=len(buffer) + 1),
+            parse_options=pa_json.ParseOptions(
+                explicit_schema=EVENT_ARROW_SCHEMA,
+                unexpected_field_behavior='ignore'
+            )
+        )
+    
+    async def _process_kafka_stream(self, emit: Optional[Callable] = None):
+        """Procesar stream desde Kafka sin bloquear el event loop"""
+        emit = emit or self._emit_direct
+        consumer = self._create_kafka_consumer()
+        await consumer.start()
+        self.kafka_consumer = consumer
+        
+        max_events = self.config.get('stream_batch_max_events', 1000)
+        max_wait_ms = self.config.get('stream_batch_timeout_ms', 1000)
+        
+        try:
+            while True:
+                # getmany cede el loop mientras espera; nunca trae más de max_events
+                records = await consumer.getmany(timeout_ms=max_wait_ms, max_records=max_events)
+                if not records:
+                    continue
+                
+                payloads = []
+                offsets = {}
+                positions = {}
                 
-                # Procesar batch cada 1000 eventos o 1 segundo
-                if len(batch) >= 1000 or (time.time() - batch_start_time) >= 1:
-                    await self._process_batch_parallel(batch)
+                for tp, messages in records.items():
+                    # Lo anterior a la posición del checkpoint ya está en el estado restaurado
+                    key = f"kafka:{tp.topic}:{tp.partition}"
+                    checkpointed = self.checkpoints.position(key, 0)
+                    payloads.extend(message.value for message in messages if message.offset >= checkpointed)
                     
-                    # Commit offset
-                    consumer.commit()
+                    # Siguiente offset a leer por partición
+                    offsets[tp] = messages[-1].offset + 1
+                    positions[key] = offsets[tp]
+                
+                # Commit explícito por partición en el siguiente checkpoint
+                async def commit(offsets=offsets):
+                    await consumer.commit(offsets)
+                
+                await emit(payloads, self.checkpoints.track(positions, commit))
+                
+        finally:
+            await consumer.stop()
+            self.kafka_consumer = None
+    
+    async def ingest_api_events(self, payloads: List[bytes]) -> bool:
+        """
+        Encolar eventos JSON crudos recibidos por HTTP para el driver API.
+        Devuelve False si la cola sigue llena tras el timeout (backpressure).
+        """
+        try:
+            await asyncio.wait_for(
+                self.api_queue.put(payloads),
+                self.config.get('api_ingest_timeout_ms', 1000) / 1000
+            )
+            return True
+        except asyncio.TimeoutError:
+            return False
+    
+    async def _process_api_stream(self, emit: Optional[Callable] = None):
+        """Procesar eventos recibidos por la API HTTP"""
+        emit = emit or self._emit_direct
+        max_events = self.config.get('stream_batch_max_events', 1000)
+        
+        while True:
+            payloads = list(await self.api_queue.get())
+            
+            # Drenar lo que ya esté encolado para no procesar peticiones de una en una
+            while len(payloads) < max_events and not self.api_queue.empty():
+                payloads.extend(self.api_queue.get_nowait())
+            
+            await emit(payloads)
+    
+    async def _process_redis_stream(self, emit: Optional[Callable] = None):
+        """Procesar Redis Stream con consumer group y XACK tras procesar"""
+        emit = emit or self._emit_direct
+        
+        client = aioredis.Redis(
+            host=self.config.get('redis_host', 'localhost'),
+            port=self.config.get('redis_port', 6379),
+            db=0,
+            decode_responses=False
+        )
+        stream = self.config.get('redis_stream_key', 'user-journey-events')
+        field_name = self.config.get('redis_stream_field', 'data').encode()
+        group = 'journey-pipeline-30x'
+        consumer_name = f"{socket.gethostname()}-{os.getpid()}"
+        max_events = self.config.get('stream_batch_max_events', 1000)
+        max_wait_ms = self.config.get('stream_batch_timeout_ms', 1000)
+        
+        try:
+            await client.xgroup_create(stream, group, id='$', mkstream=True)
+        except redis.exceptions.ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+        
+        # Primero recuperar mensajes pendientes (sin XACK) de una ejecución anterior
+        last_id = b'0'
+        
+        try:
+            while True:
+                response = await client.xreadgroup(
+                    group, consumer_name, {stream: last_id},
+                    count=max_events, block=max_wait_ms
+                )
+                
+                messages = response[0][1] if response else []
+                if not messages:
+                    last_id = b'>'
+                    continue
+                
+                if last_id != b'>':
+                    last_id = messages[-1][0]
+                
+                message_ids = [message_id for message_id, _ in messages]
+                checkpointed = self.checkpoints.position(f"redis:{stream}")
+                payloads = []
+                for message_id, fields in messages:
+                    # Ya incluido en el checkpoint pero sin XACK: solo confirmar
+                    if checkpointed and self._stream_id(message_id) <= self._stream_id(checkpointed):
+                        continue
                     
-                    # Reset batch
-                    batch = []
-                    batch_start_time = time.time()
+                    if field_name in fields:
+                        payloads.append(fields[field_name])
+                    else:
+                        self.logger.error(f"Mensaje Redis sin campo {field_name.decode()}")
+                        self.stats['errors'] += 1
                 
-                EVENTS_PROCESSED.inc()
+                async def commit(message_ids=message_ids):
+                    await client.xack(stream, group, *message_ids)
                 
-            except Exception as e:
-                self.logger.error(f"Error procesando mensaje Kafka: {str(e)}")
-                self.stats['errors'] += 1
+                await emit(payloads, self.checkpoints.track({f"redis:{stream}": message_ids[-1]}, commit))
+                
+        finally:
+            await client.close()
+    
+    @staticmethod
+    def _stream_id(message_id: bytes) -> Tuple[int, int]:
+        milliseconds, sequence = message_id.split(b'-')
+        return int(milliseconds), int(sequence)
     
-    async def _process_batch_parallel(self, batch: List[UserJourneyEvent]):
+    async def _process_batch_parallel(self, batch: pa.RecordBatch):
         """Procesar batch de eventos en paralelo con múltiples estrategias"""
         start_time = time.time()
         
-        # Dividir batch para procesamiento paralelo
-        chunk_size = len(batch) // self.parallelism + 1
-        chunks = [batch[i:i + chunk_size] for i in range(0, len(batch), chunk_size)]
+        chunks = await self._run_cpu(self._partition_batch, batch)
         
-        # Procesar chunks en paralelo
+        # Procesar chunks en paralelo; cada chunk espera al anterior solo para los operadores
+        # con estado y confirma por sink en el coordinador
+        batch_id = self.checkpoints.begin(len(chunks))
         tasks = []
+        previous = None
         for chunk in chunks:
-            task = asyncio.create_task(self._process_chunk_optimized(chunk))
-            tasks.append(task)
+            previous = asyncio.create_task(self._process_chunk_optimized(chunk, batch_id, previous))
+            tasks.append(previous)
         
         results = await asyncio.gather(*tasks, return_exceptions=True)
         
         # Consolidar resultados
         successful = sum(1 for r in results if not isinstance(r, Exception))
         
+        # Las escrituras siguen en las colas de los sinks; el checkpoint espera sus acks
+        self.checkpoints.seal(batch_id, failed_parts=len(results) - successful)
+        
         processing_time = time.time() - start_time
         PROCESSING_LATENCY.observe(processing_time)
+        self.quantile_sketches.observe('stage_latency_seconds:batch', processing_time)
         
-        self.stats['events_processed'] += len(batch)
-        self.stats['total_bytes'] += sum(len(str(e).encode()) for e in batch)
+        EVENTS_PROCESSED.inc(batch.num_rows)
+        self.stats['events_processed'] += batch.num_rows
+        self.stats['total_bytes'] += batch.nbytes
         
-        avg_time = processing_time / len(batch) if batch else 0
+        avg_time = processing_time / batch.num_rows if batch.num_rows else 0
         self.stats['avg_processing_time'] = (
-            self.stats['avg_processing_time'] * (self.stats['events_processed'] - len(batch)) +
-            avg_time * len(batch)
+            self.stats['avg_processing_time'] * (self.stats['events_processed'] - batch.num_rows) +
+            avg_time * batch.num_rows
         ) / self.stats['events_processed']
         
         DATA_VOLUME_GB.set(self.stats['total_bytes'] / (1024**3))
         PARALLEL_TASKS.set(len(chunks))
         
         self.logger.info(
-            f"✅ Batch procesado: {len(batch)} eventos, {successful}/{len(chunks)} chunks, "
-            f"{processing_time:.3f}s, {len(batch)/processing_time:.0f} eventos/segundo"
+            f"✅ Batch procesado: {batch.num_rows} eventos, {successful}/{len(chunks)} chunks, "
+            f"{processing_time:.3f}s, {batch.num_rows/processing_time:.0f} eventos/segundo"
         )
     
-    async def _process_chunk_optimized(self, chunk: List[UserJourneyEvent]) -> Dict[str, Any]:
-        """Procesar un chunk de eventos con optimizaciones 30X"""
+    def _partition_batch(self, batch: pa.RecordBatch) -> List[pl.DataFrame]:
+        """Un frame por batch o, con stream_partitions > 1, una partición por hash de user_id"""
+        # Polars usa los buffers Arrow del RecordBatch sin copiarlos
+        df = pl.from_arrow(batch)
+        if self.stream_partitions == 1:
+            return [df]
+        
+        return df.with_columns(
+            (pl.col('user_id').hash() % self.stream_partitions).alias('_partition')
+        ).partition_by('_partition', include_key=False, maintain_order=True)
+    
+    async def _run_cpu(self, func: Callable, *args) -> Any:
+        """Ejecutar una etapa síncrona de Polars/Arrow en el pool de CPU sin bloquear el loop"""
+        return await asyncio.get_running_loop().run_in_executor(self.cpu_executor, func, *args)
+    
+    async def _process_chunk_optimized(self, chunk: pl.DataFrame, batch_id: int,
+                                       previous: Optional[asyncio.Task] = None) -> Dict[str, Any]:
+        """
+        Procesar un chunk de eventos con optimizaciones 30X. Enriquecimiento y limpieza corren
+        en paralelo con los demás chunks; los operadores con estado esperan a que el chunk
+        anterior (`previous`) los haya aplicado, así que se actualizan en orden y de a uno.
+        """
         try:
-            # Convertir a DataFrame de Polars para procesamiento ultra rápido
-            df = pl.DataFrame([
-                {
-                    'event_id': e.event_id,
-                    'user_id': e.user_id,
-                    'session_id': e.session_id,
-                    'event_type': e.event_type,
-                    'event_name': e.event_name,
-                    'timestamp': e.timestamp,
-                    'platform': e.platform,
-                    'device_info': json.dumps(e.device_info),
-                    'location': json.dumps(e.location),
-                    'properties': json.dumps(e.properties),
-                    'app_version': e.app_version
-                }
-                for e in chunk
-            ])
-            
-            # 1. Enriquecimiento de datos
-            df_enriched = await self._enrich_data(df)
-            
-            # 2. Validación y limpieza
-            df_clean = await self._clean_data(df_enriched)
-            
-            # 3. Agregación para analytics
-            aggregates = await self._aggregate_events(df_clean)
+            # 1-2. Enriquecimiento, validación y limpieza
+            started_at = time.monotonic()
+            df_clean = await self._run_cpu(self._transform_chunk, chunk)
+            self._observe_stage('transform', started_at)
             
-            # 4. Detección de anomalías
-            anomalies = await self._detect_anomalies(df_clean)
+            # 3-4. Sesionización, agregación y detección de anomalías en orden de llegada
+            if previous:
+                await asyncio.wait({previous})
+            started_at = time.monotonic()
+            aggregates, anomalies = await self._run_cpu(self._apply_operators, df_clean)
+            self._observe_stage('operators', started_at)
+            await self._update_realtime_metrics(aggregates)
             
-            # 5. Almacenamiento en múltiples sinks
-            storage_tasks = [
-                self._store_clickhouse(df_clean),
-                self._store_postgres(df_clean),
-                self._store_s3_parquet(df_clean),
-                self._update_redis_cache(df_clean)
-            ]
-            
-            await asyncio.gather(*storage_tasks)
+            # 5. Almacenamiento: cada sink escribe desde su propia cola, sin esperar al más lento
+            for sink, queue in self.sink_queues.items():
+                self.checkpoints.watch(batch_id, sink, await queue.submit(df_clean))
             
             return {
-                'chunk_size': len(chunk),
+                'chunk_size': chunk.height,
                 'aggregates': aggregates,
-                'anomalies': len(anomalies),
-                'storage_success': True
+                'anomalies': len(anomalies)
             }
             
         except Exception as e:
             self.logger.error(f"Error procesando chunk: {str(e)}")
             raise
     
-    async def _enrich_data(self, df: pl.DataFrame) -> pl.DataFrame:
-        """Enriquecer datos con información adicional"""
-        # Enriquecer con datos de usuario
-        user_ids = df['user_id'].unique().to_list()
+    def _transform_chunk(self, chunk: pl.DataFrame) -> pl.DataFrame:
+        """Etapas sin estado de un chunk (pool de CPU)"""
+        return self._clean_data(self._enrich_data(chunk))
+    
+    def _apply_operators(self, df: pl.DataFrame) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+        """Operadores con estado entre batches (pool de CPU, un chunk a la vez)"""
+        closed_sessions = self.sessionizer.update(df)
+        self.retention.update(df)
+        self.dashboard_sketches.update(df)
+        self._update_quantiles(closed_sessions)
+        aggregates = self._aggregate_events(df, closed_sessions)
+        anomalies = self._detect_anomalies(df, closed_sessions)
         
-        if self.redis_client:
-            # Buscar en caché primero
-            user_data = {}
-            for user_id in user_ids:
-                cached = self.redis_client.get(f"user:{user_id}")
-                if cached:
-                    user_data[user_id] = orjson.loads(cached)
-            
-            # Para usuarios no en caché, buscar en PostgreSQL
-            missing_ids = [uid for uid in user_ids if uid not in user_data]
-            
-            if missing_ids and self.postgres_pool:
-                query = text("""
-                    SELECT user_id, created_at, country, language, 
-                           subscription_tier, total_spent, retention_score
-                    FROM users 
-                    WHERE user_id = ANY(:user_ids)
-                """)
-                
-                with self.postgres_pool.connect() as conn:
-                    result = conn.execute(query, {'user_ids': missing_ids})
-                    for row in result:
-                        user_data[row.user_id] = dict(row)
-                        
-                        # Almacenar en caché
-                        self.redis_client.setex(
-                            f"user:{row.user_id}",
-                            self.cache_ttl,
-                            orjson.dumps(dict(row))
-                        )
-            
-            # Añadir datos enriquecidos al DataFrame
-            if user_data:
-                df = df.with_columns([
-                    pl.lit(user_data.get(row['user_id'], {})).alias('user_data')
-                    for row in df.iter_rows(named=True)
-                ])
+        # Timelines en memoria: solo los usuarios ya cacheados (el resto se lee de Redis)
+        cached_users = self.timelines.cached_users()
+        if cached_users:
+            hot = df.filter(pl.col('user_id').is_in(cached_users))
+            if hot.height:
+                self.timelines.append(UserTimelineStore.encode(self._storage_frame(hot)))
+        
+        if self.journey_maps.update(closed_sessions):
+            self._journey_map_dirty = True
+        if self._journey_map_dirty and time.monotonic() - self._journey_map_refreshed_at >= \
+                self.config.get('journey_refresh_seconds', 5):
+            self._materialize_journey_map()
+        
+        return aggregates, anomalies
+    
+    def _update_quantiles(self, closed_sessions: pl.DataFrame):
+        """Duración de las sesiones cerradas (por su fin) e intervalos entre eventos del batch"""
+        self.quantile_sketches.update('session_duration_seconds', closed_sessions.select(
+            (pl.col('session_end').dt.epoch('us') / 1_000_000).alias('ts'),
+            'platform',
+            pl.col('duration_seconds').alias('value')
+        ))
+        self.quantile_sketches.update('inter_event_seconds', self.sessionizer.last_gaps.rename({'gap': 'value'}))
+    
+    def _observe_stage(self, stage: str, started_at: float):
+        self.quantile_sketches.observe(f"stage_latency_seconds:{stage}", time.monotonic() - started_at)
+    
+    def _observe_sink_flush(self, sink: str, seconds: float):
+        self.quantile_sketches.observe(f"stage_latency_seconds:sink_{sink}", seconds)
+    
+    def _materialize_journey_map(self):
+        """Recalcular el journey map agregado que sirve /journey/aggregate (se reemplaza entero)"""
+        # Antes del summary: un batch que se aplique mientras tanto lo vuelve a marcar
+        self._journey_map_dirty = False
+        summary = self.journey_maps.summary(
+            self.config.get('journey_top_paths', 20),
+            min_frequency=self.config.get('journey_min_frequency', 5)
+        )
+        journey_map = self._build_aggregate_journey_map(summary['top_paths'])
+        
+        # Abandonos sobre todas las sesiones de la ventana, no solo los recorridos del top
+        journey_map['dropoff_analysis'] = {
+            event: sessions for event, sessions in summary['ends_by_event'].items()
+            if event not in JOURNEY_COMPLETION_EVENTS
+        }
+        journey_map['step_dropoff'] = summary['step_dropoff']
+        journey_map['window'] = summary['window']
+        
+        self.aggregate_journey = journey_map
+        self._journey_map_refreshed_at = time.monotonic()
+    
+    async def _refresh_journey_map(self):
+        """Materializar los cambios pendientes aunque el stream se quede sin batches"""
+        interval = self.config.get('journey_refresh_seconds', 5)
+        while True:
+            await asyncio.sleep(interval)
+            if self._journey_map_dirty and time.monotonic() - self._journey_map_refreshed_at >= interval:
+                try:
+                    await self._run_cpu(self._materialize_journey_map)
+                except Exception as e:
+                    self.logger.warning(f"No se pudo recalcular el journey map: {str(e)}")
+    
+    def _enrich_data(self, df: pl.DataFrame) -> pl.DataFrame:
+        """Enriquecer datos con información adicional"""
+        # Enriquecer con datos de usuario: un join por batch, coste proporcional a usuarios únicos
+        user_ids = df['user_id'].drop_nulls().unique().to_list()
+        profiles = self._lookup_user_profiles(user_ids)
+        df = df.join(profiles, on='user_id', how='left')
         
-        # Enriquecer con datos geográficos
+        # Enriquecer con datos geográficos desde el índice local
         if 'location' in df.columns:
-            df = df.with_columns([
-                pl.col('location').map_elements(
-                    lambda x: self._geocode_location(json.loads(x) if isinstance(x, str) else x),
-                    return_dtype=pl.Object
-                ).alias('location_enriched')
-            ])
+            if self.geo_index:
+                df = self.geo_index.enrich(df)
+            else:
+                df = df.with_columns(location_struct_expr())
         
         return df
     
-    async def _clean_data(self, df: pl.DataFrame) -> pl.DataFrame:
+    def _lookup_user_profiles(self, user_ids: List[str]) -> pl.DataFrame:
+        """Perfiles de usuario: un MGET a Redis y una sola query ANY() para los fallos"""
+        rows = []
+        missing_ids = user_ids
+        
+        if self.redis_client and user_ids:
+            cached = self.redis_client.mget([f"user:{user_id}" for user_id in user_ids])
+            missing_ids = []
+            for user_id, value in zip(user_ids, cached):
+                if value:
+                    rows.append(orjson.loads(value))
+                else:
+                    missing_ids.append(user_id)
+        
+        if missing_ids and self.postgres_pool:
+            query = text("""
+                SELECT user_id, created_at, country, language, 
+                       subscription_tier, total_spent, retention_score
+                FROM users 
+                WHERE user_id = ANY(:user_ids)
+            """)
+            
+            with self.postgres_pool.connect() as conn:
+                fetched = [dict(row._mapping) for row in conn.execute(query, {'user_ids': missing_ids})]
+            
+            rows.extend(fetched)
+            
+            # Almacenar en caché en un solo round trip
+            if self.redis_client and fetched:
+                pipeline = self.redis_client.pipeline(transaction=False)
+                for row in fetched:
+                    pipeline.setex(
+                        f"user:{row['user_id']}",
+                        self.cache_ttl,
+                        orjson.dumps(row, default=float)  # numeric de Postgres llega como Decimal
+                    )
+                pipeline.execute()
+        
+        return pl.DataFrame(
+            [{column: row.get(column) for column in USER_PROFILE_SCHEMA} for row in rows],
+            schema=USER_PROFILE_SCHEMA,
+            strict=False
+        ).unique(subset=['user_id'], keep='first')
+    
+    def _clean_data(self, df: pl.DataFrame) -> pl.DataFrame:
         """Limpiar y validar datos"""
         # Eliminar eventos duplicados
         df = df.unique(subset=['event_id'], keep='first')
@@ -514,30 +3914,25 @@ class UserJourneyPipeline30X:
         max_future_time = current_time + timedelta(hours=24)
         
         df = df.filter(
-            pl.col('timestamp') >= (current_time - timedelta(days=30)) &
-            pl.col('timestamp') <= max_future_time
+            (pl.col('timestamp') >= (current_time - timedelta(days=30))) &
+            (pl.col('timestamp') <= max_future_time)
         )
         
         # Validar user_id y session_id
         df = df.filter(
             pl.col('user_id').is_not_null() &
             pl.col('session_id').is_not_null() &
-            (pl.col('user_id').str.lengths() > 0) &
-            (pl.col('session_id').str.lengths() > 0)
+            (pl.col('user_id').str.len_chars() > 0) &
+            (pl.col('session_id').str.len_chars() > 0)
         )
         
         # Sanitizar propiedades
         if 'properties' in df.columns:
-            df = df.with_columns([
-                pl.col('properties').map_elements(
-                    lambda x: self._sanitize_properties(json.loads(x) if isinstance(x, str) else x),
-                    return_dtype=pl.Object
-                ).alias('properties_sanitized')
-            ])
+            df = df.with_columns(self._sanitize_properties(df['properties']))
         
         return df
     
-    async def _aggregate_events(self, df: pl.DataFrame) -> Dict[str, Any]:
+    def _aggregate_events(self, df: pl.DataFrame, closed_sessions: pl.DataFrame) -> Dict[str, Any]:
         """Agregar eventos para análisis"""
         if df.height == 0:
             return {}
@@ -547,37 +3942,23 @@ class UserJourneyPipeline30X:
             'total_events': df.height,
             'unique_users': df['user_id'].n_unique(),
             'unique_sessions': df['session_id'].n_unique(),
-            'events_by_type': df.groupby('event_type').agg(pl.count()).to_dicts(),
-            'events_by_platform': df.groupby('platform').agg(pl.count()).to_dicts(),
-            'events_over_time': df.groupby(
+            'events_by_type': df.group_by('event_type').agg(pl.len().alias('count')).to_dicts(),
+            'events_by_platform': df.group_by('platform').agg(pl.len().alias('count')).to_dicts(),
+            'events_over_time': df.group_by(
                 pl.col('timestamp').dt.truncate('1h')
-            ).agg(pl.count()).sort('timestamp').to_dicts(),
-            'session_duration_stats': self._calculate_session_duration(df),
-            'funnel_conversion': await self._calculate_funnel_conversion(df)
+            ).agg(pl.len().alias('count')).sort('timestamp').to_dicts(),
+            'session_duration_stats': self._calculate_session_duration(closed_sessions),
+            'open_sessions': self.sessionizer.open_sessions,
+            'funnel_conversion': self._calculate_funnel_conversion(df)
         }
         
-        # Actualizar métricas en tiempo real
-        await self._update_realtime_metrics(aggregates)
-        
         return aggregates
     
-    def _calculate_session_duration(self, df: pl.DataFrame) -> Dict[str, float]:
-        """Calcular duración de sesiones"""
-        if 'session_id' not in df.columns or 'timestamp' not in df.columns:
-            return {}
-        
-        session_stats = df.groupby('session_id').agg([
-            pl.col('timestamp').min().alias('session_start'),
-            pl.col('timestamp').max().alias('session_end')
-        ])
-        
+    def _calculate_session_duration(self, session_stats: pl.DataFrame) -> Dict[str, float]:
+        """Calcular duración de las sesiones cerradas por el sessionizer"""
         if session_stats.height == 0:
             return {}
         
-        session_stats = session_stats.with_columns([
-            (pl.col('session_end') - pl.col('session_start')).dt.seconds().alias('duration_seconds')
-        ])
-        
         return {
             'avg_duration': session_stats['duration_seconds'].mean(),
             'median_duration': session_stats['duration_seconds'].median(),
@@ -586,67 +3967,25 @@ class UserJourneyPipeline30X:
             'total_sessions': session_stats.height
         }
     
-    async def _calculate_funnel_conversion(self, df: pl.DataFrame) -> Dict[str, float]:
-        """Calcular conversión de funnel"""
-        # Definir funnel stages
-        funnel_stages = ['app_open', 'signup_view', 'signup_submit', 'onboarding_complete', 'first_action']
-        
-        # Encontrar eventos de funnel por usuario
-        funnel_events = df.filter(
-            pl.col('event_name').is_in(funnel_stages)
-        )
-        
-        if funnel_events.height == 0:
+    def _calculate_funnel_conversion(self, df: pl.DataFrame) -> Dict[str, Dict[str, float]]:
+        """Actualizar los funnels con el batch y devolver la conversión acumulada"""
+        if 'event_name' not in df.columns:
             return {}
         
-        # Contar usuarios en cada etapa
-        funnel_counts = {}
-        for i, stage in enumerate(funnel_stages):
-            stage_users = funnel_events.filter(
-                pl.col('event_name') == stage
-            )['user_id'].unique()
-            
-            funnel_counts[stage] = stage_users.height
-            
-            # Calcular conversión desde etapa anterior
-            if i > 0:
-                prev_stage = funnel_stages[i-1]
-                prev_count = funnel_counts.get(prev_stage, 0)
-                if prev_count > 0:
-                    conversion_rate = funnel_counts[stage] / prev_count * 100
-                    funnel_counts[f'{prev_stage}_to_{stage}_conversion'] = conversion_rate
+        for tracker in self.funnels.values():
+            tracker.update(df)
         
-        return funnel_counts
+        return {name: tracker.metrics() for name, tracker in self.funnels.items()}
     
-    async def _detect_anomalies(self, df: pl.DataFrame) -> List[Dict[str, Any]]:
+    def _detect_anomalies(self, df: pl.DataFrame, closed_sessions: pl.DataFrame) -> List[Dict[str, Any]]:
         """Detectar anomalías en eventos"""
         anomalies = []
         
-        # Detectar spikes en actividad
-        activity_by_minute = df.groupby(
-            pl.col('timestamp').dt.truncate('1min')
-        ).agg(pl.count().alias('event_count'))
-        
-        if activity_by_minute.height > 10:
-            mean = activity_by_minute['event_count'].mean()
-            std = activity_by_minute['event_count'].std()
-            
-            spike_threshold = mean + (3 * std)
-            spikes = activity_by_minute.filter(
-                pl.col('event_count') > spike_threshold
-            )
-            
-            for spike in spikes.iter_rows(named=True):
-                anomalies.append({
-                    'type': 'activity_spike',
-                    'timestamp': spike['timestamp'],
-                    'event_count': spike['event_count'],
-                    'threshold': spike_threshold,
-                    'severity': 'high'
-                })
+        # Spikes por serie y usuarios erráticos contra el estado acumulado entre batches
+        anomalies.extend(self.anomaly_detector.update(df))
         
         # Detectar sesiones anormalmente largas
-        session_durations = self._calculate_session_duration(df)
+        session_durations = self._calculate_session_duration(closed_sessions)
         if session_durations and 'max_duration' in session_durations:
             max_duration = session_durations['max_duration']
             if max_duration > 3600:  # Más de 1 hora
@@ -657,27 +3996,34 @@ class UserJourneyPipeline30X:
                     'severity': 'medium'
                 })
         
-        # Detectar usuarios con comportamiento errático
-        user_events = df.groupby('user_id').agg([
-            pl.count().alias('event_count'),
-            pl.col('event_type').n_unique().alias('unique_event_types')
-        ])
-        
-        erratic_users = user_events.filter(
-            (pl.col('event_count') > 1000) &  # Muchos eventos
-            (pl.col('unique_event_types') < 3)  # Pocos tipos diferentes
-        )
+        return anomalies
+    
+    @staticmethod
+    def _storage_frame(df: pl.DataFrame) -> pl.DataFrame:
+        """Columnas de almacenamiento con los campos anidados serializados a JSON"""
+        properties = 'properties_sanitized' if 'properties_sanitized' in df.columns else 'properties'
         
-        for user in erratic_users.iter_rows(named=True):
-            anomalies.append({
-                'type': 'erratic_behavior',
-                'user_id': user['user_id'],
-                'event_count': user['event_count'],
-                'unique_event_types': user['unique_event_types'],
-                'severity': 'low'
-            })
+        def json_column(name: str) -> pl.Expr:
+            column = pl.col(name)
+            if df.schema[name] == pl.Utf8:
+                return column
+            return pl.when(column.is_not_null()).then(column.struct.json_encode())
         
-        return anomalies
+        return df.select(
+            'event_id', 'user_id', 'session_id', 'event_type', 'event_name',
+            'timestamp', 'platform',
+            json_column('device_info').alias('device_info'),
+            json_column('location').alias('location'),
+            json_column(properties).alias('properties'),
+            'app_version'
+        )
+    
+    @staticmethod
+    def _clickhouse_table(frame: pl.DataFrame) -> pa.Table:
+        """Tabla Arrow para insert columnar (large_string: compatible con el formato Arrow de ClickHouse)"""
+        return frame.with_columns(
+            pl.lit(datetime.now()).cast(pl.Datetime('us')).alias('processing_time')
+        ).to_arrow(compat_level=pl.CompatLevel.oldest())
     
     async def _store_clickhouse(self, df: pl.DataFrame):
         """Almacenar en ClickHouse para queries en tiempo real"""
@@ -685,37 +4031,22 @@ class UserJourneyPipeline30X:
             return
         
         try:
-            # Convertir a formato de ClickHouse
-            data = []
-            for row in df.iter_rows(named=True):
-                data.append({
-                    'event_id': row['event_id'],
-                    'user_id': row['user_id'],
-                    'session_id': row['session_id'],
-                    'event_type': row['event_type'],
-                    'event_name': row['event_name'],
-                    'timestamp': row['timestamp'].isoformat() if hasattr(row['timestamp'], 'isoformat') else row['timestamp'],
-                    'platform': row['platform'],
-                    'device_info': json.dumps(row.get('device_info', {})),
-                    'location': json.dumps(row.get('location', {})),
-                    'properties': json.dumps(row.get('properties_sanitized', row.get('properties', {}))),
-                    'app_version': row['app_version'],
-                    'processing_time': datetime.now().isoformat()
-                })
+            # Insert columnar: ClickHouse convierte los tipos Arrow en el servidor
+            table = self._clickhouse_table(self._storage_frame(df))
             
-            # Insertar en batch
-            self.clickhouse_client.insert(
-                'user_journey_events',
-                data,
-                column_names=['event_id', 'user_id', 'session_id', 'event_type', 'event_name', 
-                            'timestamp', 'platform', 'device_info', 'location', 'properties', 
-                            'app_version', 'processing_time']
+            settings = None
+            if self.config.get('clickhouse_async_insert', True):
+                settings = {'async_insert': 1, 'wait_for_async_insert': 1}
+            
+            await asyncio.to_thread(
+                self.clickhouse_client.insert_arrow, 'user_journey_events', table, settings=settings
             )
             
-            self.logger.debug(f"✅ {len(data)} eventos almacenados en ClickHouse")
+            self.logger.debug(f"✅ {table.num_rows} eventos almacenados en ClickHouse")
             
         except Exception as e:
             self.logger.error(f"Error almacenando en ClickHouse: {str(e)}")
+            raise
     
     async def _store_postgres(self, df: pl.DataFrame):
         """Almacenar en PostgreSQL para análisis detallado"""
@@ -723,74 +4054,84 @@ class UserJourneyPipeline30X:
             return
         
         try:
-            # Usar COPY para inserción masiva ultra rápida
-            with self.postgres_pool.connect() as conn:
-                # Crear tabla temporal
-                conn.execute(text("""
+            start_time = time.time()
+            frame = self._storage_frame(df)
+            
+            # COPY bloqueante en un hilo: los workers del sink escriben en paralelo
+            await asyncio.to_thread(self._copy_to_postgres, frame)
+            
+            rows_per_second = frame.height / max(time.time() - start_time, 1e-6)
+            POSTGRES_ROWS_PER_SECOND.set(rows_per_second)
+            
+            self.logger.debug(
+                f"✅ {df.height} eventos almacenados en PostgreSQL ({rows_per_second:.0f} filas/segundo)"
+            )
+            
+        except Exception as e:
+            self.logger.error(f"Error almacenando en PostgreSQL: {str(e)}")
+            self.stats['errors'] += 1
+            raise
+    
+    def _copy_to_postgres(self, frame: pl.DataFrame):
+        """COPY FROM STDIN a una tabla temporal y upsert en bloque, en una transacción"""
+        columns = ', '.join(f'"{column}"' for column in frame.columns)
+        batch_size = self.config.get('postgres_copy_batch_size', 50000)
+        
+        # COPY FROM STDIN sobre la conexión psycopg2 subyacente
+        connection = self.postgres_pool.raw_connection()
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("""
                     CREATE TEMP TABLE temp_journey_events (
                         LIKE user_journey_events INCLUDING DEFAULTS
                     ) ON COMMIT DROP
-                """))
+                """)
                 
-                # Insertar datos en tabla temporal
-                for row in df.iter_rows(named=True):
-                    conn.execute(text("""
-                        INSERT INTO temp_journey_events 
-                        (event_id, user_id, session_id, event_type, event_name, 
-                         timestamp, platform, device_info, location, properties, app_version)
-                        VALUES (:event_id, :user_id, :session_id, :event_type, :event_name,
-                                :timestamp, :platform, :device_info, :location, :properties, :app_version)
-                    """), row)
+                # Un COPY por bloque desde un buffer CSV en memoria
+                for offset in range(0, frame.height, batch_size):
+                    buffer = io.BytesIO()
+                    frame.slice(offset, batch_size).write_csv(buffer, include_header=False)
+                    buffer.seek(0)
+                    cursor.copy_expert(
+                        f"COPY temp_journey_events ({columns}) FROM STDIN WITH (FORMAT csv)",
+                        buffer
+                    )
                 
-                # Copiar a tabla principal
-                conn.execute(text("""
-                    INSERT INTO user_journey_events 
-                    SELECT * FROM temp_journey_events
+                # Upsert en bloque a la tabla principal
+                cursor.execute(f"""
+                    INSERT INTO user_journey_events ({columns})
+                    SELECT {columns} FROM temp_journey_events
                     ON CONFLICT (event_id) DO NOTHING
-                """))
-                
-                conn.commit()
-            
-            self.logger.debug(f"✅ {df.height} eventos almacenados en PostgreSQL")
+                """)
             
-        except Exception as e:
-            self.logger.error(f"Error almacenando en PostgreSQL: {str(e)}")
-            self.stats['errors'] += 1
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection.close()
     
-    async def _store_s3_parquet(self, df: pl.DataFrame):
-        """Almacenar en S3 como Parquet para data lake"""
-        if not self.s3_client or df.height == 0:
+    async def _store_lake_parquet(self, df: pl.DataFrame):
+        """Almacenar en el data lake como Parquet particionado (S3 o filesystem local)"""
+        if not self.lake_writer or df.height == 0:
             return
         
-        try:
-            # Convertir a PyArrow Table
-            table = df.to_arrow()
-            
-            # Escribir a buffer Parquet con compresión
-            buffer = pa.BufferOutputStream()
-            pq.write_table(
-                table,
-                buffer,
-                compression='snappy',
-                use_dictionary=True,
-                data_page_version='2.0'
-            )
-            
-            # Subir a S3
-            date_str = datetime.now().strftime('%Y/%m/%d/%H')
-            s3_key = f"user-journey/events/{date_str}/events_{datetime.now().timestamp()}.parquet"
-            
-            self.s3_client.put_object(
-                Bucket=self.config.get('s3_bucket', 'petmatch-data-lake'),
-                Key=s3_key,
-                Body=buffer.getvalue().to_pybytes(),
-                ContentType='application/parquet'
+        # Una vez en el buffer las filas no se vuelven a añadir: un reintento del sink
+        # duplicaría las particiones que sí se escribieron. La cola del lake tiene un solo
+        # worker y reintenta con el mismo chunk
+        if df is not self._lake_unflushed:
+            await asyncio.to_thread(self.lake_writer.append, self._storage_frame(df))
+            self._lake_unflushed = df
+        
+        # Si el flush falla las particiones siguen en el buffer y el error llega a la cola
+        # (reintento) y al checkpoint, que no se completa mientras falle
+        files = await asyncio.to_thread(self.lake_writer.flush_due)
+        self._lake_unflushed = None
+        
+        for committed in files:
+            self.logger.debug(
+                f"✅ {committed['rows']} eventos almacenados en el lake: {committed['path']}"
             )
-            
-            self.logger.debug(f"✅ {df.height} eventos almacenados en S3: {s3_key}")
-            
-        except Exception as e:
-            self.logger.error(f"Error almacenando en S3: {str(e)}")
     
     async def _update_redis_cache(self, df: pl.DataFrame):
         """Actualizar caché Redis con métricas en tiempo real"""
@@ -799,7 +4140,7 @@ class UserJourneyPipeline30X:
         
         try:
             # Actualizar contadores de usuario
-            user_events = df.groupby('user_id').agg(pl.count().alias('event_count'))
+            user_events = df.group_by('user_id').agg(pl.len().alias('event_count'))
             
             pipeline = self.redis_client.pipeline()
             for row in user_events.iter_rows(named=True):
@@ -817,82 +4158,141 @@ class UserJourneyPipeline30X:
             pipeline.hincrby('realtime_metrics', current_minute, total_events)
             pipeline.expire('realtime_metrics', 3600)
             
-            pipeline.execute()
+            # Timelines por usuario para /journey/{user_id}
+            self.timelines.redis_append(pipeline, UserTimelineStore.encode(self._storage_frame(df)))
+            
+            await asyncio.to_thread(pipeline.execute)
             
         except Exception as e:
             self.logger.error(f"Error actualizando Redis cache: {str(e)}")
+            raise
     
     async def _update_realtime_metrics(self, aggregates: Dict[str, Any]):
-        """Actualizar métricas en tiempo real para dashboards"""
-        if not self.redis_client:
+        """Publicar los sketches del dashboard y de cuantiles (como mucho cada dashboard_publish_seconds)"""
+        if not self.redis_client or not aggregates:
+            return
+        
+        now = time.monotonic()
+        if now - self._dashboard_published_at < self.config.get('dashboard_publish_seconds', 5):
             return
+        self._dashboard_published_at = now
         
         try:
-            timestamp = datetime.now().isoformat()
-            
-            metrics_key = f"dashboard_metrics:{timestamp[:13]}"  # Por hora
-            
-            self.redis_client.hset(
-                metrics_key,
-                mapping={
-                    'total_events': aggregates.get('total_events', 0),
-                    'unique_users': aggregates.get('unique_users', 0),
-                    'unique_sessions': aggregates.get('unique_sessions', 0),
-                    'timestamp': timestamp
-                }
-            )
-            
-            self.redis_client.expire(metrics_key, 7200)  # 2 horas
-            
+            await asyncio.to_thread(self._publish_dashboard_sketches)
         except Exception as e:
             self.logger.error(f"Error actualizando métricas: {str(e)}")
     
-    def _geocode_location(self, location: Dict) -> Dict:
-        """Enriquecer ubicación con datos geográficos"""
-        if not location:
+    def _publish_dashboard_sketches(self):
+        """
+        Publicar los parciales de este worker (dashboard y cuantiles) y recalcular
+        `dashboard_metrics:{periodo}` combinando los parciales de todos los workers
+        """
+        self._publish_partials('quantile_sketch', self.quantile_sketches)
+        published = self._publish_partials('dashboard_sketch', self.dashboard_sketches)
+        if not published:
+            return
+        
+        try:
+            timestamp = datetime.now().isoformat()
+            pipeline = self.redis_client.pipeline(transaction=False)
+            for key, workers in published.items():
+                summary = DashboardSketches.merge_payloads(list(workers.values())).summary()
+                metrics_key = f"dashboard_metrics:{PeriodSketches.label(*key)}"
+                pipeline.hset(
+                    metrics_key,
+                    mapping={
+                        'total_events': summary['total_events'],
+                        'unique_users': summary['unique_users'],
+                        'unique_sessions': summary['unique_sessions'],
+                        'top_event_names': orjson.dumps(summary['top_event_names']),
+                        'top_users': orjson.dumps(summary['top_users']),
+                        'workers': len(workers),
+                        'timestamp': timestamp
+                    }
+                )
+                pipeline.expire(metrics_key, self.dashboard_sketches.ttl(key[0]))
+            pipeline.execute()
+            
+        except Exception:
+            self.dashboard_sketches.mark_dirty(published)
+            raise
+    
+    def _publish_partials(self, prefix: str, store: PeriodSketches) -> Dict[Tuple[str, int], Dict[bytes, bytes]]:
+        """
+        Escribir el parcial de este worker de cada bucket modificado en `{prefix}:{periodo}`
+        (un campo por worker); devuelve los parciales de todos los workers
+        """
+        dirty = store.take_dirty()
+        if not dirty:
             return {}
         
-        # En producción, usar servicio de geocoding como Google Maps o Mapbox
-        enriched = location.copy()
+        try:
+            keys = list(dirty)
+            pipeline = self.redis_client.pipeline(transaction=False)
+            for key in keys:
+                sketch_key = f"{prefix}:{PeriodSketches.label(*key)}"
+                pipeline.hset(sketch_key, store.worker_id, dirty[key])
+                pipeline.expire(sketch_key, store.ttl(key[0]))
+                pipeline.hgetall(sketch_key)
+            return dict(zip(keys, pipeline.execute()[2::3]))
+            
+        except Exception:
+            # Se vuelven a publicar en la siguiente pasada
+            store.mark_dirty(dirty)
+            raise
+    
+    def _sanitize_properties(self, properties: pl.Series) -> pl.Series:
+        """
+        Sanitizar propiedades en columnar: las claves sensibles se descartan una vez por
+        esquema (no por fila), los strings largos se truncan y los valores anidados se
+        serializan a JSON. Devuelve el struct tipado `properties_sanitized`.
+        """
+        if properties.dtype == pl.Utf8:
+            # Camino de fallback del decoder: parsear todo el batch de una sola vez (las
+            # filas nulas siguen nulas)
+            properties = properties.str.json_decode(infer_schema_length=None)
         
-        # Simulación de enriquecimiento
-        if 'city' in location and 'country' in location:
-            enriched['region'] = "North America"  # Esto vendría de una base de datos
-            enriched['timezone'] = "America/New_York"
-            enriched['coordinates'] = {
-                'lat': 40.7128,
-                'lon': -74.0060
-            }
+        if not isinstance(properties.dtype, pl.Struct):
+            return pl.Series('properties_sanitized', [None] * properties.len(), dtype=pl.Struct([]))
         
-        return enriched
-    
-    def _sanitize_properties(self, properties: Dict) -> Dict:
-        """Sanitizar propiedades del evento"""
-        if not properties:
-            return {}
+        kept = [
+            key for key in properties.dtype.fields
+            if not SENSITIVE_PROPERTY_KEY.search(key.name)
+        ]
         
-        sanitized = {}
+        if not kept:
+            return pl.Series('properties_sanitized', [None] * properties.len(), dtype=pl.Struct([]))
         
-        for key, value in properties.items():
-            # Eliminar datos sensibles
-            if any(sensitive in key.lower() for sensitive in ['password', 'token', 'secret', 'credit']):
-                continue
+        expressions = []
+        for key in kept:
+            value = pl.col('properties').struct.field(key.name)
             
-            # Limitar longitud de strings
-            if isinstance(value, str):
-                if len(value) > 1000:
-                    value = value[:1000] + "..."
+            if key.dtype == pl.Utf8:
+                # Limitar longitud de strings
+                value = pl.when(value.str.len_chars() > MAX_PROPERTY_LENGTH) \
+                    .then(value.str.slice(0, MAX_PROPERTY_LENGTH) + '...') \
+                    .otherwise(value)
+            elif isinstance(key.dtype, pl.Struct):
+                value = pl.when(value.is_not_null()).then(value.struct.json_encode())
+            elif isinstance(key.dtype, (pl.List, pl.Array)):
+                # Polars solo serializa structs a JSON; las listas son raras en properties
+                value = value.map_batches(self._json_encode_lists, return_dtype=pl.Utf8)
             
-            # Convertir tipos complejos a JSON string
-            if isinstance(value, (dict, list)):
-                try:
-                    value = json.dumps(value)
-                except:
-                    value = str(value)
-            
-            sanitized[key] = value
+            expressions.append(value.alias(key.name))
         
-        return sanitized
+        return properties.to_frame('properties').select(
+            pl.when(pl.col('properties').is_not_null())
+            .then(pl.struct(expressions))
+            .alias('properties_sanitized')
+        ).to_series()
+    
+    @staticmethod
+    def _json_encode_lists(values: pl.Series) -> pl.Series:
+        """Serializar una columna de listas a JSON, una fila a la vez (nulos se mantienen)"""
+        return pl.Series(
+            [None if value is None else orjson.dumps(value).decode() for value in values.to_list()],
+            dtype=pl.Utf8
+        )
     
     async def run_batch_processing(self, date_range: Tuple[datetime, datetime]):
         """
@@ -904,9 +4304,40 @@ class UserJourneyPipeline30X:
         
         try:
             # 1. Leer datos de S3/data lake
-            s3_path = f"s3://{self.config.get('s3_bucket')}/user-journey/events/"
-            if self.spark:
-                df = self.spark.read.parquet(s3_path)
+            lake_path = self._lake_uri()
+            if self.batch_engine == 'auto':
+                candidates = self._auto_batch_engines()
+            else:
+                candidates = [self.batch_engine]
+            
+            # En auto, si un motor distribuido no arranca se pasa al siguiente
+            for engine in candidates:
+                try:
+                    results = await self._run_batch_engine(engine, lake_path, date_range)
+                    break
+                except EngineUnavailableError as e:
+                    if engine == candidates[-1]:
+                        raise
+                    self.logger.warning(f"⚠️ {str(e)}, probando el siguiente motor")
+            
+            processing_time = time.time() - start_time
+            self.logger.info(f"✅ Batch processing ({engine}) completado en {processing_time:.2f}s")
+            
+            return results
+            
+        except Exception as e:
+            self.logger.error(f"Error en batch processing: {str(e)}", exc_info=True)
+            raise
+    
+    async def _run_batch_engine(self, engine: str, lake_path: str,
+                                date_range: Tuple[datetime, datetime]) -> Dict[str, Any]:
+        """Ejecutar el batch con un motor concreto"""
+        if engine == 'duckdb':
+            return await self._process_duckdb_batch(lake_path, date_range)
+        
+        if engine == 'spark':
+            async with self._engine_session('spark') as spark:
+                df = spark.read.parquet(lake_path)
                 
                 # Filtrar por rango de fechas
                 df = df.filter(
@@ -915,30 +4346,67 @@ class UserJourneyPipeline30X:
                 )
                 
                 # Procesar con Spark
-                results = await self._process_spark_batch(df)
-                
-            elif self.dask_client:
-                # Usar Dask para procesamiento paralelo
-                df = dd.read_parquet(s3_path)
+                return await self._process_spark_batch(spark, df)
+        
+        if engine == 'dask':
+            import dask.dataframe as dd
+            
+            # Usar Dask para procesamiento paralelo
+            async with self._engine_session('dask'):
+                df = dd.read_parquet(lake_path)
                 df = df[(df.timestamp >= date_range[0]) & (df.timestamp <= date_range[1])]
                 
-                results = await self._process_dask_batch(df)
-            
-            else:
-                # Procesamiento local con Polars
-                # Nota: Para terabytes, necesitarías un enfoque chunked
-                results = await self._process_local_batch(s3_path, date_range)
-            
-            processing_time = time.time() - start_time
-            self.logger.info(f"✅ Batch processing completado en {processing_time:.2f}s")
-            
-            return results
-            
+                return await self._process_dask_batch(df)
+        
+        if engine == 'polars':
+            # Procesamiento local con Polars en modo streaming (memoria acotada)
+            return await self._process_local_batch(lake_path, date_range)
+        
+        raise ValueError(f"batch_engine desconocido: {engine} (auto, spark, dask, polars o duckdb)")
+    
+    @asynccontextmanager
+    async def _engine_session(self, name: str):
+        """Sesión sobre un motor registrado; EngineUnavailableError si falta o no arranca"""
+        engine = self.engines.get(name)
+        if engine is None:
+            raise EngineUnavailableError(
+                f"Motor {name} no registrado (config['engines']: {', '.join(self.engines) or 'ninguno'})"
+            )
+        
+        try:
+            handle = await engine.acquire()
         except Exception as e:
-            self.logger.error(f"Error en batch processing: {str(e)}", exc_info=True)
-            raise
+            raise EngineUnavailableError(f"{name} no arrancó: {str(e)}") from e
+        
+        try:
+            yield handle
+        finally:
+            engine.release()
+    
+    def _auto_batch_engines(self) -> List[str]:
+        """
+        Motores candidatos para batch_engine='auto': Spark > Dask > Polars local.
+        Solo se comprueba que estén registrados e instalados (Spark necesita además
+        Java), sin arrancar la JVM ni el cluster. DuckDB no entra en auto: se elige
+        explícitamente con batch_engine='duckdb'.
+        """
+        candidates = []
+        if 'spark' in self.engines and self._importable('pyspark') and \
+                (shutil.which('java') or os.environ.get('JAVA_HOME')):
+            candidates.append('spark')
+        if 'dask' in self.engines and self._importable('dask.distributed'):
+            candidates.append('dask')
+        candidates.append('polars')
+        return candidates
     
-    async def _process_spark_batch(self, df) -> Dict[str, Any]:
+    @staticmethod
+    def _importable(module: str) -> bool:
+        try:
+            return importlib.util.find_spec(module) is not None
+        except ModuleNotFoundError:
+            return False
+    
+    async def _process_spark_batch(self, spark, df) -> Dict[str, Any]:
         """Procesar batch con Spark"""
         # Registrar DataFrame como tabla temporal
         df.createOrReplaceTempView("events")
@@ -975,8 +4443,8 @@ class UserJourneyPipeline30X:
         ORDER BY funnel_stage
         """
         
-        funnel_df = self.spark.sql(funnel_query)
-        results['funnel_analysis'] = funnel_df.collect()
+        funnel_df = spark.sql(funnel_query)
+        results['funnel_analysis'] = [row.asDict() for row in funnel_df.collect()]
         
         # Cohort analysis
         cohort_query = """
@@ -997,44 +4465,236 @@ class UserJourneyPipeline30X:
         ORDER BY signup_week DESC
         """
         
-        cohort_df = self.spark.sql(cohort_query)
-        results['cohort_analysis'] = cohort_df.collect()
+        cohort_df = spark.sql(cohort_query)
+        results['cohort_analysis'] = [row.asDict() for row in cohort_df.collect()]
         
         return results
     
-    def generate_journey_map(self, user_id: Optional[str] = None) -> Dict[str, Any]:
+    async def _process_dask_batch(self, df) -> Dict[str, Any]:
+        """
+        Procesar batch con Dask.
+        Los conteos por etapa y el primer/último evento de cada usuario se reducen en
+        el cluster en un solo compute; las cohortes se agregan en local con Polars
+        sobre esa tabla por usuario. Devuelve la misma estructura que _process_spark_batch.
+        """
+        import dask
+        
+        df = df[['user_id', 'event_name', 'timestamp']]
+        per_stage = df[df.event_name.isin(FUNNEL_STAGES)].groupby('event_name').user_id
+        per_user = df.groupby('user_id').timestamp
+        
+        # Bloqueante: fuera del event loop
+        total_events, stage_users, stage_events, first_seen, last_seen = await asyncio.to_thread(
+            dask.compute, df.shape[0], per_stage.nunique(), per_stage.count(), per_user.min(), per_user.max()
+        )
+        
+        funnel = pl.from_pandas(
+            pd.concat({'users': stage_users, 'events': stage_events}, axis=1).rename_axis('event_name').reset_index()
+        ).select(self._funnel_stage(), 'users', 'events').sort('funnel_stage')
+        
+        per_user = pl.from_pandas(
+            pd.concat({'first_seen': first_seen, 'last_seen': last_seen}, axis=1).rename_axis('user_id').reset_index()
+        )
+        
+        return {
+            'total_events': int(total_events),
+            'unique_users': per_user.height,
+            'funnel_analysis': funnel.to_dicts(),
+            'cohort_analysis': self._cohort_analysis(per_user.lazy()).collect().to_dicts()
+        }
+    
+    def _lake_uri(self) -> str:
+        """Raíz del data lake de eventos"""
+        if self.lake_writer:
+            return self.lake_writer.uri()
+        return f"s3://{self.config.get('s3_bucket')}/user-journey/events"
+    
+    def _lake_storage_options(self, lake_path: str) -> Optional[Dict[str, str]]:
+        """Credenciales para leer el lake desde S3 con Polars"""
+        if not lake_path.startswith('s3://'):
+            return None
+        
+        return {
+            'aws_access_key_id': self.config.get('aws_access_key'),
+            'aws_secret_access_key': self.config.get('aws_secret_key'),
+            'aws_region': self.config.get('aws_region', 'us-east-1')
+        }
+    
+    def _duckdb_connect(self, lake_path: str) -> duckdb.DuckDBPyConnection:
+        """Conexión DuckDB en memoria con spill a disco y acceso al lake"""
+        spill_dir = self.config.get('duckdb_temp_directory', os.path.join(os.getcwd(), 'duckdb-spill'))
+        os.makedirs(spill_dir, exist_ok=True)
+        
+        conn = duckdb.connect(config={
+            'threads': self.config.get('duckdb_threads', mp.cpu_count()),
+            'memory_limit': self.config.get('duckdb_memory_limit', '8GB'),
+            'temp_directory': spill_dir,
+            'preserve_insertion_order': False
+        })
+        
+        if lake_path.startswith('s3://'):
+            conn.execute("INSTALL httpfs")
+            conn.execute("LOAD httpfs")
+            conn.execute(
+                "CREATE SECRET lake (TYPE S3, KEY_ID ?, SECRET ?, REGION ?)",
+                [
+                    self.config.get('aws_access_key'),
+                    self.config.get('aws_secret_key'),
+                    self.config.get('aws_region', 'us-east-1')
+                ]
+            )
+        
+        return conn
+    
+    async def _process_duckdb_batch(self, lake_path: str, date_range: Tuple[datetime, datetime]) -> Dict[str, Any]:
         """
-        Generar mapa de viaje del usuario agregado o individual
+        Procesar batch con DuckDB directamente sobre el Parquet del lake.
+        Arranca en milisegundos, escanea en paralelo y hace spill a disco
+        cuando las agregaciones no caben en memory_limit.
+        Devuelve la misma estructura que _process_spark_batch.
         """
+        return await asyncio.to_thread(self._run_duckdb_batch, lake_path, date_range)
+    
+    def _run_duckdb_batch(self, lake_path: str, date_range: Tuple[datetime, datetime]) -> Dict[str, Any]:
+        start, end = date_range
+        conn = self._duckdb_connect(lake_path)
+        
         try:
-            if user_id:
-                # Viaje individual
-                if self.clickhouse_client:
-                    query = """
-                    SELECT 
-                        event_name,
-                        event_type,
-                        timestamp,
-                        properties,
-                        session_id
-                    FROM user_journey_events
-                    WHERE user_id = %(user_id)s
-                    ORDER BY timestamp
-                    LIMIT 1000
-                    """
-                    
-                    result = self.clickhouse_client.query(
-                        query,
-                        {'user_id': user_id}
-                    )
-                    
-                    events = result.result_rows
-                    
-                    # Construir journey
-                    journey = self._build_individual_journey(events)
-                    return journey
+            # Vista con poda de particiones date= y proyección mínima
+            conn.execute(f"""
+            CREATE TEMP VIEW events AS
+            SELECT user_id, event_name, timestamp
+            FROM read_parquet('{lake_path.rstrip('/')}/**/*.parquet', hive_partitioning = true)
+            WHERE date BETWEEN DATE '{start.date().isoformat()}' AND DATE '{end.date().isoformat()}'
+              AND timestamp BETWEEN TIMESTAMP '{start.isoformat(sep=' ')}' AND TIMESTAMP '{end.isoformat(sep=' ')}'
+            """)
+            
+            results = {}
+            
+            # Métricas básicas
+            results['total_events'], results['unique_users'] = conn.execute(
+                "SELECT COUNT(*), COUNT(DISTINCT user_id) FROM events"
+            ).fetchone()
+            
+            # Funnel analysis
+            stage_case = ' '.join(
+                f"WHEN '{stage}' THEN {i + 1}" for i, stage in enumerate(FUNNEL_STAGES)
+            )
+            stage_list = ', '.join(f"'{stage}'" for stage in FUNNEL_STAGES)
+            funnel = conn.execute(f"""
+            SELECT 
+                CAST(CASE event_name {stage_case} END AS INTEGER) as funnel_stage,
+                COUNT(DISTINCT user_id) as users,
+                COUNT(*) as events
+            FROM events
+            WHERE event_name IN ({stage_list})
+            GROUP BY funnel_stage
+            ORDER BY funnel_stage
+            """).fetch_arrow_table()
+            results['funnel_analysis'] = funnel.to_pylist()
+            
+            # Cohort analysis
+            cohort = conn.execute("""
+            SELECT 
+                DATE_TRUNC('week', first_seen) as signup_week,
+                COUNT(*) as signups,
+                AVG(retention_days) as avg_retention_days,
+                COUNT(*) FILTER (WHERE retention_days >= 7) * 100.0 / COUNT(*) as week1_retention
+            FROM (
+                SELECT 
+                    user_id,
+                    MIN(timestamp) as first_seen,
+                    FLOOR(EPOCH(MAX(timestamp) - MIN(timestamp)) / 86400) as retention_days
+                FROM events
+                GROUP BY user_id
+            )
+            GROUP BY signup_week
+            ORDER BY signup_week DESC
+            """).fetch_arrow_table()
+            results['cohort_analysis'] = cohort.to_pylist()
+            
+            return results
+        
+        finally:
+            conn.close()
+    
+    async def _process_local_batch(self, lake_path: str, date_range: Tuple[datetime, datetime]) -> Dict[str, Any]:
+        """
+        Procesar batch en un solo nodo con Polars lazy sobre el lake particionado.
+        Las particiones date= fuera del rango no se leen, los filtros y la proyección
+        se empujan al scan de Parquet y el motor streaming mantiene la memoria acotada.
+        Devuelve la misma estructura que _process_spark_batch.
+        """
+        start, end = date_range
+        
+        events = pl.scan_parquet(
+            f"{lake_path.rstrip('/')}/**/*.parquet",
+            hive_partitioning=True,
+            storage_options=self._lake_storage_options(lake_path)
+        ).filter(
+            pl.col('date').is_between(start.date(), end.date()) &
+            pl.col('timestamp').is_between(start, end)
+        ).select('user_id', 'event_name', 'timestamp')
+        
+        totals = events.select(
+            pl.len().alias('total_events'),
+            pl.col('user_id').n_unique().alias('unique_users')
+        )
+        
+        funnel = events.filter(
+            pl.col('event_name').is_in(FUNNEL_STAGES)
+        ).group_by(self._funnel_stage()).agg(
+            pl.col('user_id').n_unique().alias('users'),
+            pl.len().alias('events')
+        ).sort('funnel_stage')
+        
+        cohort = self._cohort_analysis(events.group_by('user_id').agg(
+            pl.col('timestamp').min().alias('first_seen'),
+            pl.col('timestamp').max().alias('last_seen')
+        ))
+        
+        # Fuera del event loop: el scan puede tardar minutos
+        totals, funnel, cohort = await asyncio.to_thread(
+            pl.collect_all, [totals, funnel, cohort], engine='streaming'
+        )
+        
+        return {
+            'total_events': totals['total_events'][0],
+            'unique_users': totals['unique_users'][0],
+            'funnel_analysis': funnel.to_dicts(),
+            'cohort_analysis': cohort.to_dicts()
+        }
+    
+    @staticmethod
+    def _funnel_stage() -> pl.Expr:
+        """Etapa del funnel (1..n) a partir de event_name"""
+        return pl.col('event_name').replace_strict(
+            {stage: i + 1 for i, stage in enumerate(FUNNEL_STAGES)}, return_dtype=pl.Int32
+        ).alias('funnel_stage')
+    
+    @staticmethod
+    def _cohort_analysis(per_user: pl.LazyFrame) -> pl.LazyFrame:
+        """Cohortes semanales a partir de first_seen/last_seen de cada usuario"""
+        return per_user.with_columns(
+            (pl.col('last_seen') - pl.col('first_seen')).dt.total_days().alias('retention_days')
+        ).group_by(
+            pl.col('first_seen').dt.truncate('1w').alias('signup_week')
+        ).agg(
+            pl.len().alias('signups'),
+            pl.col('retention_days').mean().alias('avg_retention_days'),
+            ((pl.col('retention_days') >= 7).sum() * 100.0 / pl.len()).alias('week1_retention')
+        ).sort('signup_week', descending=True)
+    
+    def generate_journey_map(self) -> Dict[str, Any]:
+        """
+        Generar mapa de viaje agregado. El journey de un usuario se sirve desde
+        get_user_journey (timelines en memoria, Redis y lake)
+        """
+        try:
+            # Journey agregado: materializado desde el stream; PostgreSQL solo en frío
+            if self.journey_maps.sessions:
+                return self.aggregate_journey
             
-            # Journey agregado
             if self.postgres_pool:
                 with self.postgres_pool.connect() as conn:
                     # Obtener secuencias comunes de eventos
@@ -1074,6 +4734,117 @@ class UserJourneyPipeline30X:
             self.logger.error(f"Error generando journey map: {str(e)}")
             return {}
     
+    def dashboard_metrics(self, period: str = 'hour', buckets: int = 24, k: int = 10) -> Dict[str, Any]:
+        """
+        Eventos, usuarios y sesiones distintos y top-k de los últimos `buckets` periodos
+        (hour o day). Con Redis se combinan los parciales de todos los workers; sin él,
+        solo los sketches de este proceso.
+        """
+        if period not in PeriodSketches.PERIOD_SECONDS:
+            raise ValueError(f"Periodo no soportado: {period}")
+        
+        # Mismo reloj naive que los timestamps de los eventos
+        newest = int((datetime.now() - UNIX_EPOCH).total_seconds()) // PeriodSketches.PERIOD_SECONDS[period]
+        indexes = list(range(newest - buckets + 1, newest + 1))
+        
+        if self.redis_client:
+            pipeline = self.redis_client.pipeline(transaction=False)
+            for index in indexes:
+                pipeline.hgetall(f"dashboard_sketch:{PeriodSketches.label(period, index)}")
+            merged = [DashboardSketches.merge_payloads(list(workers.values())) for workers in pipeline.execute()]
+            summaries = [bucket.summary(k) if bucket else None for bucket in merged]
+        else:
+            summaries = [self.dashboard_sketches.summary(period, index, k) for index in indexes]
+        
+        return {
+            'period': period,
+            'buckets': [
+                {'start': PeriodSketches.label(period, index), **summary}
+                for index, summary in zip(indexes, summaries) if summary
+            ]
+        }
+    
+    def quantile_metrics(self) -> Dict[str, Any]:
+        """
+        p50/p90/p99 por métrica y plataforma de la hora y el día en curso. Con Redis se
+        combinan los parciales de todos los workers; sin él, solo los de este proceso.
+        """
+        now = int((datetime.now() - UNIX_EPOCH).total_seconds())
+        keys = [(period, now // seconds) for period, seconds in PeriodSketches.PERIOD_SECONDS.items()]
+        
+        if self.redis_client:
+            pipeline = self.redis_client.pipeline(transaction=False)
+            for key in keys:
+                pipeline.hgetall(f"quantile_sketch:{PeriodSketches.label(*key)}")
+            merged = [QuantileSketches.merge_payloads(list(workers.values())) for workers in pipeline.execute()]
+            summaries = [bucket.summary() if bucket else {} for bucket in merged]
+        else:
+            summaries = [self.quantile_sketches.summary(*key) or {} for key in keys]
+        
+        return {
+            period: {'start': PeriodSketches.label(period, index), 'metrics': summary}
+            for (period, index), summary in zip(keys, summaries)
+        }
+    
+    def query_journey_paths(self, prefix: List[str], k: int = 10) -> Dict[str, Any]:
+        """Recorridos más frecuentes tras un prefijo, con abandono y conversión por paso"""
+        return self.journey_maps.query(prefix, k)
+    
+    async def get_user_journey(self, user_id: str, cursor: Optional[str] = None,
+                               limit: int = 100) -> Dict[str, Any]:
+        """
+        Journey de un usuario paginado por cursor (de más reciente a más antiguo).
+        Se sirve desde memoria si el usuario está caliente; si no desde Redis y, como
+        último recurso, desde los ficheros del lake.
+        """
+        timeline = self.timelines.get_local(user_id)
+        source = 'memory'
+        
+        if timeline is None and self.redis_client:
+            try:
+                timeline = await asyncio.to_thread(self.timelines.load_redis, user_id)
+                source = 'redis'
+            except Exception as e:
+                self.logger.warning(f"Timeline de Redis no disponible: {str(e)}")
+        
+        if not timeline:
+            timeline = await asyncio.to_thread(self._load_timeline_from_lake, user_id)
+            source = 'lake'
+        
+        if source != 'memory' and timeline:
+            self.timelines.put_local(user_id, timeline)
+        
+        page, next_cursor = UserTimelineStore.page(timeline, cursor, limit)
+        
+        journey = self._build_individual_journey([UserTimelineStore.decode(event) for _, _, event in page])
+        journey['user_id'] = user_id
+        journey['next_cursor'] = next_cursor
+        journey['source'] = source
+        return journey
+    
+    def _load_timeline_from_lake(self, user_id: str) -> list:
+        """
+        Últimos eventos del usuario desde el lake. Los ficheros están ordenados por
+        user_id con estadísticas por row group, así que el filtro descarta casi todo sin leerlo.
+        """
+        lake_path = self._lake_uri()
+        first_date = (datetime.now() - timedelta(days=self.config.get('timeline_lake_days', 7))).date()
+        
+        try:
+            frame = pl.scan_parquet(
+                f"{lake_path.rstrip('/')}/**/*.parquet",
+                hive_partitioning=True,
+                storage_options=self._lake_storage_options(lake_path)
+            ).filter(
+                (pl.col('date') >= first_date) & (pl.col('user_id') == user_id)
+            ).sort('timestamp').tail(self.timelines.max_events).collect()
+        except Exception as e:
+            self.logger.warning(f"Timeline del lake no disponible: {str(e)}")
+            return []
+        
+        encoded = UserTimelineStore.encode(frame).sort('t', 'id')
+        return list(zip(encoded['t'], encoded['id'], encoded['event']))
+    
     def _build_individual_journey(self, events: List) -> Dict[str, Any]:
         """Construir viaje individual del usuario"""
         journey = {
@@ -1168,7 +4939,7 @@ class UserJourneyPipeline30X:
             
             # Identificar conversiones en esta secuencia
             conversion_events = [event for event in seq_list 
-                               if event in ['signup_complete', 'purchase_complete']]
+                               if event in JOURNEY_CONVERSION_EVENTS]
             
             if conversion_events:
                 for conv_event in conversion_events:
@@ -1181,7 +4952,7 @@ class UserJourneyPipeline30X:
                     })
             
             # Identificar abandonos
-            if seq_list[-1] not in ['purchase_complete', 'onboarding_complete']:
+            if seq_list[-1] not in JOURNEY_COMPLETION_EVENTS:
                 dropoff_event = seq_list[-1]
                 if dropoff_event not in journey_map['dropoff_analysis']:
                     journey_map['dropoff_analysis'][dropoff_event] = 0
@@ -1197,16 +4968,26 @@ class UserJourneyPipeline30X:
         """Limpiar recursos"""
         self.logger.info("🧹 Limpiando recursos del pipeline...")
         
-        if self.spark:
-            self.spark.stop()
+        for engine in self.engines.values():
+            await engine.close()
         
-        if self.dask_client:
-            self.dask_client.close()
+        # Checkpoint final (flush del lake incluido) si no queda ningún batch a medias
+        if self.checkpoints.idle():
+            try:
+                await self.checkpoints.checkpoint()
+            except Exception as e:
+                self.logger.warning(f"Checkpoint final incompleto: {str(e)}")
         
-        if self.ray_context:
-            ray.shutdown()
+        for queue in self.sink_queues.values():
+            await queue.stop()
+        
+        self.cpu_executor.shutdown(wait=False, cancel_futures=True)
         
         if self.redis_client:
+            try:
+                self._publish_dashboard_sketches()
+            except Exception as e:
+                self.logger.warning(f"No se pudieron publicar las métricas del dashboard: {str(e)}")
             self.redis_client.close()
         
         if self.kafka_producer:
@@ -1215,17 +4996,19 @@ class UserJourneyPipeline30X:
         self.logger.info("✅ Recursos limpiados")
 
 # FastAPI Integration
-from fastapi import FastAPI, BackgroundTasks, HTTPException
+from fastapi import FastAPI, BackgroundTasks, HTTPException, Request
 from fastapi.responses import JSONResponse
 import uvicorn
 
 app = FastAPI(title="User Journey Pipeline 30X API")
 
 pipeline = None
+stream_task = None
 
 @app.on_event("startup")
 async def startup():
     global pipeline
+    started_at = time.monotonic()
     
     config = {
         'redis_host': 'localhost',
@@ -1238,21 +5021,32 @@ async def startup():
         'aws_access_key': 'your-key',
         'aws_secret_key': 'your-secret',
         'batch_size': 10000,
-        'parallelism': mp.cpu_count() * 4
+        'stream_source': os.environ.get('STREAM_SOURCE', DataSource.KAFKA.value)
     }
     
     pipeline = UserJourneyPipeline30X(config)
     
-    # Iniciar procesamiento en background
-    background_tasks = BackgroundTasks()
-    background_tasks.add_task(
-        pipeline.process_stream, 
-        source=DataSource.KAFKA,
-        mode=ProcessingMode.MICRO_BATCH
+    # Iniciar procesamiento en background sobre el mismo event loop que la API.
+    # Un solo driver por proceso: los checkpoints asumen una única fuente de posiciones
+    global stream_task
+    stream_task = asyncio.create_task(
+        pipeline.process_stream(
+            source=DataSource(config['stream_source']),
+            mode=ProcessingMode.MICRO_BATCH
+        )
     )
+    
+    TIME_TO_READY.set(time.monotonic() - started_at)
 
 @app.on_event("shutdown")
 async def shutdown():
+    if stream_task:
+        stream_task.cancel()
+        try:
+            await stream_task
+        except (asyncio.CancelledError, Exception):
+            pass
+    
     if pipeline:
         await pipeline.cleanup()
 
@@ -1277,24 +5071,79 @@ async def process_batch(
     except Exception as e:
         raise HTTPException(500, f"Error iniciando batch: {str(e)}")
 
-@app.get("/journey/{user_id}")
-async def get_user_journey(user_id: str):
-    """Obtener journey map de usuario específico"""
-    try:
-        journey = pipeline.generate_journey_map(user_id)
-        return journey
-    except Exception as e:
-        raise HTTPException(500, f"Error obteniendo journey: {str(e)}")
+@app.post("/events")
+async def ingest_events(request: Request):
+    """Ingestar eventos por HTTP (fuente DataSource.API) como NDJSON o array JSON"""
+    # Sin el driver API nadie drena la cola: mejor rechazar que aceptar y perder eventos
+    if DataSource.API not in pipeline.active_sources:
+        raise HTTPException(503, "Ingesta HTTP deshabilitada: el pipeline no consume la fuente api")
+    
+    body = await request.body()
+    
+    if body.lstrip().startswith(b'['):
+        try:
+            payloads = [orjson.dumps(event) for event in orjson.loads(body)]
+        except orjson.JSONDecodeError as e:
+            raise HTTPException(400, f"JSON inválido: {str(e)}")
+    else:
+        payloads = [line for line in body.splitlines() if line.strip()]
+    
+    accepted = await pipeline.ingest_api_events(payloads)
+    if not accepted:
+        raise HTTPException(429, "Pipeline saturado, reintentar más tarde")
+    
+    return {"status": "accepted", "events": len(payloads)}
 
+# Antes que /journey/{user_id}: si no, "aggregate" se toma como un user_id
 @app.get("/journey/aggregate")
 async def get_aggregate_journey():
     """Obtener journey map agregado"""
+    # Mapa ya materializado desde el stream: se reemplaza entero, así que se lee sin lock
+    if pipeline.journey_maps.sessions:
+        return pipeline.aggregate_journey
+    
     try:
-        journey = pipeline.generate_journey_map()
+        journey = await asyncio.to_thread(pipeline.generate_journey_map)
         return journey
     except Exception as e:
         raise HTTPException(500, f"Error obteniendo journey agregado: {str(e)}")
 
+@app.get("/journey/paths")
+async def get_journey_paths(prefix: str = '', k: int = 10):
+    """Top-k recorridos que empiezan por `prefix` (eventos separados por comas) y abandono por paso"""
+    events = [event for event in prefix.split(',') if event]
+    # El lock del trie se toma en el pool de CPU: un batch aplicándose no bloquea el loop
+    return await pipeline._run_cpu(pipeline.query_journey_paths, events, min(k, 1000))
+
+@app.get("/journey/{user_id}")
+async def get_user_journey(user_id: str, cursor: Optional[str] = None, limit: int = 100):
+    """Obtener journey map de usuario específico, paginado con `cursor`/`next_cursor`"""
+    try:
+        journey = await pipeline.get_user_journey(user_id, cursor=cursor, limit=min(limit, 1000))
+        return journey
+    except ValueError as e:
+        raise HTTPException(400, f"Cursor inválido: {str(e)}")
+    except Exception as e:
+        raise HTTPException(500, f"Error obteniendo journey: {str(e)}")
+
+@app.get("/retention")
+async def get_retention(period: str = 'week', periods: int = 12, cohorts: int = 12):
+    """Matriz de retención por cohortes (period: day o week)"""
+    try:
+        return await pipeline._run_cpu(pipeline.retention.matrix, period, periods, cohorts)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+
+@app.get("/metrics/dashboard")
+async def get_dashboard_metrics(period: str = 'hour', buckets: int = 24, k: int = 10):
+    """Distintos y top-k por hora o día, combinados entre workers"""
+    try:
+        return await asyncio.to_thread(pipeline.dashboard_metrics, period, min(buckets, 24 * 31), min(k, 100))
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    except Exception as e:
+        raise HTTPException(500, f"Error obteniendo métricas del dashboard: {str(e)}")
+
 @app.get("/metrics")
 async def get_pipeline_metrics():
     """Obtener métricas del pipeline"""
@@ -1306,7 +5155,8 @@ async def get_pipeline_metrics():
                 (datetime.now() - pipeline.stats['last_checkpoint']).total_seconds()
                 if pipeline.stats['events_processed'] > 0 else 0,
             "data_volume_gb": pipeline.stats['total_bytes'] / (1024**3),
-            "avg_processing_time_ms": pipeline.stats['avg_processing_time'] * 1000
+            "avg_processing_time_ms": pipeline.stats['avg_processing_time'] * 1000,
+            "quantiles": await asyncio.to_thread(pipeline.quantile_metrics)
         }
     except Exception as e:
         raise HTTPException(500, f"Error obteniendo métricas: {str(e)}")
@@ -1315,8 +5165,6 @@ async def get_pipeline_metrics():
 async def health_check():
     """Health check del pipeline"""
     components = {
-        "spark": pipeline.spark is not None,
-        "dask": pipeline.dask_client is not None,
         "redis": pipeline.redis_client is not None,
         "clickhouse": pipeline.clickhouse_client is not None,
         "postgres": pipeline.postgres_pool is not None,
@@ -1329,6 +5177,8 @@ async def health_check():
     return {
         "status": status,
         "components": components,
+        # Motores bajo demanda: parados no implica degradado
+        "engines": {name: engine.running for name, engine in pipeline.engines.items()},
         "timestamp": datetime.now().isoformat()
     }
 
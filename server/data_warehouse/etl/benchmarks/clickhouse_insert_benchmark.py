@@ -0,0 +1,145 @@
+"""
+Benchmark del sink de ClickHouse: insert por filas (dicts + json.dumps + isoformat)
+contra insert columnar con Arrow.
+
+Sin --host usa un cliente que registra el payload que se enviaría por el protocolo HTTP
+(JSONEachRow para filas, Arrow IPC stream para columnar), de modo que mide el coste
+en el cliente sin servidor. Con --host inserta contra un ClickHouse local.
+
+    python benchmarks/clickhouse_insert_benchmark.py --rows 200000
+    python benchmarks/clickhouse_insert_benchmark.py --rows 200000 --host localhost
+"""
+
+import argparse
+import io
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+import orjson
+import polars as pl
+import pyarrow as pa
+import clickhouse_connect
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from UserJourneyPipeline import UserJourneyPipeline30X
+
+COLUMN_NAMES = [
+    'event_id', 'user_id', 'session_id', 'event_type', 'event_name',
+    'timestamp', 'platform', 'device_info', 'location', 'properties',
+    'app_version', 'processing_time'
+]
+
+CREATE_TABLE = """
+CREATE TABLE IF NOT EXISTS user_journey_events (
+    event_id String,
+    user_id String,
+    session_id String,
+    event_type String,
+    event_name String,
+    timestamp DateTime64(6),
+    platform String,
+    device_info String,
+    location String,
+    properties String,
+    app_version String,
+    processing_time DateTime64(6)
+) ENGINE = MergeTree ORDER BY (user_id, timestamp)
+"""
+
+class RecordingClickHouseClient:
+    """Stand-in que serializa el payload como lo haría el protocolo HTTP y lo descarta"""
+
+    def __init__(self):
+        self.bytes_sent = 0
+
+    def insert(self, table, data, column_names=None, settings=None):
+        body = b'\n'.join(orjson.dumps(dict(zip(column_names, row))) for row in data)
+        self.bytes_sent += len(body)
+
+    def insert_arrow(self, table, arrow_table, settings=None):
+        sink = io.BytesIO()
+        with pa.ipc.new_stream(sink, arrow_table.schema) as writer:
+            writer.write_table(arrow_table)
+        self.bytes_sent += sink.tell()
+
+def build_frame(rows: int) -> pl.DataFrame:
+    """Frame limpio sintético con el esquema que llega a los sinks"""
+    start = datetime.now() - timedelta(hours=1)
+    return pl.DataFrame({
+        'event_id': [f"evt_{i}" for i in range(rows)],
+        'user_id': [f"user_{i % 5000}" for i in range(rows)],
+        'session_id': [f"session_{i % 20000}" for i in range(rows)],
+        'event_type': ['navigation', 'interaction', 'conversion'] * (rows // 3) + ['navigation'] * (rows % 3),
+        'event_name': [f"screen_{i % 40}" for i in range(rows)],
+        'timestamp': [start + timedelta(milliseconds=i) for i in range(rows)],
+        'platform': ['ios', 'android'] * (rows // 2) + ['web'] * (rows % 2),
+        'device_info': [{'os': 'ios', 'os_version': '17.1', 'model': 'iPhone15,2', 'manufacturer': 'Apple'}] * rows,
+        'location': [{'city': 'Madrid', 'country': 'ES', 'region': None, 'lat': 40.41, 'lon': -3.70}] * rows,
+        'properties_sanitized': [{'screen': 'home', 'position': i % 10, 'ab_group': 'b'} for i in range(rows)],
+        'app_version': ['3.2.1'] * rows
+    })
+
+def insert_rows(client, df: pl.DataFrame):
+    """Camino anterior: un dict por fila, json.dumps de anidados e isoformat por timestamp"""
+    data = []
+    for row in df.iter_rows(named=True):
+        data.append({
+            'event_id': row['event_id'],
+            'user_id': row['user_id'],
+            'session_id': row['session_id'],
+            'event_type': row['event_type'],
+            'event_name': row['event_name'],
+            'timestamp': row['timestamp'].isoformat(),
+            'platform': row['platform'],
+            'device_info': json.dumps(row.get('device_info', {})),
+            'location': json.dumps(row.get('location', {})),
+            'properties': json.dumps(row.get('properties_sanitized', {})),
+            'app_version': row['app_version'],
+            'processing_time': datetime.now().isoformat()
+        })
+
+    client.insert('user_journey_events', [list(row.values()) for row in data], column_names=COLUMN_NAMES)
+
+def insert_arrow(client, df: pl.DataFrame):
+    """Camino columnar del pipeline"""
+    table = UserJourneyPipeline30X._clickhouse_table(UserJourneyPipeline30X._storage_frame(df))
+    client.insert_arrow('user_journey_events', table)
+
+def run(name: str, insert, client, df: pl.DataFrame, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        insert(client, df)
+        timings.append(time.perf_counter() - start)
+
+    best = min(timings)
+    print(f"{name:<10} {df.height / best:>14,.0f} filas/s   ({best * 1000:.1f} ms)")
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--host', help='ClickHouse local; sin él se usa el stand-in')
+    parser.add_argument('--port', type=int, default=8123)
+    args = parser.parse_args()
+
+    if args.host:
+        client = clickhouse_connect.get_client(host=args.host, port=args.port)
+        client.command(CREATE_TABLE)
+    else:
+        client = RecordingClickHouseClient()
+
+    df = build_frame(args.rows)
+    print(f"{args.rows:,} filas, destino: {args.host or 'stand-in'}")
+
+    rows_time = run('filas', insert_rows, client, df, args.repeat)
+    arrow_time = run('arrow', insert_arrow, client, df, args.repeat)
+
+    print(f"speedup    {rows_time / arrow_time:.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Benchmark del camino de streaming según el número de particiones por micro-batch:
+decode → enriquecimiento/limpieza → operadores con estado → colas de sinks.
+
+Antes cada micro-batch se troceaba en cpu_count * 4 chunks, cada uno con su propio
+DataFrame y sus propias escrituras; ahora es un solo frame salvo que se pida
+stream_partitions > 1. El pipeline corre sin clientes de almacenamiento y con un sink
+stand-in que simula una latencia fija por escritura.
+
+    python benchmarks/partition_benchmark.py
+    python benchmarks/partition_benchmark.py --batch-size 1000 --partitions 1 4 32 128
+"""
+
+import argparse
+import asyncio
+import logging
+import multiprocessing as mp
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+import orjson
+import polars as pl
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from UserJourneyPipeline import SinkQueue, UserJourneyPipeline30X
+
+EVENT_NAMES = ['app_open', 'signup_view', 'signup_submit', 'onboarding_complete', 'first_action']
+
+class OfflinePipeline(UserJourneyPipeline30X):
+    """Pipeline sin conexiones a Redis, ClickHouse, PostgreSQL, S3 ni Kafka"""
+
+    def _init_storage_clients(self):
+        pass
+
+def build_payloads(events: int, users: int) -> list:
+    """JSON crudo como llega de Kafka"""
+    start = datetime.now() - timedelta(minutes=30)
+    return [
+        orjson.dumps({
+            'event_id': f"evt_{i}",
+            'user_id': f"user_{i % users}",
+            'session_id': f"session_{i % (users * 2)}",
+            'event_type': ['navigation', 'interaction', 'conversion'][i % 3],
+            'event_name': EVENT_NAMES[i % len(EVENT_NAMES)],
+            'timestamp': (start + timedelta(milliseconds=i * 10)).isoformat(),
+            'platform': ['ios', 'android', 'web'][i % 3],
+            'device_info': {'os': 'ios', 'os_version': '17.1', 'model': 'iPhone15,2'},
+            'location': {'city': 'Madrid', 'country': 'ES', 'lat': 40.41, 'lon': -3.70},
+            'properties': {'screen': 'home', 'position': i % 10, 'token': 'x'},
+            'app_version': '3.2.1'
+        })
+        for i in range(events)
+    ]
+
+async def run(partitions: int, payloads: list, batch_size: int, sink_latency: float) -> float:
+    pipeline = OfflinePipeline({'engines': [], 'stream_partitions': partitions})
+
+    async def write(frame: pl.DataFrame):
+        await asyncio.sleep(sink_latency)
+
+    pipeline.sink_queues = {'standin': SinkQueue('standin', write, workers=2)}
+
+    start = time.perf_counter()
+    for i in range(0, len(payloads), batch_size):
+        await pipeline._process_payloads(payloads[i:i + batch_size])
+    await pipeline.checkpoints.drain()
+    elapsed = time.perf_counter() - start
+
+    await pipeline.cleanup()
+    return elapsed
+
+def main():
+    default_partitions = sorted({1, 2, 4, mp.cpu_count(), mp.cpu_count() * 4})
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--events', type=int, default=50000)
+    parser.add_argument('--batch-size', type=int, default=1000, help='eventos por micro-batch')
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--partitions', type=int, nargs='+', default=default_partitions)
+    parser.add_argument('--sink-latency-ms', type=float, default=2.0, help='latencia por escritura del sink stand-in')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    payloads = build_payloads(args.events, args.users)
+    print(f"{args.events:,} eventos, micro-batches de {args.batch_size}, {mp.cpu_count()} cores")
+
+    # Calentamiento: caché de esquemas de Polars/Arrow y pool de hilos
+    asyncio.run(run(1, payloads[:args.batch_size * 2], args.batch_size, 0))
+
+    for partitions in args.partitions:
+        best = min(
+            asyncio.run(run(partitions, payloads, args.batch_size, args.sink_latency_ms / 1000))
+            for _ in range(args.repeat)
+        )
+        print(f"{partitions:>4} particiones {args.events / best:>14,.0f} eventos/s   ({best * 1000:.1f} ms)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Fixtures comunes: el pipeline se construye sin clientes externos (Redis, ClickHouse,
+PostgreSQL, S3, Kafka) y el stream se alimenta con InProcessKafkaConsumer.
+"""
+
+import asyncio
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+import orjson
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import UserJourneyPipeline as ujp
+
+# _clean_data descarta eventos de hace más de 30 días
+BASE_TIME = datetime.now().replace(minute=0, second=0, microsecond=0) - timedelta(days=1)
+
+def make_event(i: int, **overrides) -> bytes:
+    """Evento crudo válido; user_id y event_name rotan para repartir etapas del funnel"""
+    event = {
+        'event_id': f"e{i}",
+        'user_id': f"u{i % 7}",
+        'session_id': f"s{i % 7}",
+        'event_type': 'navigation',
+        'event_name': ujp.FUNNEL_STAGES[i % 3],
+        'timestamp': (BASE_TIME + timedelta(seconds=i)).isoformat(),
+        'platform': 'ios',
+        'device_info': {'os': 'ios'},
+        'location': {'city': 'Madrid', 'country': 'ES'},
+        'properties': {'screen': 'home'},
+        'app_version': '1.0'
+    }
+    event.update(overrides)
+    return orjson.dumps(event)
+
+async def wait_until(condition, timeout: float = 10):
+    """Esperar a que condition() sea cierta cediendo el event loop"""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("Timeout esperando al pipeline")
+        await asyncio.sleep(0.01)
+
+async def stop(task: asyncio.Task):
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
+@pytest.fixture
+def make_pipeline(monkeypatch, tmp_path):
+    """Fábrica de pipelines sin cluster ni servidor de métricas; pipeline.log va a tmp_path"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(ujp.UserJourneyPipeline30X, '_init_cluster', lambda self: None)
+    monkeypatch.setattr(ujp, 'start_http_server', lambda *args: None)
+    
+    def make(**config) -> ujp.UserJourneyPipeline30X:
+        config.setdefault('stream_batch_timeout_ms', 50)
+        config.setdefault('checkpoint_interval_seconds', 0)
+        return ujp.UserJourneyPipeline30X(config)
+    
+    return make
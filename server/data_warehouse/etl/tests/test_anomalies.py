@@ -0,0 +1,89 @@
+"""AnomalyDetector: calentamiento de la EWMA, baseline por hora de la semana y snapshot"""
+
+from datetime import datetime, timedelta
+
+import polars as pl
+
+from conftest import ujp
+
+MINUTE = 60
+HOUR = 3600
+# Lunes 00:00 UTC: slot 0 de la semana
+MONDAY = int((datetime(2026, 10, 12) - ujp.UNIX_EPOCH).total_seconds())
+
+def traffic(bucket: int, count: int, event_type: str = 'navigation') -> pl.DataFrame:
+    """count eventos en el bucket que empieza en bucket (epoch s)"""
+    return pl.DataFrame({
+        'user_id': [f"u{i % 50}" for i in range(count)],
+        'event_type': [event_type] * count,
+        'platform': ['ios'] * count,
+        'timestamp': [ujp.UNIX_EPOCH + timedelta(seconds=bucket)] * count
+    }, schema_overrides={'timestamp': pl.Datetime('us')})
+
+def detector(**options) -> ujp.AnomalyDetector:
+    options = {'bucket_seconds': MINUTE, 'min_samples': 5, 'allowed_lateness': 0, **options}
+    return ujp.AnomalyDetector(**options)
+
+def feed(anomaly_detector: ujp.AnomalyDetector, counts, start: int = MONDAY, step: int = MINUTE) -> list:
+    """Un batch por bucket; cada uno cierra el anterior"""
+    anomalies = []
+    for i, count in enumerate(counts):
+        anomalies.extend(anomaly_detector.update(traffic(start + i * step, count)))
+    return anomalies
+
+def test_no_alerts_during_warm_up():
+    anomaly_detector = detector()
+    
+    # Cuatro buckets cerrados (< min_samples) y un pico: todavía sin baseline
+    assert feed(anomaly_detector, [10, 10, 10, 10, 500, 10]) == []
+    assert anomaly_detector._ewma[('navigation', 'ios')][2] == 5
+
+def test_spike_flagged_steady_traffic_not():
+    anomaly_detector = detector()
+    assert feed(anomaly_detector, [10] * 20) == []
+    
+    anomalies = feed(anomaly_detector, [60, 10], start=MONDAY + 20 * MINUTE)
+    assert [(anomaly['type'], anomaly['event_count'], anomaly['expected']) for anomaly in anomalies] == \
+        [('activity_spike', 60, 10.0)]
+    assert anomalies[0]['timestamp'] == ujp.UNIX_EPOCH + timedelta(seconds=MONDAY + 20 * MINUTE)
+
+def test_missing_series_counts_as_drop():
+    anomaly_detector = detector()
+    feed(anomaly_detector, [10] * 20)
+    
+    # En un bucket con eventos de otra serie, la serie conocida sin eventos cuenta como 0
+    anomaly_detector.update(traffic(MONDAY + 20 * MINUTE, 10, event_type='other'))
+    anomalies = anomaly_detector.update(traffic(MONDAY + 21 * MINUTE, 10))
+    assert [(anomaly['type'], anomaly['event_type'], anomaly['event_count']) for anomaly in anomalies] == \
+        [('activity_drop', 'navigation', 0)]
+
+def test_seasonal_baseline_uses_hour_of_week_slot():
+    anomaly_detector = detector(bucket_seconds=HOUR, min_samples=3)
+    # Tres semanas: el lunes a las 09:00 siempre hay 100 eventos, el resto de horas 10
+    weekly = [100 if hour == 9 else 10 for hour in range(168)]
+    feed(anomaly_detector, weekly * 3, step=HOUR)
+    
+    seasonal = anomaly_detector._seasonal[('navigation', 'ios')]
+    assert [slot[2] for slot in seasonal[:10]] == [3] * 10
+    assert seasonal[9][0] == 100.0 and seasonal[10][0] == 10.0
+    
+    # Semana 4: 100 eventos el lunes a las 09:00 es lo normal; el martes a las 09:00 es un pico
+    week = MONDAY + 3 * 168 * HOUR
+    counts = [10] * 9 + [100] + [10] * 23 + [100, 10]
+    anomalies = feed(anomaly_detector, counts, start=week, step=HOUR)
+    assert [(anomaly['timestamp'].strftime('%a %H'), anomaly['expected']) for anomaly in anomalies] == [('Tue 09', 10.0)]
+
+def test_snapshot_restore_continues_identically():
+    original = detector()
+    feed(original, [10] * 12)
+    # Un bucket todavía abierto entra en el snapshot
+    original.update(traffic(MONDAY + 12 * MINUTE + 5, 30))
+    
+    restored = detector()
+    restored.restore(original.snapshot())
+    assert restored.watermark == original.watermark
+    
+    follow_up = [10, 70, 10]
+    expected = feed(original, follow_up, start=MONDAY + 13 * MINUTE)
+    assert expected
+    assert feed(restored, follow_up, start=MONDAY + 13 * MINUTE) == expected
@@ -0,0 +1,92 @@
+"""Batch sobre el lake: selección de motor en auto y errores claros sin motor registrado"""
+
+import asyncio
+from datetime import timedelta
+
+import polars as pl
+import pytest
+
+from conftest import BASE_TIME, ujp
+
+def lake_events(count: int = 60) -> pl.DataFrame:
+    return pl.DataFrame({
+        'event_id': [f"e{i}" for i in range(count)],
+        'user_id': [f"u{i % 7}" for i in range(count)],
+        'event_name': [ujp.FUNNEL_STAGES[i % 3] for i in range(count)],
+        'event_type': ['navigation'] * count,
+        'timestamp': [BASE_TIME + timedelta(minutes=i) for i in range(count)]
+    })
+
+@pytest.fixture
+def pipeline(make_pipeline, tmp_path):
+    pipeline = make_pipeline(batch_engine='auto')
+    pipeline.lake_writer = ujp.RollingParquetWriter(ujp.LocalLakeBackend(str(tmp_path / 'lake')))
+    pipeline.lake_writer.write(lake_events())
+    pipeline.lake_writer.flush_all()
+    return pipeline
+
+DATE_RANGE = (BASE_TIME - timedelta(days=1), BASE_TIME + timedelta(days=1))
+
+def test_auto_without_engines_uses_polars(pipeline):
+    assert pipeline._auto_batch_engines() == ['polars']
+    
+    results = asyncio.run(pipeline.run_batch_processing(DATE_RANGE))
+    assert results['total_events'] == 60
+    assert results['unique_users'] == 7
+    assert [row['events'] for row in results['funnel_analysis']] == [20, 20, 20]
+
+def test_auto_falls_back_when_engine_does_not_start(pipeline, monkeypatch):
+    starts = []
+    
+    def start():
+        starts.append(1)
+        raise RuntimeError('sin JVM')
+    
+    pipeline.engines['spark'] = ujp.LazyEngine('spark', start, lambda handle: None)
+    monkeypatch.setattr(ujp.UserJourneyPipeline30X, '_importable', staticmethod(lambda module: True))
+    monkeypatch.setattr(ujp.shutil, 'which', lambda name: '/usr/bin/java')
+    
+    # Elegir candidatos no arranca nada
+    assert pipeline._auto_batch_engines() == ['spark', 'polars']
+    assert starts == []
+    
+    results = asyncio.run(pipeline.run_batch_processing(DATE_RANGE))
+    assert starts == [1]
+    assert results['total_events'] == 60
+
+def test_explicit_engine_must_be_registered(pipeline):
+    pipeline.batch_engine = 'spark'
+    
+    with pytest.raises(ujp.EngineUnavailableError, match='no registrado'):
+        asyncio.run(pipeline.run_batch_processing(DATE_RANGE))
+
+def test_duckdb_matches_polars(make_pipeline, tmp_path):
+    pipeline = make_pipeline(duckdb_temp_directory=str(tmp_path / 'spill'), duckdb_threads=2)
+    pipeline.lake_writer = ujp.RollingParquetWriter(ujp.LocalLakeBackend(str(tmp_path / 'lake')))
+    # Varias semanas y usuarios activos más de 7 días para que las cohortes difieran
+    count = 400
+    pipeline.lake_writer.write(lake_events(count).with_columns(
+        pl.Series('timestamp', [BASE_TIME - timedelta(days=20) + timedelta(hours=i * 7 % 480) for i in range(count)]),
+        pl.Series('user_id', [f"u{i % 23}" for i in range(count)])
+    ))
+    pipeline.lake_writer.flush_all()
+    date_range = (BASE_TIME - timedelta(days=15), BASE_TIME)
+    
+    async def scenario():
+        return (
+            await pipeline._process_duckdb_batch(pipeline._lake_uri(), date_range),
+            await pipeline._process_local_batch(pipeline._lake_uri(), date_range)
+        )
+    
+    duckdb_results, polars_results = asyncio.run(scenario())
+    
+    assert 0 < duckdb_results['total_events'] < count
+    assert duckdb_results['total_events'] == polars_results['total_events']
+    assert duckdb_results['unique_users'] == polars_results['unique_users']
+    assert duckdb_results['funnel_analysis'] == polars_results['funnel_analysis']
+    assert len(duckdb_results['cohort_analysis']) > 1
+    for duckdb_row, polars_row in zip(duckdb_results['cohort_analysis'], polars_results['cohort_analysis'], strict=True):
+        assert duckdb_row['signup_week'] == polars_row['signup_week']
+        assert duckdb_row['signups'] == polars_row['signups']
+        assert duckdb_row['avg_retention_days'] == pytest.approx(polars_row['avg_retention_days'])
+        assert duckdb_row['week1_retention'] == pytest.approx(polars_row['week1_retention'])
@@ -0,0 +1,124 @@
+"""Checkpoints: reanudar tras un fallo sin contar dos veces en los operadores"""
+
+import asyncio
+
+from conftest import make_event, stop, wait_until, ujp
+
+def start_stream(pipeline: ujp.UserJourneyPipeline30X) -> asyncio.Task:
+    return asyncio.create_task(pipeline.process_stream(ujp.DataSource.KAFKA, ujp.ProcessingMode.STREAMING))
+
+async def reference_state(make_pipeline, events: int):
+    """Estado de los operadores tras procesar una sola vez los eventos 0..events"""
+    consumer = ujp.InProcessKafkaConsumer(partitions=2)
+    for i in range(events):
+        consumer.produce(make_event(i))
+    pipeline = make_pipeline(kafka_consumer_factory=lambda: consumer)
+    
+    task = start_stream(pipeline)
+    await wait_until(lambda: pipeline.stats['events_processed'] == events)
+    await stop(task)
+    await pipeline.cleanup()
+    return pipeline.funnels['activation'].reached, pipeline.sessionizer.open_sessions
+
+def test_restart_after_snapshot_without_source_commit(make_pipeline, tmp_path):
+    async def scenario():
+        consumer = ujp.InProcessKafkaConsumer(partitions=2)
+        for i in range(300):
+            consumer.produce(make_event(i))
+        config = {'kafka_consumer_factory': lambda: consumer, 'state_dir': str(tmp_path / 'state')}
+        
+        first = make_pipeline(**config)
+        task = start_stream(first)
+        await wait_until(lambda: first.stats['events_processed'] == 300)
+        await stop(task)
+        await first.cleanup()
+        
+        # Caída entre el snapshot y el commit en Kafka: la fuente reentrega desde el inicio
+        consumer.committed = {}
+        for i in range(300, 400):
+            consumer.produce(make_event(i))
+        
+        second = make_pipeline(**config)
+        task = start_stream(second)
+        await wait_until(lambda: second.stats['events_processed'] == 100)
+        await asyncio.sleep(0.2)
+        await stop(task)
+        await second.cleanup()
+        
+        # Lo incluido en el snapshot se descarta al reentregarse
+        assert second.stats['events_processed'] == 100
+        reached, open_sessions = await reference_state(make_pipeline, 400)
+        assert second.funnels['activation'].reached == reached
+        assert second.sessionizer.open_sessions == open_sessions
+    
+    asyncio.run(scenario())
+
+def test_failed_required_sink_replays_from_checkpoint(make_pipeline, monkeypatch):
+    written = []
+    calls = {'count': 0}
+    
+    async def store_postgres(self, df):
+        calls['count'] += 1
+        if calls['count'] == 1:
+            raise ConnectionError('postgres caído')
+        written.append(df.height)
+    
+    monkeypatch.setattr(ujp.UserJourneyPipeline30X, '_store_postgres', store_postgres)
+    
+    async def scenario():
+        consumer = ujp.InProcessKafkaConsumer(partitions=2)
+        for i in range(300):
+            consumer.produce(make_event(i))
+        pipeline = make_pipeline(
+            kafka_consumer_factory=lambda: consumer,
+            checkpoint_required_sinks=['postgres'],
+            sinks={'postgres': {'max_retries': 0, 'backoff_seconds': 0.01}}
+        )
+        
+        task = start_stream(pipeline)
+        await wait_until(lambda: calls['count'] >= 1)
+        
+        # Tras el fallo se vuelve al checkpoint inicial y la fuente reentrega todo
+        for i in range(300, 400):
+            consumer.produce(make_event(i))
+        await wait_until(lambda: sum(written) == 400)
+        await stop(task)
+        await pipeline.cleanup()
+        
+        assert pipeline.checkpoints.positions == {
+            'kafka:user-journey-events:0': 200,
+            'kafka:user-journey-events:1': 200
+        }
+        reached, open_sessions = await reference_state(make_pipeline, 400)
+        assert pipeline.funnels['activation'].reached == reached
+        assert pipeline.sessionizer.open_sessions == open_sessions
+    
+    asyncio.run(scenario())
+
+def test_checkpoints_do_not_close_small_lake_files(make_pipeline, monkeypatch, tmp_path):
+    lake = tmp_path / 'lake'
+    
+    def init_lake(self):
+        self.lake_writer = ujp.RollingParquetWriter(ujp.LocalLakeBackend(str(lake)), max_age_seconds=300)
+    
+    monkeypatch.setattr(ujp.UserJourneyPipeline30X, '_init_cluster', init_lake)
+    
+    async def scenario():
+        consumer = ujp.InProcessKafkaConsumer(partitions=2)
+        # checkpoint_interval_seconds=0 pediría un checkpoint (y un flush del lake) por batch
+        pipeline = make_pipeline(kafka_consumer_factory=lambda: consumer)
+        assert pipeline.checkpoints.interval == 300
+        
+        task = start_stream(pipeline)
+        for wave in range(3):
+            for i in range(wave * 100, (wave + 1) * 100):
+                consumer.produce(make_event(i))
+            await wait_until(lambda: pipeline.stats['events_processed'] == (wave + 1) * 100)
+        await stop(task)
+        assert not list(lake.rglob('*.parquet'))
+        
+        # El checkpoint final escribe un único fichero por partición
+        await pipeline.cleanup()
+        assert len(list(lake.rglob('*.parquet'))) == 1
+    
+    asyncio.run(scenario())
@@ -0,0 +1,70 @@
+"""Insert columnar en ClickHouse: tabla Arrow con anidados como JSON y async_insert"""
+
+import asyncio
+from datetime import timedelta
+
+import orjson
+import polars as pl
+import pyarrow as pa
+import pytest
+
+from conftest import BASE_TIME
+
+class FakeClickHouse:
+    def __init__(self, error: Exception = None):
+        self.error = error
+        self.inserts = []
+    
+    def insert_arrow(self, table_name, table, settings=None):
+        if self.error:
+            raise self.error
+        self.inserts.append((table_name, table, settings))
+
+def processed_events(count: int = 3) -> pl.DataFrame:
+    """Columnas tal como salen de _clean_data / _enrich_data"""
+    return pl.DataFrame({
+        'event_id': [f"e{i}" for i in range(count)],
+        'user_id': [f"u{i}" for i in range(count)],
+        'session_id': ['s1'] * count,
+        'event_type': ['navigation'] * count,
+        'event_name': ['app_open'] * count,
+        'timestamp': [BASE_TIME + timedelta(seconds=i) for i in range(count)],
+        'platform': ['ios'] * count,
+        'device_info': [{'os': 'ios', 'model': None}] * count,
+        'location': [{'city': 'Madrid', 'country': 'ES'}] * (count - 1) + [None],
+        'properties_sanitized': [{'screen': 'home'}] * count,
+        'app_version': ['1.0'] * count,
+        'subscription_tier': ['pro'] * count
+    })
+
+def test_insert_arrow_with_json_columns(make_pipeline):
+    pipeline = make_pipeline()
+    pipeline.clickhouse_client = FakeClickHouse()
+    
+    asyncio.run(pipeline._store_clickhouse(processed_events()))
+    
+    (table_name, table, settings), = pipeline.clickhouse_client.inserts
+    assert table_name == 'user_journey_events'
+    assert settings == {'async_insert': 1, 'wait_for_async_insert': 1}
+    assert table.num_rows == 3
+    # Solo las columnas de almacenamiento, más processing_time
+    assert table.column_names == [
+        'event_id', 'user_id', 'session_id', 'event_type', 'event_name', 'timestamp', 'platform',
+        'device_info', 'location', 'properties', 'app_version', 'processing_time'
+    ]
+    assert table.schema.field('event_id').type == pa.large_string()
+    assert table.schema.field('timestamp').type == pa.timestamp('us')
+    assert orjson.loads(table.column('device_info')[0].as_py()) == {'os': 'ios', 'model': None}
+    assert table.column('location').to_pylist()[-1] is None
+    assert table.column('properties')[0].as_py() == '{"screen":"home"}'
+
+def test_async_insert_can_be_disabled_and_errors_propagate(make_pipeline):
+    pipeline = make_pipeline(clickhouse_async_insert=False)
+    pipeline.clickhouse_client = FakeClickHouse()
+    asyncio.run(pipeline._store_clickhouse(processed_events()))
+    assert pipeline.clickhouse_client.inserts[0][2] is None
+    
+    # El error llega a la cola del sink para reintentar
+    pipeline.clickhouse_client = FakeClickHouse(ConnectionError('clickhouse caído'))
+    with pytest.raises(ConnectionError):
+        asyncio.run(pipeline._store_clickhouse(processed_events()))
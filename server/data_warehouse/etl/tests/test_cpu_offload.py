@@ -0,0 +1,66 @@
+"""Pool de CPU: las etapas Polars/Arrow y las lecturas con lock no corren en el event loop"""
+
+import asyncio
+import threading
+
+import pytest
+
+from conftest import make_event, stop, wait_until, ujp
+
+def record_threads(monkeypatch, cls, names, threads):
+    """Envolver los métodos `names` de cls para anotar el hilo en que se ejecutan"""
+    for name in names:
+        method = getattr(cls, name)
+        
+        def wrapper(self, *args, _method=method, _name=name, **kwargs):
+            threads.setdefault(_name, set()).add(threading.current_thread().name)
+            return _method(self, *args, **kwargs)
+        
+        monkeypatch.setattr(cls, name, wrapper)
+
+def test_stream_stages_run_in_cpu_pool(make_pipeline, monkeypatch):
+    threads = {}
+    record_threads(monkeypatch, ujp.UserJourneyPipeline30X,
+                   ['_decode_batch', '_transform_chunk', '_apply_operators'], threads)
+    
+    async def scenario():
+        consumer = ujp.InProcessKafkaConsumer(partitions=2)
+        for i in range(200):
+            consumer.produce(make_event(i))
+        pipeline = make_pipeline(kafka_consumer_factory=lambda: consumer, cpu_workers=2)
+        
+        task = asyncio.create_task(pipeline.process_stream(ujp.DataSource.KAFKA, ujp.ProcessingMode.STREAMING))
+        await wait_until(lambda: pipeline.stats['events_processed'] == 200)
+        await stop(task)
+        await pipeline.cleanup()
+    
+    asyncio.run(scenario())
+    
+    assert set(threads) == {'_decode_batch', '_transform_chunk', '_apply_operators'}
+    for names in threads.values():
+        assert all(name.startswith('journey-cpu') for name in names)
+
+@pytest.mark.parametrize('endpoint, lock', [
+    (lambda: ujp.get_journey_paths(prefix='app_open', k=5), lambda pipeline: pipeline.journey_maps._lock),
+    (lambda: ujp.get_retention(period='day'), lambda pipeline: pipeline.retention._lock)
+])
+def test_endpoints_wait_for_locks_off_the_loop(make_pipeline, monkeypatch, endpoint, lock):
+    async def scenario():
+        pipeline = make_pipeline()
+        monkeypatch.setattr(ujp, 'pipeline', pipeline)
+        
+        # Un batch aplicándose en el pool tiene el lock 0.3 s: la petición espera sin parar el loop
+        lock(pipeline).acquire()
+        threading.Timer(0.3, lock(pipeline).release).start()
+        request = asyncio.create_task(endpoint())
+        ticks = 0
+        while not request.done():
+            await asyncio.sleep(0.01)
+            ticks += 1
+        assert ticks >= 10
+        
+        result = request.result()
+        assert isinstance(result, dict)
+        await pipeline.cleanup()
+    
+    asyncio.run(scenario())
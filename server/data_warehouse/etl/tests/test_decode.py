@@ -0,0 +1,70 @@
+"""Decodificación de payloads a Arrow: camino rápido, fallback, timestamps y descartes"""
+
+import logging
+from datetime import timezone
+
+import pyarrow as pa
+import pytest
+
+from conftest import BASE_TIME, make_event, ujp
+
+@pytest.fixture
+def pipeline(make_pipeline):
+    return make_pipeline()
+
+def test_fast_path_keeps_properties_as_struct(pipeline):
+    batch = pipeline._decode_batch([make_event(i) for i in range(5)])
+    
+    assert batch.num_rows == 5
+    assert batch.schema.field('properties').type == pa.struct([('screen', pa.string())])
+    assert batch.column('event_id').to_pylist() == [f"e{i}" for i in range(5)]
+    assert batch.column('timestamp')[0].as_py() == BASE_TIME
+    assert pipeline.stats['errors'] == 0
+
+def test_fallback_on_inconsistent_properties(pipeline):
+    batch = pipeline._decode_batch([
+        make_event(0, properties={'value': 1}),
+        make_event(1, properties={'value': 'uno'}),
+        make_event(2, properties=None)
+    ])
+    
+    assert batch.num_rows == 3
+    assert batch.schema.field('properties').type == pa.string()
+    assert batch.column('properties').to_pylist() == ['{"value":1}', '{"value":"uno"}', '{}']
+    assert pipeline.stats['errors'] == 0
+
+def test_epoch_and_utc_timestamps_are_normalized(pipeline):
+    utc = BASE_TIME.replace(tzinfo=timezone.utc)
+    epoch = int(utc.timestamp())
+    variants = [
+        BASE_TIME.isoformat(),
+        BASE_TIME.isoformat() + 'Z',
+        epoch,
+        epoch * 1000,
+        epoch * 1_000_000,
+        float(epoch),
+        str(epoch)
+    ]
+    
+    batch = pipeline._decode_batch([make_event(i, timestamp=value) for i, value in enumerate(variants)])
+    
+    assert batch.column('timestamp').to_pylist() == [BASE_TIME] * len(variants)
+    assert pipeline.stats['errors'] == 0
+
+def test_malformed_rows_are_dropped_counted_and_logged(pipeline, caplog):
+    payloads = [
+        make_event(0),
+        b'{"event_id": "roto"',
+        make_event(2, location={'city': 'Madrid', 'lat': 'abc'}),
+        make_event(3, timestamp='ayer'),
+        make_event(4)
+    ]
+    
+    with caplog.at_level(logging.ERROR, logger='UserJourneyPipeline30X'):
+        batch = pipeline._decode_batch(payloads)
+    
+    assert batch.column('event_id').to_pylist() == ['e0', 'e4']
+    assert pipeline.stats['errors'] == 3
+    messages = [record.getMessage() for record in caplog.records]
+    assert sum('Error decodificando evento' in message for message in messages) == 1
+    assert sum('Evento descartado por esquema' in message for message in messages) == 2
@@ -0,0 +1,182 @@
+"""Drivers API y Redis Streams, y disparadores del MicroBatcher (micro-batch e híbrido)"""
+
+import asyncio
+
+import pytest
+
+from conftest import make_event, stop, wait_until, ujp
+
+def start_stream(pipeline: ujp.UserJourneyPipeline30X, source: ujp.DataSource,
+                 mode: ujp.ProcessingMode = ujp.ProcessingMode.STREAMING) -> asyncio.Task:
+    return asyncio.create_task(pipeline.process_stream(source, mode))
+
+def test_api_ingestion_and_backpressure(make_pipeline):
+    async def scenario():
+        pipeline = make_pipeline(api_queue_max_requests=2, api_ingest_timeout_ms=20)
+        
+        # Sin driver consumiendo, la cola se llena y la petición se rechaza
+        assert await pipeline.ingest_api_events([make_event(0)])
+        assert await pipeline.ingest_api_events([make_event(1)])
+        assert not await pipeline.ingest_api_events([make_event(2)])
+        
+        task = start_stream(pipeline, ujp.DataSource.API)
+        await wait_until(lambda: pipeline.stats['events_processed'] == 2)
+        for start in range(2, 100, 7):
+            assert await pipeline.ingest_api_events([make_event(i) for i in range(start, min(start + 7, 100))])
+        await wait_until(lambda: pipeline.stats['events_processed'] == 100)
+        
+        await stop(task)
+        await pipeline.cleanup()
+    
+    asyncio.run(scenario())
+
+class FakeStreamRedis:
+    """Redis Stream en memoria con un consumer group: entregas pendientes y XACK"""
+    
+    def __init__(self, messages, pending: int = 0):
+        self.messages = [(f"{i + 1}-0".encode(), fields) for i, fields in enumerate(messages)]
+        # Los primeros `pending` se entregaron en una ejecución anterior sin XACK
+        self.delivered = pending
+        self.acked = []
+        self.closed = False
+    
+    async def xgroup_create(self, stream, group, id='$', mkstream=False):
+        pass
+    
+    async def xreadgroup(self, group, consumer, streams, count=None, block=None):
+        (stream, last_id), = streams.items()
+        if last_id == b'>':
+            messages = self.messages[self.delivered:self.delivered + count]
+            self.delivered += len(messages)
+        else:
+            after = ujp.UserJourneyPipeline30X._stream_id(last_id if b'-' in last_id else last_id + b'-0')
+            messages = [
+                message for message in self.messages[:self.delivered]
+                if message[0] not in self.acked and ujp.UserJourneyPipeline30X._stream_id(message[0]) > after
+            ][:count]
+        
+        if not messages:
+            await asyncio.sleep(block / 1000)
+            return []
+        return [[stream.encode(), messages]]
+    
+    async def xack(self, stream, group, *message_ids):
+        self.acked.extend(message_ids)
+    
+    async def close(self):
+        self.closed = True
+
+def test_redis_stream_recovers_pending_and_acks_after_checkpoint(make_pipeline, monkeypatch):
+    messages = [{b'data': make_event(i)} for i in range(50)]
+    messages[30] = {b'otro': b'{}'}
+    client = FakeStreamRedis(messages, pending=10)
+    monkeypatch.setattr(ujp.aioredis, 'Redis', lambda **options: client)
+    
+    async def scenario():
+        pipeline = make_pipeline(stream_batch_max_events=8)
+        task = start_stream(pipeline, ujp.DataSource.REDIS)
+        await wait_until(lambda: pipeline.stats['events_processed'] == 49)
+        
+        # XACK solo en el checkpoint: el último batch sigue pendiente hasta el de cleanup
+        assert b'50-0' not in client.acked
+        await stop(task)
+        await pipeline.cleanup()
+        
+        assert pipeline.stats['errors'] == 1
+        assert sorted(client.acked, key=ujp.UserJourneyPipeline30X._stream_id) == [message_id for message_id, _ in client.messages]
+        assert pipeline.checkpoints.positions == {'redis:user-journey-events': b'50-0'}
+        assert client.closed
+    
+    asyncio.run(scenario())
+
+def test_micro_batcher_flushes_by_size_and_commits_with_last_batch():
+    async def scenario():
+        batches = []
+        commits = []
+        
+        async def handler(batch):
+            batches.append(list(batch))
+        
+        async def commit():
+            commits.append(len(batches))
+        
+        batcher = ujp.MicroBatcher(handler, max_events=3, max_latency_ms=60_000)
+        runner = asyncio.create_task(batcher.run())
+        
+        await batcher.add([b'a', b'b', b'c', b'd', b'e'], commit)
+        await batcher.join()
+        assert batches == [[b'a', b'b', b'c']]
+        assert commits == []
+        
+        # El commit de la lectura viaja con el batch de su último evento
+        await batcher.add([b'f'])
+        await batcher.join()
+        assert batches == [[b'a', b'b', b'c'], [b'd', b'e', b'f']]
+        assert commits == [2]
+        assert batcher.is_idle()
+        
+        runner.cancel()
+    
+    asyncio.run(scenario())
+
+def test_micro_batcher_flushes_by_latency():
+    async def scenario():
+        batches = []
+        
+        async def handler(batch):
+            batches.append(list(batch))
+        
+        batcher = ujp.MicroBatcher(handler, max_events=1000, max_latency_ms=50)
+        runner = asyncio.create_task(batcher.run())
+        
+        await batcher.add([b'a', b'b'])
+        await asyncio.sleep(0.02)
+        assert batches == []
+        await wait_until(lambda: batches == [[b'a', b'b']], timeout=1)
+        
+        runner.cancel()
+    
+    asyncio.run(scenario())
+
+def test_micro_batcher_stops_after_failure():
+    async def scenario():
+        async def handler(batch):
+            raise ValueError('sink caído')
+        
+        batcher = ujp.MicroBatcher(handler, max_events=1)
+        runner = asyncio.create_task(batcher.run())
+        
+        await batcher.add([b'a'])
+        await asyncio.wait_for(batcher.failed.wait(), 1)
+        with pytest.raises(ValueError):
+            await batcher.add([b'b'])
+        
+        runner.cancel()
+    
+    asyncio.run(scenario())
+
+@pytest.mark.parametrize('mode', [ujp.ProcessingMode.MICRO_BATCH, ujp.ProcessingMode.HYBRID])
+def test_batched_modes_process_and_commit_everything(make_pipeline, mode):
+    async def scenario():
+        consumer = ujp.InProcessKafkaConsumer(partitions=2)
+        for i in range(300):
+            consumer.produce(make_event(i))
+        pipeline = make_pipeline(
+            kafka_consumer_factory=lambda: consumer,
+            micro_batch_max_events=64,
+            micro_batch_max_latency_ms=20,
+            # Umbral bajo: el modo híbrido pasa a batch con la primera lectura
+            hybrid_rate_threshold=1
+        )
+        
+        task = start_stream(pipeline, ujp.DataSource.KAFKA, mode)
+        await wait_until(lambda: pipeline.stats['events_processed'] == 300)
+        await stop(task)
+        await pipeline.cleanup()
+        
+        assert pipeline.checkpoints.positions == {
+            'kafka:user-journey-events:0': 150,
+            'kafka:user-journey-events:1': 150
+        }
+    
+    asyncio.run(scenario())
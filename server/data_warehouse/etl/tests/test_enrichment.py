@@ -0,0 +1,78 @@
+"""Enriquecimiento con perfiles: un MGET, una query ANY() para los fallos y un join"""
+
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+import orjson
+import polars as pl
+
+from conftest import ujp
+
+PROFILES = {
+    'u1': {'user_id': 'u1', 'country': 'ES', 'language': 'es', 'subscription_tier': 'pro',
+           'total_spent': 12.5, 'retention_score': 0.9},
+    'u2': {'user_id': 'u2', 'country': 'FR', 'language': 'fr', 'subscription_tier': 'free',
+           'total_spent': 0.0, 'retention_score': 0.1}
+}
+
+class FakeRedis:
+    def __init__(self, cached):
+        self.cached = cached
+        self.mget_calls = []
+        self.setex_calls = []
+    
+    def mget(self, keys):
+        self.mget_calls.append(keys)
+        return [self.cached.get(key) for key in keys]
+    
+    def pipeline(self, transaction=True):
+        return self
+    
+    def setex(self, key, ttl, value):
+        self.setex_calls.append((key, orjson.loads(value)))
+    
+    def execute(self):
+        pass
+
+class FakePostgres:
+    def __init__(self, rows):
+        self.rows = rows
+        self.queries = []
+    
+    @contextmanager
+    def connect(self):
+        yield self
+    
+    def execute(self, query, params):
+        self.queries.append(params['user_ids'])
+        return [SimpleNamespace(_mapping=self.rows[user_id]) for user_id in params['user_ids'] if user_id in self.rows]
+
+def test_profiles_joined_with_one_lookup_per_batch(make_pipeline):
+    pipeline = make_pipeline()
+    pipeline.redis_client = FakeRedis({'user:u1': orjson.dumps(PROFILES['u1'])})
+    pipeline.postgres_pool = FakePostgres({'u2': PROFILES['u2']})
+    
+    events = pl.DataFrame({
+        'event_id': ['e1', 'e2', 'e3', 'e4'],
+        'user_id': ['u1', 'u2', 'u1', 'u3']
+    })
+    enriched = pipeline._enrich_data(events)
+    
+    # Usuarios únicos: un MGET, y solo los fallos de caché van a PostgreSQL
+    assert len(pipeline.redis_client.mget_calls) == 1
+    assert sorted(pipeline.redis_client.mget_calls[0]) == ['user:u1', 'user:u2', 'user:u3']
+    assert [sorted(user_ids) for user_ids in pipeline.postgres_pool.queries] == [['u2', 'u3']]
+    assert pipeline.redis_client.setex_calls == [('user:u2', PROFILES['u2'])]
+    
+    # Todas las filas se conservan; sin perfil quedan nulos
+    assert enriched.height == 4
+    assert enriched.sort('event_id').select('user_id', 'subscription_tier', 'total_spent').rows() == [
+        ('u1', 'pro', 12.5), ('u2', 'free', 0.0), ('u1', 'pro', 12.5), ('u3', None, None)
+    ]
+    assert enriched.schema['retention_score'] == pl.Float64
+
+def test_without_clients_profile_columns_are_null(make_pipeline):
+    enriched = make_pipeline()._enrich_data(pl.DataFrame({'event_id': ['e1'], 'user_id': ['u1']}))
+    
+    assert set(ujp.USER_PROFILE_SCHEMA) <= set(enriched.columns)
+    assert enriched['subscription_tier'].to_list() == [None]
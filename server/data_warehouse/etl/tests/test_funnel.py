@@ -0,0 +1,55 @@
+"""FunnelTracker: conversión incremental entre micro-batches"""
+
+from datetime import timedelta
+
+import polars as pl
+
+from conftest import BASE_TIME, ujp
+
+def events(*rows) -> pl.DataFrame:
+    """Filas (user_id, event_name, segundos desde BASE_TIME)"""
+    return pl.DataFrame(
+        [(user_id, name, BASE_TIME + timedelta(seconds=seconds)) for user_id, name, seconds in rows],
+        schema={'user_id': pl.Utf8, 'event_name': pl.Utf8, 'timestamp': pl.Datetime('us')},
+        orient='row'
+    )
+
+def tracker(window_seconds: float = 3600) -> ujp.FunnelTracker:
+    return ujp.FunnelTracker(
+        ujp.FunnelDefinition('activation', ['app_open', 'signup_view', 'signup_submit'], window_seconds),
+        allowed_lateness=0
+    )
+
+def test_conversion_spans_batches():
+    funnel = tracker()
+    funnel.update(events(('u1', 'app_open', 0), ('u2', 'app_open', 5)))
+    funnel.update(events(('u1', 'signup_view', 60), ('u2', 'signup_submit', 70)))
+    funnel.update(events(('u1', 'signup_submit', 120)))
+    
+    metrics = funnel.metrics()
+    assert metrics['app_open'] == 2
+    assert metrics['signup_view'] == 1
+    assert metrics['signup_submit'] == 1
+    assert metrics['app_open_to_signup_view_conversion'] == 50.0
+    # u1 completó el funnel; u2 sigue esperando signup_view (saltarse etapas no cuenta)
+    assert metrics['in_progress'] == 1
+
+def test_attempt_expires_outside_window():
+    funnel = tracker(window_seconds=60)
+    funnel.update(events(('u1', 'app_open', 0)))
+    funnel.update(events(('u1', 'signup_view', 600)))
+    
+    assert funnel.metrics()['signup_view'] == 0
+    assert funnel.expired == 1
+    assert funnel.metrics()['in_progress'] == 0
+
+def test_snapshot_restore_continues_conversion():
+    funnel = tracker()
+    funnel.update(events(('u1', 'app_open', 0)))
+    
+    restored = tracker()
+    restored.restore(funnel.snapshot())
+    restored.update(events(('u1', 'signup_view', 30)))
+    
+    assert restored.metrics()['signup_view'] == 1
+    assert restored.reached == [1, 1, 0]
@@ -0,0 +1,70 @@
+"""GeoIndex: aciertos, fallos, fallback por país y claves en los extremos del índice"""
+
+import os
+
+import polars as pl
+import pytest
+
+from conftest import ujp
+
+REFERENCE = """city,country,region,timezone,lat,lon
+Barcelona,ES,Cataluña,Europe/Madrid,41.39,2.17
+Madrid,ES,Comunidad de Madrid,Europe/Madrid,40.42,-3.70
+,ES,,Europe/Madrid,40.0,-4.0
+Lyon,FR,Auvergne-Rhône-Alpes,Europe/Paris,45.76,4.84
+"""
+
+LOCATION = pl.Struct({'city': pl.Utf8, 'country': pl.Utf8, 'region': pl.Utf8, 'lat': pl.Float64, 'lon': pl.Float64})
+
+@pytest.fixture
+def geo_index(tmp_path) -> ujp.GeoIndex:
+    path = tmp_path / 'geo.csv'
+    path.write_text(REFERENCE)
+    return ujp.GeoIndex(str(path), hot_cache_size=2)
+
+def enrich(geo_index, *locations) -> list:
+    df = pl.DataFrame({'location': list(locations)}, schema={'location': LOCATION})
+    return geo_index.enrich(df)['location_enriched'].to_list()
+
+def test_hits_are_normalized(geo_index):
+    madrid, lyon = enrich(geo_index, {'city': ' madrid ', 'country': 'es'}, {'city': 'Lyon', 'country': 'FR'})
+    
+    assert (madrid['region'], madrid['timezone'], madrid['lat']) == ('Comunidad de Madrid', 'Europe/Madrid', 40.42)
+    # city/country del evento se conservan tal cual
+    assert madrid['city'] == ' madrid '
+    assert lyon['timezone'] == 'Europe/Paris'
+
+def test_unknown_city_falls_back_to_country(geo_index):
+    (toledo,) = enrich(geo_index, {'city': 'Toledo', 'country': 'ES'})
+    assert (toledo['timezone'], toledo['lat'], toledo['lon']) == ('Europe/Madrid', 40.0, -4.0)
+
+def test_misses_keep_event_location(geo_index):
+    # Antes de la primera clave, después de la última y sin país en el índice
+    first, last, missing = enrich(
+        geo_index,
+        {'city': 'Aachen', 'country': 'AA', 'lat': 1.0},
+        {'city': 'Zurich', 'country': 'ZZ', 'region': 'propia', 'lat': 2.0, 'lon': 3.0},
+        {'city': None, 'country': None}
+    )
+    
+    assert first['timezone'] is None and first['lat'] == 1.0
+    assert (last['region'], last['lat'], last['lon'], last['timezone']) == ('propia', 2.0, 3.0, None)
+    assert missing['timezone'] is None
+
+def test_first_and_last_keys_resolve(geo_index):
+    keys = geo_index.frame['geo_key'].to_list()
+    assert keys == sorted(keys)
+    assert set(geo_index.lookup([keys[0], keys[-1]])) == {keys[0], keys[-1]}
+
+def test_hot_cache_is_bounded(geo_index):
+    enrich(geo_index, *({'city': city, 'country': country} for city, country in
+                        [('Madrid', 'ES'), ('Barcelona', 'ES'), ('Lyon', 'FR')]))
+    assert len(geo_index._hot_cache) == 2
+
+def test_index_rebuilt_when_reference_changes(geo_index, tmp_path):
+    path = tmp_path / 'geo.csv'
+    path.write_text(REFERENCE + "Porto,PT,Norte,Europe/Lisbon,41.15,-8.61\n")
+    os.utime(path, (os.path.getmtime(geo_index.index_path) + 10,) * 2)
+    
+    (porto,) = enrich(ujp.GeoIndex(str(path)), {'city': 'Porto', 'country': 'PT'})
+    assert porto['timezone'] == 'Europe/Lisbon'
@@ -0,0 +1,71 @@
+"""JourneyMapStore: ventana deslizante con resta de días expirados y refresco del mapa materializado"""
+
+import asyncio
+import time
+from datetime import timedelta
+
+import polars as pl
+
+from conftest import BASE_TIME, stop, wait_until, ujp
+
+def sessions(*rows) -> pl.DataFrame:
+    """Filas (recorrido, días desde BASE_TIME del fin de sesión, sesiones)"""
+    records = [
+        (f"u{i}", f"s{i}", BASE_TIME + timedelta(days=days), BASE_TIME + timedelta(days=days), 0.0,
+         len(path), list(path), 'ios')
+        for path, days, count in rows for i in range(count)
+    ]
+    return pl.DataFrame(records, schema=ujp.SESSION_SCHEMA, orient='row')
+
+def top(store: ujp.JourneyMapStore) -> dict:
+    return {tuple(path): count for path, count in store.summary(k=10)['top_paths']}
+
+def test_expired_days_are_subtracted_from_trie():
+    store = ujp.JourneyMapStore(window_days=3, conversion_events=('purchase',))
+    store.update(sessions((('open', 'purchase'), 0, 4), (('open',), 1, 2)))
+    assert top(store) == {('open', 'purchase'): 4, ('open',): 2}
+    
+    # El día 3 deja fuera el día 0: sus sesiones salen del árbol y de los totales
+    store.update(sessions((('open', 'home'), 3, 1)))
+    assert top(store) == {('open',): 2, ('open', 'home'): 1}
+    assert store.sessions == store.trie.sessions() == 3
+    assert store.trie.conversion_rate() == 0.0
+    assert store.window()['from'] == (BASE_TIME + timedelta(days=1)).date().isoformat()
+    
+    # Sesiones que llegan tarde para un día ya expirado no entran en la ventana
+    assert store.update(sessions((('open', 'purchase'), 0, 5)))
+    assert store.sessions == 3
+
+def test_prune_keeps_totals_consistent():
+    store = ujp.JourneyMapStore(max_paths_per_day=10)
+    store.update(sessions(*[((f"screen-{i}",), 0, i + 1) for i in range(12)]))
+    
+    assert store.trie.paths == 9
+    assert store.sessions == store.trie.sessions()
+    assert store.pruned_sessions == 1 + 2 + 3
+
+def test_idle_stream_materializes_pending_changes(make_pipeline):
+    async def scenario():
+        consumer = ujp.InProcessKafkaConsumer(partitions=1)
+        pipeline = make_pipeline(
+            kafka_consumer_factory=lambda: consumer,
+            journey_refresh_seconds=0.1,
+            journey_min_frequency=1
+        )
+        task = asyncio.create_task(pipeline.process_stream(ujp.DataSource.KAFKA, ujp.ProcessingMode.STREAMING))
+        
+        # Un batch recién aplicado dentro del intervalo deja el mapa pendiente de recalcular
+        pipeline.journey_maps.update(sessions((('open', 'search'), 0, 3)))
+        pipeline._journey_map_dirty = True
+        pipeline._journey_map_refreshed_at = time.monotonic()
+        assert 'window' not in pipeline.aggregate_journey
+        
+        # Sin más batches, la tarea periódica lo publica
+        await wait_until(lambda: 'window' in pipeline.aggregate_journey, timeout=2)
+        assert pipeline.aggregate_journey['window']['sessions'] == 3
+        assert not pipeline._journey_map_dirty
+        
+        await stop(task)
+        await pipeline.cleanup()
+    
+    asyncio.run(scenario())
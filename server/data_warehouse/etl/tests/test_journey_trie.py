@@ -0,0 +1,89 @@
+"""JourneyTrie: top_paths, dropoff, merge y poda tras restar sesiones"""
+
+from conftest import ujp
+
+def trie(*paths, conversion_events=('purchase',)) -> ujp.JourneyTrie:
+    """Recorridos (tupla de eventos, sesiones)"""
+    result = ujp.JourneyTrie(conversion_events)
+    for path, count in paths:
+        result.insert(path, count)
+    return result
+
+PATHS = [
+    (('open', 'search', 'purchase'), 5),
+    (('open', 'search'), 3),
+    (('open', 'home'), 4),
+    (('open',), 2),
+    (('login',), 1)
+]
+
+def test_top_paths_by_frequency_and_prefix():
+    journeys = trie(*PATHS)
+    
+    assert journeys.top_paths(k=3) == [
+        (['open', 'search', 'purchase'], 5),
+        (['open', 'home'], 4),
+        (['open', 'search'], 3)
+    ]
+    assert journeys.top_paths(prefix=('open', 'search')) == [
+        (['open', 'search', 'purchase'], 5),
+        (['open', 'search'], 3)
+    ]
+    assert journeys.top_paths(min_frequency=4) == [
+        (['open', 'search', 'purchase'], 5),
+        (['open', 'home'], 4)
+    ]
+    assert journeys.top_paths(prefix=('missing',)) == []
+    assert journeys.main_path() == ['open', 'search', 'purchase']
+
+def test_dropoff_rates():
+    steps = trie(*PATHS).dropoff(['open', 'search', 'purchase'])
+    
+    assert [step['sessions'] for step in steps] == [14, 8, 5]
+    assert [step['ended_here'] for step in steps] == [2, 3, 5]
+    assert steps[0]['reached_from_previous'] == 14 / 15 * 100
+    assert steps[1]['reached_from_previous'] == 8 / 14 * 100
+    assert steps[1]['dropoff_rate'] == 3 / 8 * 100
+    assert steps[2]['dropoff_rate'] == 100.0
+    assert steps[1]['conversion_rate'] == 5 / 8 * 100
+    # Un paso que no existe corta el recorrido
+    assert len(trie(*PATHS).dropoff(['open', 'cart'])) == 1
+
+def test_merge_equals_single_trie():
+    left = trie(*PATHS[::2])
+    right = trie(*PATHS[1::2])
+    single = trie(*PATHS)
+    
+    left.merge(right)
+    assert left.root == single.root
+    assert left.paths == single.paths == 5
+    assert left.ends_by_event == single.ends_by_event
+    assert left.top_paths() == single.top_paths()
+
+def test_retraction_prunes_empty_nodes():
+    journeys = trie(*PATHS)
+    journeys.insert(('open', 'search', 'purchase'), -5)
+    journeys.insert(('open', 'home'), -4)
+    
+    assert journeys.root == trie(*PATHS[1:2], *PATHS[3:]).root
+    assert 'home' not in journeys.root[3]['open'][3]
+    assert 'purchase' not in journeys.root[3]['open'][3]['search'][3]
+    assert journeys.paths == 3
+    assert 'purchase' not in journeys.ends_by_event
+    assert journeys.conversion_rate() == 0.0
+    
+    # Restar lo que queda deja el árbol vacío
+    for path, count in (PATHS[1], PATHS[3], PATHS[4]):
+        journeys.insert(path, -count)
+    assert journeys.root == [0, 0, 0, {}]
+    assert journeys.paths == 0
+    assert journeys.ends_by_event == {}
+
+def test_snapshot_restore_round_trip():
+    journeys = trie(*PATHS)
+    restored = ujp.JourneyTrie()
+    restored.restore(journeys.snapshot())
+    
+    assert restored.root == journeys.root
+    assert restored.paths == journeys.paths
+    assert restored.conversion_rate(('open',)) == journeys.conversion_rate(('open',))
@@ -0,0 +1,98 @@
+"""Driver Kafka: commit de offsets tras procesar, reanudación y eventos malformados"""
+
+import asyncio
+
+from conftest import make_event, stop, wait_until, ujp
+
+def topic_partition(partition: int) -> ujp.TopicPartition:
+    return ujp.TopicPartition('user-journey-events', partition)
+
+def start_stream(pipeline: ujp.UserJourneyPipeline30X) -> asyncio.Task:
+    return asyncio.create_task(pipeline.process_stream(ujp.DataSource.KAFKA, ujp.ProcessingMode.STREAMING))
+
+def test_offsets_committed_only_after_processing(make_pipeline):
+    async def scenario():
+        consumer = ujp.InProcessKafkaConsumer(partitions=2)
+        for i in range(200):
+            consumer.produce(make_event(i))
+        pipeline = make_pipeline(kafka_consumer_factory=lambda: consumer)
+        
+        # Retener el batch dentro de los operadores
+        release = asyncio.Event()
+        process = pipeline._process_batch_parallel
+        
+        async def held(batch):
+            await release.wait()
+            await process(batch)
+        
+        pipeline._process_batch_parallel = held
+        task = start_stream(pipeline)
+        await asyncio.sleep(0.2)
+        assert consumer.committed == {}
+        
+        release.set()
+        await wait_until(lambda: pipeline.stats['events_processed'] == 200)
+        # Procesado pero aún sin checkpoint: las posiciones siguen en espera
+        assert consumer.committed == {}
+        
+        await stop(task)
+        await pipeline.cleanup()
+        assert consumer.committed == {topic_partition(0): 100, topic_partition(1): 100}
+        assert pipeline.checkpoints.positions == {
+            'kafka:user-journey-events:0': 100,
+            'kafka:user-journey-events:1': 100
+        }
+    
+    asyncio.run(scenario())
+
+def test_restart_resumes_from_committed_offsets(make_pipeline, tmp_path):
+    async def scenario():
+        consumer = ujp.InProcessKafkaConsumer(partitions=2)
+        for i in range(300):
+            consumer.produce(make_event(i))
+        config = {'kafka_consumer_factory': lambda: consumer, 'state_dir': str(tmp_path / 'state')}
+        
+        first = make_pipeline(**config)
+        task = start_stream(first)
+        await wait_until(lambda: first.stats['events_processed'] == 300)
+        await stop(task)
+        await first.cleanup()
+        reached = list(first.funnels['activation'].reached)
+        
+        for i in range(300, 400):
+            consumer.produce(make_event(i))
+        
+        second = make_pipeline(**config)
+        assert second.checkpoints.checkpoint_id == first.checkpoints.checkpoint_id
+        assert second.funnels['activation'].reached == reached
+        
+        task = start_stream(second)
+        await wait_until(lambda: second.stats['events_processed'] == 100)
+        await asyncio.sleep(0.2)
+        await stop(task)
+        await second.cleanup()
+        
+        # Solo los eventos nuevos: nada de lo confirmado se vuelve a procesar
+        assert second.stats['events_processed'] == 100
+        assert consumer.committed == {topic_partition(0): 200, topic_partition(1): 200}
+    
+    asyncio.run(scenario())
+
+def test_malformed_events_are_skipped(make_pipeline):
+    async def scenario():
+        consumer = ujp.InProcessKafkaConsumer(partitions=1)
+        for i in range(20):
+            consumer.produce(make_event(i) if i != 10 else make_event(i, location={'city': 'Madrid', 'lat': 'norte'}))
+        consumer.produce(b'{"event_id": "roto"')
+        pipeline = make_pipeline(kafka_consumer_factory=lambda: consumer)
+        
+        task = start_stream(pipeline)
+        await wait_until(lambda: pipeline.stats['errors'] == 2)
+        await wait_until(lambda: pipeline.stats['events_processed'] == 19)
+        await stop(task)
+        await pipeline.cleanup()
+        
+        # Los malformados no bloquean el offset de la partición
+        assert consumer.committed == {topic_partition(0): 21}
+    
+    asyncio.run(scenario())
@@ -0,0 +1,55 @@
+"""Batch local con Polars: scan_parquet sobre el lake con poda de particiones date="""
+
+import asyncio
+from datetime import timedelta
+
+import polars as pl
+
+from conftest import BASE_TIME, ujp
+
+def events(rows) -> pl.DataFrame:
+    """Filas (user_id, event_name, días desde BASE_TIME)"""
+    return pl.DataFrame({
+        'event_id': [f"e{i}" for i in range(len(rows))],
+        'user_id': [user_id for user_id, _, _ in rows],
+        'event_name': [event_name for _, event_name, _ in rows],
+        'event_type': ['navigation'] * len(rows),
+        'timestamp': [BASE_TIME + timedelta(days=days) for _, _, days in rows]
+    })
+
+def test_local_batch_over_partitioned_lake(make_pipeline, tmp_path):
+    pipeline = make_pipeline()
+    lake = tmp_path / 'lake'
+    writer = ujp.RollingParquetWriter(ujp.LocalLakeBackend(str(lake)))
+    first, second, third = ujp.FUNNEL_STAGES[:3]
+    writer.write(events([
+        ('a', first, -10), ('a', second, -10), ('a', third, -1),
+        ('b', first, -9), ('b', second, -9),
+        ('c', first, -2),
+        # Fuera del rango
+        ('d', first, -30), ('a', first, 1)
+    ]))
+    writer.flush_all()
+    
+    # Un fichero ilegible en una partición posterior al rango: la poda evita leerlo
+    # (el esquema se toma del primer fichero, que sí es válido)
+    outside = lake / 'user-journey/events' / f"date={(BASE_TIME + timedelta(days=40)).date()}" / 'hour=00' / 'event_type=navigation'
+    outside.mkdir(parents=True)
+    (outside / 'part-corrupto.parquet').write_bytes(b'no es parquet')
+    
+    date_range = (BASE_TIME - timedelta(days=12), BASE_TIME)
+    results = asyncio.run(pipeline._process_local_batch(writer.uri(), date_range))
+    
+    assert results['total_events'] == 6
+    assert results['unique_users'] == 3
+    assert results['funnel_analysis'] == [
+        {'funnel_stage': 1, 'users': 3, 'events': 3},
+        {'funnel_stage': 2, 'users': 2, 'events': 2},
+        {'funnel_stage': 3, 'users': 1, 'events': 1}
+    ]
+    # a: 9 días entre primer y último evento; b y c: 0
+    cohorts = results['cohort_analysis']
+    assert sum(cohort['signups'] for cohort in cohorts) == 3
+    assert sum(cohort['avg_retention_days'] * cohort['signups'] for cohort in cohorts) == 9
+    assert sum(cohort['week1_retention'] * cohort['signups'] for cohort in cohorts) == 100
+    assert [cohort['signup_week'] for cohort in cohorts] == sorted((cohort['signup_week'] for cohort in cohorts), reverse=True)
@@ -0,0 +1,47 @@
+"""Particiones del micro-batch: cada user_id cae siempre en la misma partición"""
+
+import pyarrow as pa
+
+from conftest import ujp
+
+def batch(user_ids) -> pa.RecordBatch:
+    return pa.RecordBatch.from_pydict({
+        'user_id': user_ids,
+        'event_id': [f"e{i}" for i in range(len(user_ids))]
+    })
+
+def partitions(pipeline, user_ids) -> list:
+    return [set(chunk['user_id']) for chunk in pipeline._partition_batch(batch(user_ids))]
+
+def test_single_partition_is_the_whole_batch(make_pipeline):
+    pipeline = make_pipeline()
+    chunks = pipeline._partition_batch(batch(['u1', 'u2', 'u1']))
+    
+    assert len(chunks) == 1
+    assert chunks[0]['event_id'].to_list() == ['e0', 'e1', 'e2']
+
+def test_same_user_same_partition_across_batches(make_pipeline):
+    pipeline = make_pipeline(stream_partitions=4)
+    users = [f"u{i}" for i in range(200)]
+    
+    first = partitions(pipeline, users * 3)
+    # Usuarios disjuntos entre particiones y todos presentes
+    assert sum(len(chunk) for chunk in first) == len(users)
+    assert set().union(*first) == set(users)
+    assert 1 < len(first) <= 4
+    
+    # Otro batch con otro orden y un subconjunto: cada usuario sigue en su partición
+    owner = {user_id: i for i, chunk in enumerate(first) for user_id in chunk}
+    for chunk in partitions(pipeline, users[::-3] + users[::5]):
+        assert len({owner[user_id] for user_id in chunk}) == 1
+    
+    # Otro pipeline con la misma configuración reparte igual
+    assert partitions(make_pipeline(stream_partitions=4), users * 3) == first
+
+def test_partition_keeps_event_order(make_pipeline):
+    pipeline = make_pipeline(stream_partitions=3)
+    user_ids = [f"u{i % 10}" for i in range(100)]
+    
+    for chunk in pipeline._partition_batch(batch(user_ids)):
+        events = [int(event_id[1:]) for event_id in chunk['event_id']]
+        assert events == sorted(events)
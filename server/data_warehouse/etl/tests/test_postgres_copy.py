@@ -0,0 +1,107 @@
+"""COPY a PostgreSQL: CSV por bloques que distingue NULL de string vacío"""
+
+import io
+from datetime import timedelta
+
+import polars as pl
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pytest
+
+from conftest import BASE_TIME, ujp
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        return False
+    
+    def execute(self, sql):
+        self.connection.statements.append(' '.join(sql.split()))
+    
+    def copy_expert(self, sql, buffer):
+        if self.connection.fail_copy:
+            raise IOError('conexión cortada')
+        self.connection.copies.append((sql, buffer.read()))
+
+class FakeConnection:
+    def __init__(self, fail_copy: bool = False):
+        self.fail_copy = fail_copy
+        self.statements = []
+        self.copies = []
+        self.committed = self.rolled_back = self.closed = False
+    
+    def cursor(self):
+        return FakeCursor(self)
+    
+    def commit(self):
+        self.committed = True
+    
+    def rollback(self):
+        self.rolled_back = True
+    
+    def close(self):
+        self.closed = True
+
+class FakePool:
+    def __init__(self, connection):
+        self.connection = connection
+    
+    def raw_connection(self):
+        return self.connection
+
+def read_postgres_csv(data: bytes, columns: list) -> pl.DataFrame:
+    """Semántica de COPY ... (FORMAT csv): vacío sin comillas es NULL, "" es string vacío"""
+    table = pa_csv.read_csv(
+        io.BytesIO(data),
+        read_options=pa_csv.ReadOptions(column_names=columns),
+        convert_options=pa_csv.ConvertOptions(
+            column_types={column: pa.string() for column in columns},
+            strings_can_be_null=True,
+            quoted_strings_can_be_null=False
+        )
+    )
+    return pl.from_arrow(table)
+
+FRAME = pl.DataFrame({
+    'event_id': ['e1', 'e2', 'e3'],
+    'user_id': ['u1', 'u2', 'u3'],
+    'session_id': ['s1', 's2', 's3'],
+    'event_type': ['navigation', '', None],
+    'event_name': ['app_open', 'a,"b"\nc', 'x'],
+    'timestamp': [BASE_TIME + timedelta(seconds=i) for i in range(3)],
+    'platform': ['ios', None, ''],
+    'device_info': ['{"os":"ios"}', None, '{}'],
+    'location': [None, '{"city":"Madrid, ES"}', None],
+    'properties': ['{"screen":"home"}', '', None],
+    'app_version': ['1.0', '', None]
+})
+
+def test_copy_round_trips_null_and_empty_string(make_pipeline):
+    connection = FakeConnection()
+    pipeline = make_pipeline(postgres_copy_batch_size=2)
+    pipeline.postgres_pool = FakePool(connection)
+    
+    pipeline._copy_to_postgres(FRAME)
+    
+    # Un COPY por bloque, upsert desde la tabla temporal y commit
+    assert len(connection.copies) == 2
+    assert all('FORMAT csv' in sql for sql, _ in connection.copies)
+    assert any('ON CONFLICT (event_id) DO NOTHING' in sql for sql in connection.statements)
+    assert connection.committed and connection.closed
+    
+    copied = pl.concat([read_postgres_csv(data, FRAME.columns) for _, data in connection.copies])
+    assert copied.with_columns(pl.col('timestamp').str.to_datetime(time_unit='us')).equals(FRAME)
+
+def test_failed_copy_rolls_back(make_pipeline):
+    connection = FakeConnection(fail_copy=True)
+    pipeline = make_pipeline()
+    pipeline.postgres_pool = FakePool(connection)
+    
+    with pytest.raises(IOError):
+        pipeline._copy_to_postgres(FRAME)
+    assert connection.rolled_back and not connection.committed and connection.closed
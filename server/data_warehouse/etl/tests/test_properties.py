@@ -0,0 +1,51 @@
+"""Sanitización de properties: claves sensibles, truncado y serialización de anidados"""
+
+import orjson
+import polars as pl
+import pytest
+
+from conftest import ujp
+
+ROWS = [
+    {'screen': 'home', 'password': 'x', 'authToken': 'y', 'tags': ['a', 'b"c'], 'extra': {'k': 1}},
+    {'screen': 'z' * (ujp.MAX_PROPERTY_LENGTH + 50), 'tags': None, 'extra': None},
+    None
+]
+
+@pytest.fixture
+def sanitize(make_pipeline):
+    return make_pipeline()._sanitize_properties
+
+def struct_column(rows) -> pl.Series:
+    return pl.Series('properties', rows)
+
+def utf8_column(rows) -> pl.Series:
+    """Columna del decoder de fallback: JSON crudo por fila"""
+    return pl.Series('properties', [None if row is None else orjson.dumps(row).decode() for row in rows])
+
+@pytest.mark.parametrize('column', [struct_column, utf8_column])
+def test_sanitize_properties(sanitize, column):
+    result = sanitize(column(ROWS))
+    
+    assert result.name == 'properties_sanitized'
+    assert [field.name for field in result.dtype.fields] == ['screen', 'tags', 'extra']
+    
+    first, second, third = result.to_list()
+    assert first == {'screen': 'home', 'tags': '["a","b\\"c"]', 'extra': '{"k":1}'}
+    assert orjson.loads(first['tags']) == ['a', 'b"c']
+    
+    # Truncado a MAX_PROPERTY_LENGTH; los anidados nulos siguen nulos
+    assert second['screen'] == 'z' * ujp.MAX_PROPERTY_LENGTH + '...'
+    assert second['tags'] is None and second['extra'] is None
+    assert third is None
+
+def test_only_sensitive_keys_or_no_properties(sanitize):
+    result = sanitize(struct_column([{'password': 'x', 'secret_key': 'y'}]))
+    assert result.to_list() == [None]
+    
+    assert sanitize(pl.Series('properties', [None, None], dtype=pl.Utf8)).to_list() == [None, None]
+    assert sanitize(pl.Series('properties', [], dtype=pl.Utf8)).len() == 0
+
+def test_fallback_keeps_null_nested_values(sanitize):
+    result = sanitize(utf8_column([{'extra': {'k': 1}, 'tags': [1]}, {'extra': None}]))
+    assert result.to_list() == [{'extra': '{"k":1}', 'tags': '[1]'}, {'extra': None, 'tags': None}]
@@ -0,0 +1,95 @@
+"""QuantileSketch (DDSketch): error relativo acotado y merge exacto"""
+
+import numpy as np
+import pytest
+
+from conftest import ujp
+
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+def sketch(values, **options) -> ujp.QuantileSketch:
+    result = ujp.QuantileSketch(**options)
+    result.add(values)
+    return result
+
+@pytest.fixture
+def latencies() -> np.ndarray:
+    return np.random.default_rng(3).lognormal(mean=3, sigma=1.5, size=100_000)
+
+def assert_relative_error(estimate, values, q, alpha):
+    exact = np.quantile(values, q, method='lower')
+    assert abs(estimate - exact) <= alpha * exact
+
+@pytest.mark.parametrize('alpha', [0.01, 0.05])
+def test_quantiles_within_relative_accuracy(latencies, alpha):
+    result = sketch(latencies, relative_accuracy=alpha)
+    for q in QUANTILES:
+        assert_relative_error(result.quantile(q), latencies, q, alpha)
+
+def test_merge_equals_sketch_of_union(latencies):
+    parts = np.array_split(latencies, 7)
+    merged = ujp.QuantileSketch()
+    for part in parts:
+        merged.merge(sketch(part))
+    union = sketch(latencies)
+    
+    assert merged.bins == union.bins
+    assert merged.count == union.count
+    for q in QUANTILES:
+        assert merged.quantile(q) == union.quantile(q)
+        assert_relative_error(merged.quantile(q), latencies, q, 0.01)
+    
+    with pytest.raises(ValueError):
+        merged.merge(ujp.QuantileSketch(relative_accuracy=0.05))
+
+def test_single_values_match_array(latencies):
+    # observe() añade las latencias de una en una; los batches añaden arrays
+    values = latencies[:2_000]
+    one_by_one = ujp.QuantileSketch(max_bins=64)
+    for value in values:
+        one_by_one.add(value)
+    at_once = sketch(values, max_bins=64)
+    
+    assert one_by_one.bins == at_once.bins
+    assert (one_by_one.count, one_by_one.min, one_by_one.max) == (at_once.count, at_once.min, at_once.max)
+    assert one_by_one.sum == pytest.approx(at_once.sum)
+    for q in QUANTILES:
+        assert one_by_one.quantile(q) == at_once.quantile(q)
+    
+    single = sketch(42.0)
+    assert single.count == 1
+    assert single.quantile(0.5) == 42.0
+
+def test_zero_and_negative_values_go_to_zero_bin():
+    result = sketch(np.array([0.0, 0.0, -2.0, 1.0, np.nan]))
+    
+    assert result.count == 4
+    assert result.zero_count == 3
+    assert result.quantile(0.5) == 0.0
+    assert result.quantile(1.0) == pytest.approx(1.0, rel=0.01)
+
+def test_collapse_keeps_upper_quantiles(latencies):
+    # 256 bins de γ ≈ 1.02 cubren de p99 al máximo; lo que queda por debajo se pliega
+    result = sketch(latencies, max_bins=256)
+    
+    assert len(result.bins) == 256
+    assert result.count == len(latencies)
+    for q in (0.99, 0.999):
+        assert_relative_error(result.quantile(q), latencies, q, 0.01)
+    assert result.quantile(0.5) > 1.01 * np.quantile(latencies, 0.5)
+
+def test_quantile_bucket_round_trip_and_all_platforms(latencies):
+    bucket = ujp.QuantileBucket()
+    bucket.sketch('session_duration', 'ios').add(latencies[:40_000])
+    bucket.sketch('session_duration', 'android').add(latencies[40_000:])
+    
+    restored = ujp.QuantileBucket.from_bytes(bucket.to_bytes())
+    summary = restored.summary()['session_duration']
+    
+    assert summary == bucket.summary()['session_duration']
+    assert summary['all']['count'] == len(latencies)
+    assert_relative_error(summary['all']['p99'], latencies, 0.99, 0.01)
+
+def test_period_sketches_is_abstract():
+    with pytest.raises(TypeError):
+        ujp.PeriodSketches()
@@ -0,0 +1,81 @@
+"""Sessionizer: cierre por inactividad, por watermark y spill a SQLite"""
+
+from datetime import timedelta
+
+import polars as pl
+
+from conftest import BASE_TIME, ujp
+
+def events(*rows) -> pl.DataFrame:
+    """Filas (user_id, event_name, segundos desde BASE_TIME); session_id = user_id"""
+    return pl.DataFrame(
+        [(user_id, user_id, name, BASE_TIME + timedelta(seconds=seconds), 'ios') for user_id, name, seconds in rows],
+        schema={'user_id': pl.Utf8, 'session_id': pl.Utf8, 'event_name': pl.Utf8,
+                'timestamp': pl.Datetime('us'), 'platform': pl.Utf8},
+        orient='row'
+    )
+
+def test_gap_closes_session_across_batches():
+    sessionizer = ujp.Sessionizer(gap_seconds=60, allowed_lateness=0)
+    assert sessionizer.update(events(('u1', 'app_open', 0), ('u1', 'signup_view', 10))).height == 0
+    
+    closed = sessionizer.update(events(('u1', 'signup_submit', 200)))
+    
+    assert closed.rows(named=True) == [{
+        'user_id': 'u1',
+        'session_id': 'u1',
+        'session_start': BASE_TIME,
+        'session_end': BASE_TIME + timedelta(seconds=10),
+        'duration_seconds': 10.0,
+        'event_count': 2,
+        'path': ['app_open', 'signup_view'],
+        'platform': 'ios'
+    }]
+    # La nueva sesión sigue abierta
+    assert sessionizer.open_sessions == 1
+
+def test_gap_within_session_spans_batches():
+    sessionizer = ujp.Sessionizer(gap_seconds=60, allowed_lateness=0)
+    sessionizer.update(events(('u1', 'app_open', 0)))
+    sessionizer.update(events(('u1', 'signup_view', 45)))
+    
+    assert sessionizer.last_gaps['gap'].to_list() == [45.0]
+    assert sessionizer.open_sessions == 1
+
+def test_watermark_closes_idle_sessions():
+    sessionizer = ujp.Sessionizer(gap_seconds=60, allowed_lateness=30)
+    sessionizer.update(events(('u1', 'app_open', 0), ('u1', 'signup_view', 10)))
+    
+    # Watermark = 95 - 30: aún dentro del gap de u1
+    assert sessionizer.update(events(('u2', 'app_open', 95))).height == 0
+    
+    closed = sessionizer.update(events(('u2', 'signup_view', 101)))
+    assert closed['user_id'].to_list() == ['u1']
+    assert closed['event_count'].to_list() == [2]
+    
+    # Un evento de u1 anterior al cierre llega tarde y se descarta
+    sessionizer.update(events(('u1', 'signup_submit', 5)))
+    assert sessionizer.late_events == 1
+
+def test_spill_and_snapshot_restore(tmp_path):
+    spill_path = str(tmp_path / 'sessions.sqlite')
+    sessionizer = ujp.Sessionizer(gap_seconds=60, allowed_lateness=0, max_open_sessions=2, spill_path=spill_path)
+    sessionizer.update(events(*[(f"u{i}", 'app_open', i) for i in range(5)]))
+    
+    assert sessionizer.open_sessions == 5
+    assert sessionizer._spilled == 3
+    
+    # Un evento de una sesión en SQLite la vuelve a memoria y la continúa
+    sessionizer.update(events(('u0', 'signup_view', 20)))
+    assert sessionizer.open_sessions == 5
+    
+    restored = ujp.Sessionizer(gap_seconds=60, allowed_lateness=0, max_open_sessions=2,
+                               spill_path=str(tmp_path / 'restored.sqlite'))
+    restored.restore(sessionizer.snapshot())
+    assert restored.open_sessions == 5
+    
+    closed = restored.update(events(('u9', 'app_open', 1000)))
+    counts = dict(closed.select('user_id', 'event_count').iter_rows())
+    assert counts == {'u0': 2, 'u1': 1, 'u2': 1, 'u3': 1, 'u4': 1}
+    assert closed.filter(pl.col('user_id') == 'u0')['path'].to_list() == [['app_open', 'signup_view']]
+    assert restored.open_sessions == 1
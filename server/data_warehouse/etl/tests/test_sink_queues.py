@@ -0,0 +1,110 @@
+"""SinkQueue: políticas con la cola llena (drop, spill, block) y reintentos"""
+
+import asyncio
+
+import polars as pl
+import pytest
+from prometheus_client import REGISTRY
+
+from conftest import ujp
+
+def chunk(i: int) -> pl.DataFrame:
+    return pl.DataFrame({'chunk': [i]})
+
+class BlockedSink:
+    """Sink que retiene las escrituras hasta release()"""
+    
+    def __init__(self):
+        self.written = []
+        self.released = asyncio.Event()
+    
+    async def write(self, frame: pl.DataFrame):
+        await self.released.wait()
+        self.written.extend(frame['chunk'].to_list())
+    
+    def release(self):
+        self.released.set()
+
+async def start_blocked(queue: ujp.SinkQueue) -> list:
+    """Un chunk en escritura (retenido) y otro que llena la cola"""
+    futures = [await queue.submit(chunk(0))]
+    await asyncio.sleep(0.01)
+    futures.append(await queue.submit(chunk(1)))
+    return futures
+
+def test_drop_policy_fails_future_and_counts():
+    async def scenario():
+        sink = BlockedSink()
+        queue = ujp.SinkQueue('test-drop', sink.write, max_queue=1, policy='drop')
+        dropped = REGISTRY.get_sample_value('sink_dropped_chunks_total', {'sink': 'test-drop'}) or 0
+        
+        futures = await start_blocked(queue)
+        rejected = await queue.submit(chunk(2))
+        
+        with pytest.raises(RuntimeError, match='chunk descartado'):
+            await rejected
+        assert REGISTRY.get_sample_value('sink_dropped_chunks_total', {'sink': 'test-drop'}) == dropped + 1
+        
+        sink.release()
+        assert await asyncio.gather(*futures) == [1, 1]
+        await queue.stop()
+        assert sink.written == [0, 1]
+    
+    asyncio.run(scenario())
+
+def test_spilled_chunks_replay_in_order(tmp_path):
+    async def scenario():
+        sink = BlockedSink()
+        spill_dir = tmp_path / 'spill'
+        queue = ujp.SinkQueue('test-spill', sink.write, max_queue=1, policy='spill',
+                              coalesce_rows=1, spill_dir=str(spill_dir))
+        
+        futures = await start_blocked(queue)
+        for i in range(2, 6):
+            futures.append(await queue.submit(chunk(i)))
+        assert len(list(spill_dir.glob('*.arrow'))) == 4
+        
+        sink.release()
+        await asyncio.gather(*futures)
+        await queue.stop()
+        
+        assert sink.written == [0, 1, 2, 3, 4, 5]
+        assert list(spill_dir.glob('*.arrow')) == []
+    
+    asyncio.run(scenario())
+
+def test_block_policy_waits_until_workers_drain():
+    async def scenario():
+        sink = BlockedSink()
+        queue = ujp.SinkQueue('test-block', sink.write, max_queue=1, policy='block')
+        
+        await start_blocked(queue)
+        blocked = asyncio.create_task(queue.submit(chunk(2)))
+        await asyncio.sleep(0.05)
+        assert not blocked.done()
+        
+        sink.release()
+        written = await asyncio.wait_for(blocked, 1)
+        assert await written == 1
+        await queue.stop()
+        assert sink.written == [0, 1, 2]
+    
+    asyncio.run(scenario())
+
+def test_retries_then_fails_future():
+    async def scenario():
+        attempts = []
+        
+        async def write(frame):
+            attempts.append(frame.height)
+            raise ConnectionError('sink caído')
+        
+        queue = ujp.SinkQueue('test-retry', write, max_retries=2, backoff_seconds=0.001)
+        future = await queue.submit(chunk(0))
+        
+        with pytest.raises(ConnectionError):
+            await future
+        assert attempts == [1, 1, 1]
+        await queue.stop()
+    
+    asyncio.run(scenario())
@@ -0,0 +1,86 @@
+"""HyperLogLog y HeavyHitters (Count-Min): cotas de error y merge"""
+
+import math
+
+import numpy as np
+import polars as pl
+import pytest
+
+from conftest import ujp
+
+def hll(values) -> ujp.HyperLogLog:
+    sketch = ujp.HyperLogLog()
+    sketch.add_hashes(ujp.stable_hash64(values))
+    return sketch
+
+def test_stable_hash_matches_across_inputs():
+    values = ['u1', 'usuario-ñ', '', 'u1' * 100]
+    hashes = ujp.stable_hash64(values)
+    
+    assert hashes.dtype == np.uint64
+    assert len(set(hashes.tolist())) == 4
+    assert ujp.stable_hash64(values).tolist() == hashes.tolist()
+    # Series de Polars y listas (y slices con offset) dan el mismo hash
+    assert ujp.stable_hash64(pl.Series(values)).tolist() == hashes.tolist()
+    assert ujp.stable_hash64(pl.Series(values)[1:]).tolist() == hashes[1:].tolist()
+
+@pytest.mark.parametrize('distinct', [100, 5_000, 200_000])
+def test_hyperloglog_error_bound(distinct):
+    sketch = hll([f"user-{i}" for i in range(distinct)])
+    # Error típico 1.04 / sqrt(2^14) ≈ 0.8%: 4 desviaciones
+    assert abs(sketch.count() - distinct) <= 4 * 1.04 / math.sqrt(1 << 14) * distinct + 1
+
+def test_hyperloglog_merge_equals_union():
+    left = hll([f"user-{i}" for i in range(0, 60_000)])
+    right = hll([f"user-{i}" for i in range(40_000, 100_000)])
+    union = hll([f"user-{i}" for i in range(100_000)])
+    
+    left.merge(right)
+    assert np.array_equal(left.registers, union.registers)
+    assert left.count() == union.count()
+    
+    with pytest.raises(ValueError):
+        left.merge(ujp.HyperLogLog(precision=10))
+
+def zipf_counts(values: int = 2_000, seed: int = 7) -> dict:
+    rng = np.random.default_rng(seed)
+    counts = np.bincount(rng.zipf(1.3, 200_000) % values, minlength=values)
+    return {f"event-{i}": int(count) for i, count in enumerate(counts) if count}
+
+def heavy_hitters(counts: dict) -> ujp.HeavyHitters:
+    sketch = ujp.HeavyHitters(capacity=50)
+    sketch.add(list(counts), np.array(list(counts.values())))
+    return sketch
+
+def test_count_min_overestimates_within_bound():
+    counts = zipf_counts()
+    sketch = heavy_hitters(counts)
+    total = sum(counts.values())
+    width = sketch.counts.shape[1]
+    
+    # Cota de Count-Min: error ≤ e/width · N con probabilidad 1 - e^-depth
+    for value, estimate in sketch.top(20):
+        assert counts[value] <= estimate <= counts[value] + math.e / width * total
+    
+    exact_top = sorted(counts, key=counts.get, reverse=True)[:5]
+    assert [value for value, _ in sketch.top(5)] == exact_top
+
+def test_heavy_hitters_merge_matches_single_sketch():
+    counts = zipf_counts()
+    items = list(counts.items())
+    left = heavy_hitters(dict(items[::2]))
+    right = heavy_hitters(dict(items[1::2]))
+    single = heavy_hitters(counts)
+    
+    left.merge(right)
+    assert np.array_equal(left.counts, single.counts)
+    assert left.top(10) == single.top(10)
+
+def test_sketch_bucket_bytes_round_trip():
+    bucket = ujp.SketchBucket()
+    bucket.events = 3
+    bucket.users.add_hashes(ujp.stable_hash64(['u1', 'u2']))
+    bucket.event_names.add(['app_open'], np.array([3]))
+    
+    restored = ujp.SketchBucket.from_bytes(bucket.to_bytes())
+    assert restored.summary() == bucket.summary()
@@ -0,0 +1,79 @@
+"""UserTimelineStore: orden, límite, paginación y deduplicación de reintentos"""
+
+from datetime import timedelta
+
+import polars as pl
+
+from conftest import BASE_TIME, ujp
+
+def storage_frame(*rows) -> pl.DataFrame:
+    """Filas (user_id, event_id, segundos desde BASE_TIME) con las columnas de _storage_frame"""
+    return pl.DataFrame(
+        [(user_id, event_id, 's1', 'app_open', 'navigation', BASE_TIME + timedelta(seconds=seconds), '{"screen":"home"}')
+         for user_id, event_id, seconds in rows],
+        schema={'user_id': pl.Utf8, 'event_id': pl.Utf8, 'session_id': pl.Utf8, 'event_name': pl.Utf8,
+                'event_type': pl.Utf8, 'timestamp': pl.Datetime('us'), 'properties': pl.Utf8},
+        orient='row'
+    )
+
+def cached(store: ujp.UserTimelineStore, user_id: str) -> list:
+    return [event_id for _, event_id, _ in store.get_local(user_id)]
+
+class FakeRedisList:
+    """Solo lrange sobre listas en memoria"""
+    
+    def __init__(self, lists):
+        self.lists = lists
+    
+    def lrange(self, key, start, end):
+        return self.lists.get(key, [])
+
+def test_encode_decode_round_trip():
+    encoded = ujp.UserTimelineStore.encode(storage_frame(('u1', 'e1', 5)))
+    name, event_type, timestamp, properties, session_id = ujp.UserTimelineStore.decode(encoded['event'][0])
+    
+    assert (name, event_type, session_id) == ('app_open', 'navigation', 's1')
+    assert timestamp == BASE_TIME + timedelta(seconds=5)
+    assert properties == {'screen': 'home'}
+
+def test_append_only_updates_cached_users_in_order():
+    store = ujp.UserTimelineStore(max_events=3)
+    store.put_local('u1', [])
+    store.append(ujp.UserTimelineStore.encode(storage_frame(('u1', 'e2', 20), ('u2', 'x1', 0), ('u1', 'e3', 30))))
+    # Un evento tardío se intercala por (t, id) y el más antiguo sale por el límite
+    store.append(ujp.UserTimelineStore.encode(storage_frame(('u1', 'e1', 10), ('u1', 'e4', 40))))
+    
+    assert cached(store, 'u1') == ['e2', 'e3', 'e4']
+    assert store.get_local('u2') is None
+
+def test_local_entries_expire_and_lru_is_bounded():
+    store = ujp.UserTimelineStore(max_users=2, local_ttl_seconds=60)
+    for user_id in ('u1', 'u2', 'u3'):
+        store.put_local(user_id, [])
+    assert store.cached_users() == ['u2', 'u3']
+    
+    # Cargado hace más de local_ttl_seconds: se vuelve a leer de Redis
+    store._local['u3'][0] -= 61
+    assert store.get_local('u3') is None
+    assert store.get_local('u2') == []
+
+def test_page_walks_back_with_cursor():
+    timeline = [(t, f"e{t}", '{}') for t in range(5)]
+    
+    page, cursor = ujp.UserTimelineStore.page(timeline, limit=2)
+    assert [event[1] for event in page] == ['e3', 'e4']
+    
+    page, cursor = ujp.UserTimelineStore.page(timeline, cursor=cursor, limit=2)
+    assert [event[1] for event in page] == ['e1', 'e2']
+    
+    page, cursor = ujp.UserTimelineStore.page(timeline, cursor=cursor, limit=2)
+    assert [event[1] for event in page] == ['e0']
+    assert cursor is None
+
+def test_load_redis_deduplicates_replayed_events():
+    events = ujp.UserTimelineStore.encode(storage_frame(('u1', 'e2', 20), ('u1', 'e1', 10)))['event'].to_list()
+    # Un reintento tras volver al checkpoint repite el RPUSH del mismo batch
+    redis_client = FakeRedisList({'timeline:u1': [event.encode() for event in events + events]})
+    store = ujp.UserTimelineStore(redis_client)
+    
+    assert [event_id for _, event_id, _ in store.load_redis('u1')] == ['e1', 'e2']